@@ -0,0 +1,766 @@
+import asyncio
+import time
+from collections import deque
+from common import (
+    PRIMARY_PORT, BACKUP_PORT, BUFFER_SIZE, FRAME_HEARTBEAT, FRAME_REPLICATE, FRAME_ACK, FRAME_CATCHUP,
+    FRAME_SNAPSHOT, FRAME_ROOM, FRAME_PRESENCE, FRAME_HELLO, FRAME_HEADER, HEARTBEAT_FRAME, HEARTBEAT_INTERVAL,
+    TAKEOVER_RETRY_INTERVAL, LISTEN_BACKLOG, FrameDecoder, FrameBuffer, ProtocolError, log_event
+)
+from connection import OutboundQueue, DEFAULT_FLUSH_DELAY, DEFAULT_FLUSH_BYTES
+from replication import (
+    ReplicationLog, MODE_ASYNC, MODE_SEMI_SYNC, DEFAULT_ACK_TIMEOUT, decode_ack,
+    decode_entry, encode_ack, encode_position, decode_position, encode_leader, split_frames
+)
+from history import HistoryReader
+from failure_detector import PhiAccrualDetector, DEFAULT_PHI_THRESHOLD, DEFAULT_ACCEPTABLE_PAUSE, CHECK_INTERVAL
+from profiling import profiler
+from handshake import DEFAULT_PEERS, HELLO_WAIT, ROLE_PEER, encode_hello, decode_hello, resolve_peers
+from server_core import ChatServerCore
+from tracing import is_traced, stamp, sequenced
+from delivery import encode_receipt, receipt_for, trace_of
+from rooms import decode_room, is_room_message, is_replayable, room_of
+from users import decode_presence
+from wal import WriteAheadLog, DURABILITY_BATCH
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+
+def raise_file_limit() -> None:
+    """
+    raise the open file limit as far as we're allowed.
+
+    every connection is a file descriptor, so the default soft limit of 1024
+    would stop us long before 10k clients.
+    """
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError) as e:
+        print(f"Could not raise open file limit: {e}")
+
+
+class BatchedWriter:
+    """
+    collects frames for one transport and hands them over in one writelines call.
+
+    flushes after flush_delay or as soon as flush_bytes are waiting, so a busy
+    room costs one send per batch instead of one per frame.
+    """
+
+    def __init__(self, transport, flush_delay: float = DEFAULT_FLUSH_DELAY,
+                 flush_bytes: int = DEFAULT_FLUSH_BYTES):
+        self.transport = transport
+        self.flush_delay = flush_delay
+        self.flush_bytes = flush_bytes
+        # frames waiting for the next flush
+        self.pending = []
+        self.pending_bytes = 0
+        # the scheduled flush, if there is one
+        self.flush_handle = None
+
+    def write(self, data: bytes) -> None:
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+        if self.pending_bytes >= self.flush_bytes:
+            self.flush()
+        elif self.flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self.flush_handle = loop.call_later(self.flush_delay, self.flush)
+
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.pending:
+            return
+        if not self.transport.is_closing():
+            with profiler.span("writelines"):
+                self.transport.writelines(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+
+
+class ChatProtocol(asyncio.BufferedProtocol):
+    """
+    one client connection, owned by an async server.
+
+    the loop reads straight into our pooled receive buffer and each frame is
+    handled in place there, as a memoryview that's gone once the next read
+    starts. frames go straight to the transport until it asks us to pause,
+    after that they wait in a bounded outbound queue with the server's slow
+    consumer policy.
+
+    a new connection is nobody's until it has said hello, or sent something
+    else first, or HELLO_WAIT has passed, then the server decides whether
+    it's a client or a peer.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.address = None
+        self.frames = FrameBuffer()
+        self.queue = OutboundQueue(server.queue_frames, server.queue_bytes, server.slow_consumer_policy)
+        # set while the transport's write buffer is above its high water mark
+        self.paused = False
+        # the id the server's client registry gave us
+        self.client_id = None
+        # the timer that takes us for a client if we don't say hello, None once the server knows what we are
+        self.greeting = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')
+        self.writer = BatchedWriter(transport, self.server.flush_delay, self.server.flush_bytes)
+        self.greeting = asyncio.get_running_loop().call_later(HELLO_WAIT, self.greet, None)
+
+    def greet(self, hello):
+        # tell the server what we are, hello is None for a client that didn't say
+        self.greeting.cancel()
+        self.greeting = None
+        self.server.greeted(self, hello)
+
+    def get_buffer(self, sizehint):
+        return self.frames.space()
+
+    def buffer_updated(self, nbytes):
+        self.frames.filled(nbytes)
+        with profiler.span("data_received"):
+            while True:
+                try:
+                    with profiler.span("decode"):
+                        frame = self.frames.next_frame()
+                except ProtocolError as e:
+                    print(f"Error handling client {self.address}: {e}")
+                    self.transport.close()
+                    return
+                if frame is None:
+                    break
+                if self.greeting is not None:
+                    if frame[0] == FRAME_HELLO:
+                        try:
+                            hello = decode_hello(frame[1][FRAME_HEADER.size:])
+                        except ProtocolError as e:
+                            print(f"Error greeting {self.address}: {e}")
+                            self.transport.close()
+                            return
+                        self.greet(hello)
+                        continue
+                    self.greet(None)
+                try:
+                    self.server.frame_received(self, *frame)
+                except Exception as e:
+                    # a frame we can't make sense of costs this connection, the way a
+                    # threaded server's handler thread drops its client, not the loop
+                    print(f"Error handling client {self.address}: {e}")
+                    self.transport.close()
+                    return
+            self.server.frames_done(self)
+
+    def connection_lost(self, exc):
+        self.queue.close()
+        if self.greeting is not None:
+            # gone before it said what it was, the server never knew about it
+            self.greeting.cancel()
+            self.greeting = None
+        else:
+            self.server.connection_lost(self)
+        self.frames.release()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        # whatever was batched before the pause has to go out before the queue
+        self.writer.flush()
+        pending = self.queue.drain()
+        if pending:
+            self.transport.writelines(pending)
+
+    def write(self, data: bytes) -> bool:
+        """
+        send a frame without ever blocking the event loop.
+
+        Returns:
+            false if the client is gone or was dropped for being too slow
+        """
+        if self.transport.is_closing():
+            return False
+        if not self.paused:
+            self.writer.write(data)
+            return True
+        if self.queue.put(data):
+            return True
+        print(f"Disconnecting slow client {self.address}")
+        self.transport.abort()
+        return False
+
+    # the shared handlers in server_core send to any connection this way
+    send = write
+
+    def queue_depth(self) -> int:
+        """how many frames are waiting for this client beyond the transport's own buffer."""
+        return len(self.queue)
+
+
+class AsyncServerBase(ChatServerCore):
+    """the asyncio engine: one event loop accepts and serves every client."""
+
+    def __init__(self, port: int, **options):
+        super().__init__(port, **options)
+        # the event loop and listening server, set once we start
+        self.loop = None
+        self.server = None
+        # (seq, wal seq, frame, sender) held back from fan out until the backup
+        # acks seq and the disk has wal seq, in the order they arrived
+        self.held = deque()
+        # everything up to this replication seq no longer waits on the backup
+        self.released_seq = 0
+
+    def start(self):
+        raise_file_limit()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.stop()
+            self.loop.close()
+
+    async def serve(self):
+        # listen for clients and run the role specific background tasks
+        self.server = await self.loop.create_server(
+            lambda: ChatProtocol(self), '0.0.0.0', self.port,
+            reuse_address=True, backlog=LISTEN_BACKLOG
+        )
+        print(f"{self.role_name} server listening on port {self.port} (asyncio engine)")
+        if self.stats_port is not None:
+            # the subclasses have set up everything the gauges read by now
+            self.metrics.watch(self)
+            self.metrics.serve(self.stats_port)
+        await asyncio.gather(*self.background_tasks())
+
+    def background_tasks(self) -> list:
+        return []
+
+    def greeted(self, protocol, hello):
+        # a connection is a client unless its hello says it's a peer, we never go by its address
+        if hello is not None and hello.role == ROLE_PEER:
+            self.peer_connected(protocol, hello)
+            return
+        if hello is not None:
+            print(f"Client {hello.node_id} connected from {protocol.address}")
+        self.connection_made(protocol)
+
+    def peer_connected(self, protocol, hello):
+        # we dial our backup, nothing replicates to a primary
+        print(f"Refused {hello.node_id} at {protocol.address}, it wants to replicate to us but we're the primary")
+        protocol.transport.close()
+
+    def connection_made(self, protocol):
+        print(f"New connection from {protocol.address}")
+        # catch the client up on recent messages in one write before it sees anything live
+        self.add_client(protocol)
+
+    def connection_lost(self, protocol):
+        if protocol.client_id is None:
+            # a peer we turned away was never one of our clients
+            return
+        self.client_gone(protocol)
+        print(f"Client {protocol.address} disconnected")
+
+    def frame_received(self, protocol, frame_type, frame):
+        # frame is the whole encoded frame in the protocol's receive buffer, it's
+        # sent on with one copy and never decoded, anything kept has to be copied
+        if not self.handle_frame(protocol, frame_type, frame):
+            protocol.transport.close()
+
+    def frames_done(self, protocol):
+        # called after every frame from one read has been handled
+        pass
+
+    def fan_out(self, data: bytes, sender):
+        # remember the frame for clients that join later and send it to all clients except the sender
+        started = time.perf_counter()
+        with profiler.span("fan_out"):
+            if is_room_message(data):
+                # only the room's connections get it, and it's not replayed to everyone who connects
+                self.room_history.append(data)
+                recipients = self.rooms.recipients(room_of(data))
+            else:
+                self.history.append(data)
+                recipients = self.clients.snapshot()
+            sent = 0
+            for client in recipients:
+                if client is not sender and client.write(data):
+                    sent += 1
+        elapsed = time.perf_counter() - started
+        self.metrics.fanout_seconds.observe(elapsed)
+        profiler.record_broadcast(elapsed, len(recipients))
+        self.metrics.messages_out.inc(sent)
+        self.metrics.bytes_out.inc(sent * len(data))
+
+    def open_wal(self):
+        # open the write-ahead log, its writer thread tells the loop about every commit
+        if self.wal_options is None or self.wal is not None:
+            return
+        self.wal = WriteAheadLog(on_commit=self.wal_committed, **self.wal_options)
+        self.wal.start()
+        self.history_reader = HistoryReader(self.wal.directory)
+        print(f"Logging messages to {self.wal.directory} from {self.wal.last_seq + 1} "
+              f"with {self.wal.durability} durability")
+
+    def wal_committed(self, seq: int):
+        # runs on the wal's writer thread, so hop back onto the loop
+        try:
+            self.loop.call_soon_threadsafe(self.release_held)
+        except RuntimeError:
+            pass  # the loop is already closed
+
+    def persist(self, data: bytes) -> int:
+        # queue the frame for the next group commit, returns the record fan out
+        # has to wait for or 0 if the durability mode doesn't wait
+        if self.wal is None:
+            return 0
+        seq = self.wal.append(data)
+        return seq if self.wal.durability == DURABILITY_BATCH else 0
+
+    def hold(self, seq: int, wal_seq: int, data: bytes, sender):
+        # frames always go through held so nothing overtakes one still waiting
+        self.held.append((seq, wal_seq, data, sender))
+        self.release_held()
+
+    def release_held(self):
+        # fan out everything at the front that isn't waiting on anything any more
+        committed = self.wal.committed_seq if self.wal is not None else 0
+        while self.held:
+            seq, wal_seq, data, sender = self.held[0]
+            if seq > self.released_seq or wal_seq > committed:
+                break
+            self.held.popleft()
+            if is_traced(data):
+                now = time.time()
+                data = stamp(data, replicated=now if self.is_acked(seq) else None, fanned_out=now)
+                self.fan_out(data, sender)
+                # once it's out the sender can stop keeping it
+                if sender is not None:
+                    sender.write(receipt_for(data))
+                continue
+            self.fan_out(data, sender)
+
+    def is_acked(self, seq: int) -> bool:
+        # whether the backup has acked a held frame, only a primary ever knows
+        return False
+
+    def stop(self):
+        # stop the server and clean up, the loop may already be gone after ctrl+c
+        self.is_running = False
+        if self.loop is None or self.loop.is_closed():
+            return
+        if self.server:
+            self.server.close()
+        for client in self.clients.snapshot():
+            try:
+                client.transport.close()
+            except Exception:
+                pass
+        if self.wal is not None:
+            self.wal.close()
+        self.metrics.close()
+
+
+class AsyncPrimaryServer(AsyncServerBase):
+    role_name = "Primary"
+
+    def __init__(self, port: int = PRIMARY_PORT, backup_address: tuple = ('127.0.0.1', BACKUP_PORT),
+                 replication_mode: str = MODE_ASYNC, ack_timeout: float = DEFAULT_ACK_TIMEOUT,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL, **options):
+        super().__init__(port, **options)
+        # numbers everything we replicate and tracks the backup's acks
+        self.replication_log = ReplicationLog(replication_mode, ack_timeout)
+        # task reading acks from the backup
+        self.ack_task = None
+        # where the backup server listens
+        self.backup_address = backup_address
+        # flag to track if we're connected to the backup server
+        self.backup_connected = False
+        # stream for talking to the backup server and the batching writer on top of it
+        self.backup_stream = None
+        self.backup_writer = None
+        # how long the link to the backup may go quiet before we send a heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        # when we last sent the backup anything, by time.monotonic
+        self.replicated_at = 0.0
+
+    async def serve(self):
+        # start logging messages to disk before the first client can send one, and
+        # after a restart carry on numbering from what we logged before it
+        self.open_wal()
+        if self.wal is not None:
+            seq = self.recover_log()
+            self.replication_log.restart(self.history.tail() + self.room_history.tail(), seq)
+        await super().serve()
+
+    def background_tasks(self) -> list:
+        return [self.connect_to_backup(), self.send_heartbeat()]
+
+    async def connect_to_backup(self):
+        # keep the link to the backup up for as long as we run, we always dial
+        # the backup so every accepted connection here is a client
+        while self.is_running:
+            if self.backup_stream is None:
+                try:
+                    reader, stream = await asyncio.open_connection(*self.backup_address)
+                    # say we're the server it should follow before anything else
+                    stream.write(encode_hello(ROLE_PEER, self.epoch, self.node_id))
+                    self.backup_stream = stream
+                    self.backup_writer = BatchedWriter(stream.transport, self.flush_delay, self.flush_bytes)
+                    # live entries start once the backup has told us where it's up to
+                    print("Connected to backup server")
+                    self.ack_task = asyncio.ensure_future(self.read_acks(reader, stream))
+                except OSError as e:
+                    print(f"Failed to connect to backup server: {e}")
+            await asyncio.sleep(1)
+
+    async def send_heartbeat(self):
+        # send the backup a heartbeat whenever the link has been quiet for a heartbeat
+        # interval, while messages are flowing they tell it we're alive instead
+        while self.is_running:
+            quiet_for = time.monotonic() - self.replicated_at
+            if self.backup_writer is not None and quiet_for >= self.heartbeat_interval:
+                self.replicate(HEARTBEAT_FRAME)
+                self.metrics.heartbeats_sent.inc()
+                quiet_for = 0
+            await asyncio.sleep(max(self.heartbeat_interval - quiet_for, CHECK_INTERVAL))
+
+    async def read_acks(self, reader, stream):
+        # the backup acks what it has applied on the same connection
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = await reader.read(BUFFER_SIZE)
+                if not data:
+                    break
+                for frame_type, payload in decoder.feed(data):
+                    if frame_type == FRAME_ACK:
+                        self.replication_log.ack(decode_ack(payload))
+                    elif frame_type == FRAME_CATCHUP:
+                        self.catch_up_backup(*decode_position(payload)[:2])
+                    elif frame_type == FRAME_HELLO and not self.backup_hello(decode_hello(payload)):
+                        stream.close()
+                        raise ConnectionError("backup has followed a newer primary")
+                self.release(self.replication_log.acked_seq)
+        except (OSError, ProtocolError):
+            pass
+        if stream is self.backup_stream:
+            self.lost_backup()
+
+    def catch_up_backup(self, log_id: int, seq: int):
+        # send the backup what it missed, nothing else runs on the loop meanwhile
+        # so no live entry can get ahead of it
+        frames = self.replication_log.catch_up(log_id, seq)
+        for frame in frames:
+            self.backup_writer.write(frame)
+        # then the whole member table and who is online, which the backup
+        # can't get from a snapshot of messages
+        for frame in self.rooms.snapshot() + self.users.snapshot():
+            self.backup_writer.write(frame)
+        self.backup_connected = True
+        print(f"Backup caught up from {seq} to {self.replication_log.last_seq} with {len(frames)} frames")
+
+    def release(self, seq: int):
+        # stop waiting on the backup for everything up to and including seq
+        self.released_seq = max(self.released_seq, seq)
+        self.release_held()
+
+    def replicate(self, data: bytes):
+        # push a frame to the backup without waiting on it
+        if self.backup_writer is None:
+            return
+        if self.backup_writer.transport.is_closing():
+            self.lost_backup()
+            return
+        self.backup_writer.write(data)
+        self.replicated_at = time.monotonic()
+
+    def is_acked(self, seq: int) -> bool:
+        # held frames without a seq never waited on the backup
+        return 0 < seq <= self.replication_log.acked_seq
+
+    def lost_backup(self):
+        self.backup_connected = False
+        self.backup_stream = None
+        self.backup_writer = None
+        self.replication_log.reset()
+        # nothing more is going to be acked, so stop holding anything back
+        self.release(self.replication_log.last_seq)
+        print("Lost connection to backup server")
+
+    def broadcast_frame(self, data: bytes, sender):
+        # a traced message a client resent after reconnecting only gets its receipt again
+        key = trace_of(data).trace_id if is_traced(data) else None
+        if key is not None:
+            seq = self.delivered.claim(key)
+            if seq is not None:
+                if sender is not None:
+                    sender.write(encode_receipt(key, seq))
+                return
+        # every frame goes in the log so a backup that connects later can catch up,
+        # it's only sent straight away if the backup is connected. a traced message
+        # carries its number on to every client
+        data = sequenced(data, self.replication_log.last_seq + 1)
+        seq, entry = self.replication_log.append(data)
+        if key is not None:
+            self.delivered.record(key, seq)
+        if self.apply_change(data):
+            # membership and presence only have to reach our tables and the backup
+            if self.backup_connected:
+                self.replicate(entry)
+            return
+        wal_seq = self.persist(data)
+        if not self.backup_connected or self.replication_log.mode == MODE_ASYNC:
+            if self.backup_connected:
+                self.replicate(entry)
+            self.hold(0, wal_seq, data, sender)
+            return
+        self.replicate(entry)
+        # semi-sync and sync hold the frame until the backup acks it, without
+        # blocking the loop, semi-sync only holds it for ack_timeout
+        self.hold(seq, wal_seq, data, sender)
+        if self.replication_log.mode == MODE_SEMI_SYNC:
+            self.loop.call_later(self.replication_log.ack_timeout, self.release, seq)
+
+    def replication_lag(self):
+        # how far behind the backup is, see ReplicationLog.lag
+        return self.replication_log.lag()
+
+    def stop(self):
+        super().stop()
+        if self.backup_stream is not None and not self.loop.is_closed():
+            try:
+                self.backup_stream.close()
+            except Exception:
+                pass
+        if self.ack_task is not None and not self.loop.is_closed():
+            self.ack_task.cancel()
+            self.loop.run_until_complete(asyncio.gather(self.ack_task, return_exceptions=True))
+
+
+class AsyncBackupServer(AsyncPrimaryServer):
+    """
+    follows the primary until it stops hearing from it, then takes over.
+
+    it's a primary that hasn't taken over yet: once promoted it takes the
+    primary's clients on the primary's port as well as its own and
+    replicates to a backup of its own at backup_address, if it has one.
+    """
+
+    role_name = "Backup"
+
+    def __init__(self, port: int = BACKUP_PORT, takeover_port: int = PRIMARY_PORT, backup_address: tuple = None,
+                 phi_threshold: float = DEFAULT_PHI_THRESHOLD, acceptable_pause: float = DEFAULT_ACCEPTABLE_PAUSE,
+                 peers: tuple = DEFAULT_PEERS, **options):
+        super().__init__(port, backup_address=backup_address, **options)
+        # the addresses a primary may replicate to us from, a hello from anywhere else is a client lying
+        self.peers = resolve_peers(peers)
+        # the port clients reach the primary on, we take it over once promoted, None to leave it
+        self.takeover_port = takeover_port
+        self.takeover_server = None
+        # a primary's background tasks, started once we're promoted
+        self.takeover_tasks = []
+        # flag to track if we're connected to the primary server
+        self.primary_connected = False
+        # protocol for the primary server's connection and the node id it gave in its hello
+        self.primary_protocol = None
+        self.primary_node = None
+        # judges from every frame the primary sends how long a silence means it's dead
+        self.detector = PhiAccrualDetector(self.heartbeat_interval, phi_threshold, acceptable_pause)
+        # set once we've taken over as primary
+        self.promoted = False
+        # which primary log we're following, the last entry we applied from it and the last one we acked
+        self.log_id = 0
+        self.applied_seq = 0
+        self.acked_seq = 0
+        self.taking_messages = False
+
+    async def serve(self):
+        # no log of our own until we take over
+        await AsyncServerBase.serve(self)
+        await asyncio.gather(*self.takeover_tasks)
+
+    def background_tasks(self) -> list:
+        return [self.monitor_primary()]
+
+    def primary_lost(self) -> bool:
+        # its connection dropped and the failure detector hasn't given up on it yet
+        return self.primary_connected and self.primary_protocol is None and not self.promoted
+
+    def peer_connected(self, protocol, hello):
+        # a primary wants to replicate to us. we answer with our own hello either way,
+        # so one we turn down can see from our epoch that it has been replaced
+        if protocol.address[0] not in self.peers:
+            # not a host the primary runs on, it isn't told our epoch or anything else
+            print(f"Refused {hello.node_id} at {protocol.address}, it says it's a primary but isn't one of our peers")
+            protocol.transport.close()
+            return
+        refused = None
+        if self.promoted:
+            refused = "we're the primary now"
+        elif hello.epoch < self.epoch:
+            refused = f"its epoch {hello.epoch} is behind {self.primary_node}'s {self.epoch}"
+        else:
+            self.epoch = hello.epoch
+        protocol.transport.write(encode_hello(ROLE_PEER, self.epoch, self.node_id))
+        if refused is not None:
+            print(f"Refused primary {hello.node_id} at {protocol.address}, {refused}")
+            protocol.transport.close()
+            return
+        # a newer connection replaces the one we had
+        replaced = self.primary_protocol
+        self.primary_protocol = protocol
+        self.primary_node = hello.node_id
+        self.primary_connected = True
+        self.detector.reset()
+        self.refuse_waiting()
+        # tell the primary where we're up to so it only sends what we missed
+        protocol.transport.write(encode_position(FRAME_CATCHUP, self.log_id, self.applied_seq))
+        print(f"Primary server {hello.node_id} connected from {protocol.address} at epoch {hello.epoch}")
+        if replaced is not None:
+            replaced.transport.close()
+
+    def connection_lost(self, protocol):
+        if protocol is self.primary_protocol:
+            # monitor_primary takes over unless it reconnects before the failure detector gives up on it
+            self.primary_protocol = None
+            print("Lost connection to primary server")
+            log_event("primary_lost", silent_for=f"{self.detector.silence():.3f}")
+            return
+        super().connection_lost(protocol)
+
+    def frame_received(self, protocol, frame_type, frame):
+        if protocol is self.primary_protocol:
+            payload = frame[FRAME_HEADER.size:]
+            quiet_for = self.detector.heartbeat()
+            if frame_type == FRAME_HEARTBEAT:
+                # the primary had nothing else to send, how late the heartbeat was shows how much its loop lags
+                if quiet_for is not None:
+                    self.metrics.heartbeat_interval.observe(quiet_for)
+                return
+            if frame_type == FRAME_REPLICATE:
+                # apply the entry unless we've already seen it
+                seq, data = decode_entry(payload)
+                if seq > self.applied_seq and self.apply_change(data):
+                    self.applied_seq = seq
+                elif seq > self.applied_seq:
+                    if is_traced(data):
+                        self.delivered.record(trace_of(data).trace_id, seq)
+                        data = stamp(data, replicated=time.time())
+                    # a view of the receive buffer, what we keep has to be a copy
+                    self.fan_out(bytes(data), protocol)
+                    self.applied_seq = seq
+                return
+            if frame_type == FRAME_CATCHUP:
+                # the entries that follow carry on from where we are
+                self.log_id, _, _ = decode_position(payload)
+                return
+            if frame_type == FRAME_SNAPSHOT:
+                # we were too far behind, so start over from the primary's snapshot
+                self.log_id, self.applied_seq, body = decode_position(payload)
+                self.acked_seq = -1
+                self.history.clear()
+                self.room_history.clear()
+                for frame in split_frames(body):
+                    if is_room_message(frame):
+                        self.room_history.append(frame)
+                        continue
+                    if not is_replayable(frame):
+                        continue
+                    if is_traced(frame):
+                        trace = trace_of(frame)
+                        self.delivered.record(trace.trace_id, trace.seq)
+                    self.history.append(frame)
+                return
+            if frame_type == FRAME_ROOM:
+                # the primary's member table and who is online, sent after a catch-up
+                self.rooms.apply(*decode_room(payload))
+                return
+            if frame_type == FRAME_PRESENCE:
+                self.users.apply(*decode_presence(payload))
+                return
+        super().frame_received(protocol, frame_type, frame)
+
+    def frames_done(self, protocol):
+        # one cumulative ack for everything that arrived in this read
+        if protocol is self.primary_protocol and self.applied_seq > self.acked_seq:
+            protocol.transport.write(encode_ack(self.applied_seq))
+            self.acked_seq = self.applied_seq
+
+    async def monitor_primary(self):
+        # take over once the failure detector gives up on the primary, whether its
+        # connection dropped or it's still open and has gone quiet
+        while self.is_running and not self.promoted:
+            await asyncio.sleep(CHECK_INTERVAL)
+            if self.primary_connected and self.detector.suspects():
+                print("Primary server heartbeat timeout")
+                log_event("heartbeat_timeout", silent_for=f"{self.detector.silence():.3f}",
+                          phi=f"{self.detector.phi():.1f}")
+                self.promote_to_primary()
+
+    def promote_to_primary(self):
+        # take over as the primary server
+        print("Promoting to primary server...")
+        log_event("promotion_started")
+        self.primary_connected = False
+        self.promoted = True
+        # a backup that has followed us won't go back to the primary we replaced
+        self.epoch += 1
+        # from here on we're the one that has to keep messages safe
+        self.open_wal()
+        if self.primary_protocol is not None:
+            self.primary_protocol.transport.close()
+            self.primary_protocol = None
+        # our log starts over from what we have, a backup that connects gets it as a
+        # snapshot, and the numbering carries on from the primary's so clients can resume
+        self.replication_log.restart(self.history.tail() + self.room_history.tail(), self.applied_seq)
+        self.take_messages()
+        # everyone already here hears it from us, everyone still retrying the primary finds us there
+        leader = encode_leader(self.takeover_port or self.port)
+        for client in self.clients.snapshot():
+            client.write(leader)
+        tasks = [self.send_heartbeat()]
+        if self.takeover_port:
+            tasks.append(self.take_over_port())
+        if self.backup_address is not None:
+            tasks.append(self.connect_to_backup())
+        self.takeover_tasks = [asyncio.ensure_future(task) for task in tasks]
+        log_event("promotion_done", clients=len(self.clients))
+
+    async def take_over_port(self):
+        # the port only frees up once the old primary's process is really gone
+        failed = False
+        while self.is_running and self.takeover_server is None:
+            try:
+                self.takeover_server = await self.loop.create_server(
+                    lambda: ChatProtocol(self), '0.0.0.0', self.takeover_port,
+                    reuse_address=True, backlog=LISTEN_BACKLOG
+                )
+            except OSError as e:
+                if not failed:
+                    print(f"Port {self.takeover_port} is still taken, retrying: {e}")
+                    failed = True
+                await asyncio.sleep(TAKEOVER_RETRY_INTERVAL)
+                continue
+            print(f"Took over port {self.takeover_port} for clients")
+            log_event("port_taken_over", port=self.takeover_port)
+
+    def stop(self):
+        if self.takeover_server is not None and not self.loop.is_closed():
+            self.takeover_server.close()
+        super().stop()
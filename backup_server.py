@@ -1,153 +1,373 @@
-import socket
+import argparse
 import threading
 import time
-from common import BACKUP_PORT, send_message, receive_message
-
-class BackupServer:
-    def __init__(self):
-        # keep track of all connected clients
-        self.clients = []
-        # flag to control the server's main loop
-        self.is_running = True
+from common import (
+    PRIMARY_PORT, BACKUP_PORT, FRAME_HEARTBEAT, FRAME_REPLICATE, FRAME_CATCHUP, FRAME_SNAPSHOT, FRAME_ROOM,
+    FRAME_PRESENCE, FRAME_HEADER, HEARTBEAT_INTERVAL, TAKEOVER_RETRY_INTERVAL, get_reader, release_reader,
+    send_encoded, parse_address, log_event
+)
+from connection import (
+    POLICIES, POLICY_DROP_OLDEST, DEFAULT_MAX_FRAMES, DEFAULT_MAX_BYTES, DEFAULT_FLUSH_DELAY, DEFAULT_FLUSH_BYTES
+)
+from replication import (
+    MODES, MODE_ASYNC, DEFAULT_ACK_TIMEOUT, decode_entry, encode_ack, encode_position, decode_position,
+    encode_leader, split_frames
+)
+from history import DEFAULT_HISTORY_MESSAGES, DEFAULT_HISTORY_BYTES, DEFAULT_REPLAY_MESSAGES
+from failure_detector import PhiAccrualDetector, DEFAULT_PHI_THRESHOLD, DEFAULT_ACCEPTABLE_PAUSE, CHECK_INTERVAL
+from handshake import DEFAULT_PEERS, ROLE_PEER, encode_hello, resolve_peers
+from server_core import ThreadedServer
+from tracing import is_traced, stamp
+from delivery import trace_of
+from rooms import decode_room, is_replayable, is_room_message
+from users import decode_presence
+from profiling import (
+    profiler, install_signal_handler, DEFAULT_PROFILE_DIR, DEFAULT_DUMP_INTERVAL, DEFAULT_TOP_BROADCASTS
+)
+from wal import DURABILITIES, DURABILITY_INTERVAL, DEFAULT_COMMIT_INTERVAL, DEFAULT_SYNC_INTERVAL
+
+class BackupServer(ThreadedServer):
+    """
+    follows the primary until it stops hearing from it, then takes over.
+
+    clients can connect to it all along, once promoted it serves them as
+    the primary did and replicates to a backup of its own at backup_address,
+    if it has one.
+    """
+
+    def __init__(self, port=BACKUP_PORT, takeover_port=PRIMARY_PORT, backup_address=None,
+                 phi_threshold=DEFAULT_PHI_THRESHOLD, acceptable_pause=DEFAULT_ACCEPTABLE_PAUSE,
+                 peers=DEFAULT_PEERS, **options):
+        super().__init__(port, backup_address=backup_address, **options)
+        # the addresses a primary may replicate to us from, a hello from anywhere else is a client lying
+        self.peers = resolve_peers(peers)
+        # the node id of the primary we follow, and the lock that makes sure only one connection is it
+        self.primary_node = None
+        self.peer_lock = threading.Lock()
+        # the port clients reach the primary on, we take it over once promoted, None to leave it,
+        # and the socket we accept them on there once we have
+        self.takeover_port = takeover_port
+        self.takeover_socket = None
         # flag to track if we're connected to the primary server
         self.primary_connected = False
         # socket for talking to the primary server
         self.primary_socket = None
-        # when we last got a heartbeat from the primary
-        self.last_heartbeat = time.time()
-        # how long to wait before assuming primary is dead
-        self.heartbeat_timeout = 3  # seconds
+        # judges from every frame the primary sends how long a silence means it's dead
+        self.detector = PhiAccrualDetector(self.heartbeat_interval, phi_threshold, acceptable_pause)
+        # set once we've taken over as primary
+        self.promoted = False
+        # which primary log we're following and the last entry we applied from it
+        self.log_id = 0
+        self.applied_seq = 0
+        self.taking_messages = False
 
     def start(self):
-        # create a socket to listen for connections
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # allow reusing the port if it's still in use
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # bind to all network interfaces on our port
-        server_socket.bind(('0.0.0.0', BACKUP_PORT))
-        # start listening for connections
-        server_socket.listen(5)
-        print(f"Backup server listening on port {BACKUP_PORT}")
-
-        # main loop to accept new connections
-        while self.is_running:
+        # listen for the primary and for clients on our own port
+        self.server_socket = self.listen(self.port)
+        print(f"Backup server listening on port {self.port}")
+        if self.stats_port is not None:
+            self.metrics.serve(self.stats_port)
+        # watch for the primary going quiet on a thread of its own, not just when a read fails
+        threading.Thread(target=self.monitor_primary, daemon=True).start()
+        self.accept_clients(self.server_socket)
+
+    def primary_lost(self):
+        # its connection dropped and the failure detector hasn't given up on it yet
+        return self.primary_connected and self.primary_socket is None and not self.promoted
+
+    def peer_connected(self, primary_socket, address, hello):
+        # a primary wants to replicate to us. we answer with our own hello either way,
+        # so one we turn down can see from our epoch that it has been replaced
+        if address[0] not in self.peers:
+            # not a host the primary runs on, it isn't told our epoch or anything else
+            print(f"Refused {hello.node_id} at {address}, it says it's a primary but isn't one of our peers")
+            primary_socket.close()
+            return
+        with self.peer_lock:
+            refused = None
+            if self.promoted:
+                refused = "we're the primary now"
+            elif hello.epoch < self.epoch:
+                refused = f"its epoch {hello.epoch} is behind {self.primary_node}'s {self.epoch}"
+            if refused is None:
+                self.epoch = hello.epoch
             try:
-                # wait for a new connection
-                client_socket, address = server_socket.accept()
-                print(f"New connection from {address}")
-                
-                # check if this is the primary server trying to connect
-                if address[0] == '127.0.0.1' and not self.primary_connected:
-                    self.primary_socket = client_socket
-                    self.primary_connected = True
-                    self.last_heartbeat = time.time()
-                    print("Primary server connected")
-                    
-                    # start checking for heartbeats from the primary
-                    heartbeat_thread = threading.Thread(target=self.monitor_heartbeat, daemon=True)
-                    heartbeat_thread.start()
-                    continue
-                
-                # add the new client to our list
-                self.clients.append(client_socket)
-                
-                # start a thread to handle this client's messages
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, address),
-                    daemon=True
-                )
-                client_thread.start()
-                
-            except Exception as e:
-                if self.is_running:
-                    print(f"Error accepting connection: {e}")
+                send_encoded(primary_socket, encode_hello(ROLE_PEER, self.epoch, self.node_id))
+            except OSError as e:
+                refused = str(e)
+            if refused is not None:
+                print(f"Refused primary {hello.node_id} at {address}, {refused}")
+                primary_socket.close()
+                return
+            # a newer connection replaces the one we had, the old reader sees it's been replaced and stops
+            replaced = self.primary_socket
+            self.primary_node = hello.node_id
+            self.attach_primary(primary_socket)
+            if replaced is not None:
+                try:
+                    replaced.close()
+                except OSError:
+                    pass
+        print(f"Primary server {hello.node_id} connected from {address} at epoch {hello.epoch}")
+
+    def attach_primary(self, primary_socket):
+        self.primary_socket = primary_socket
+        self.primary_connected = True
+        self.detector.reset()
+        self.refuse_waiting()
+        
+        # tell the primary where we're up to so it only sends what we missed
+        send_encoded(primary_socket, encode_position(FRAME_CATCHUP, self.log_id, self.applied_seq))
+        
+        # start applying what the primary sends
+        primary_thread = threading.Thread(target=self.follow_primary, args=(primary_socket,), daemon=True)
+        primary_thread.start()
 
-    def monitor_heartbeat(self):
-        # keep checking if the primary server is still alive
-        while self.is_running and self.primary_connected:
+    def follow_primary(self, primary_socket):
+        # apply what the primary sends us, every frame tells the failure detector it's alive
+        acked_seq = self.applied_seq
+        reader = get_reader(primary_socket)
+        while self.is_running and primary_socket is self.primary_socket:
             try:
-                # get a message from the primary
-                message = receive_message(self.primary_socket)
-                if message == "HEARTBEAT":
-                    # primary is still alive, update the timestamp
-                    self.last_heartbeat = time.time()
+                # get a frame from the primary, in place in the receive buffer
+                received = reader.read_view()
+                if received is None:
+                    raise ConnectionError("primary server closed the connection")
+                frame_type, frame = received
+                payload = frame[FRAME_HEADER.size:]
+                quiet_for = self.detector.heartbeat()
+                if frame_type == FRAME_HEARTBEAT:
+                    # the primary had nothing else to send, see how late the heartbeat was
+                    if quiet_for is not None:
+                        self.metrics.heartbeat_interval.observe(quiet_for)
+                elif frame_type == FRAME_REPLICATE:
+                    self.apply_entry(payload)
+                elif frame_type == FRAME_CATCHUP:
+                    # the entries that follow carry on from where we are
+                    self.log_id, _, _ = decode_position(payload)
+                elif frame_type == FRAME_SNAPSHOT:
+                    self.apply_snapshot(payload)
+                    # we may have moved back to an earlier position, so always ack it
+                    acked_seq = -1
+                elif frame_type == FRAME_ROOM:
+                    # the primary's member table and who is online, sent after a catch-up
+                    self.rooms.apply(*decode_room(payload))
+                elif frame_type == FRAME_PRESENCE:
+                    self.users.apply(*decode_presence(payload))
                 else:
-                    # forward any other messages to our clients
-                    self.broadcast(message, self.primary_socket)
-            except:
-                # if we haven't heard from the primary in a while, take over
-                if time.time() - self.last_heartbeat > self.heartbeat_timeout:
-                    print("Primary server heartbeat timeout")
-                    self.promote_to_primary()
-                    break
+                    # forward any other messages to our clients as they came
+                    self.broadcast_frame(bytes(frame), primary_socket)
+                
+                # ack once we've worked through everything the last read gave us,
+                # so a burst of entries costs one ack instead of one each
+                if self.applied_seq > acked_seq and not reader.pending:
+                    send_encoded(primary_socket, encode_ack(self.applied_seq))
+                    acked_seq = self.applied_seq
+            except Exception as e:
+                print(f"Lost connection to primary server: {e}")
+                break
+        # this thread was the socket's only reader
+        release_reader(primary_socket)
+        
+        if primary_socket is not self.primary_socket:
+            return
+        log_event("primary_lost", silent_for=f"{self.detector.silence():.3f}")
+        # free the slot so a primary that reconnects in time can pick up where it left off,
+        # monitor_primary takes over if it doesn't
+        try:
+            primary_socket.close()
+        except:
+            pass
+        self.primary_socket = None
+
+    def monitor_primary(self):
+        # take over once the failure detector gives up on the primary, whether its
+        # connection dropped or it's still open and has gone quiet
+        while self.is_running and not self.promoted:
+            time.sleep(CHECK_INTERVAL)
+            if self.primary_connected and self.detector.suspects():
+                print("Primary server heartbeat timeout")
+                log_event("heartbeat_timeout", silent_for=f"{self.detector.silence():.3f}",
+                          phi=f"{self.detector.phi():.1f}")
+                self.promote_to_primary()
+
+    def apply_entry(self, payload):
+        # hand a replicated frame to our clients, skipping anything we've already applied
+        seq, frame = decode_entry(payload)
+        if seq <= self.applied_seq:
+            return
+        if self.apply_change(frame):
+            self.applied_seq = seq
+            return
+        if is_traced(frame):
+            # the primary never knows when we had it in async mode, so we fill that hop in
+            self.delivered.record(trace_of(frame).trace_id, seq)
+            frame = stamp(frame, replicated=time.time())
+        # the entry is a view of the receive buffer, what we keep has to be a copy
+        self.fan_out(bytes(frame), self.primary_socket)
+        self.applied_seq = seq
+
+    def apply_snapshot(self, payload):
+        # we were too far behind, so start over from the primary's snapshot
+        self.log_id, self.applied_seq, body = decode_position(payload)
+        frames = split_frames(body)
+        room_frames = [frame for frame in frames if is_room_message(frame)]
+        frames = [frame for frame in frames if is_replayable(frame)]
+        for frame in frames:
+            if is_traced(frame):
+                trace = trace_of(frame)
+                self.delivered.record(trace.trace_id, trace.seq)
+        with self.history_lock:
+            self.history.clear()
+            self.history.extend(frames)
+            self.room_history.clear()
+            self.room_history.extend(room_frames)
+        print(f"Applied snapshot up to {self.applied_seq} with {len(self.history)} messages")
 
     def promote_to_primary(self):
         # take over as the primary server
         print("Promoting to primary server...")
-        self.primary_connected = False
+        log_event("promotion_started")
+        with self.peer_lock:
+            self.primary_connected = False
+            self.promoted = True
+            # a backup that has followed us won't go back to the primary we replaced
+            self.epoch += 1
+        # from here on we're the one that has to keep messages safe
+        self.open_wal()
         if self.primary_socket:
             try:
                 self.primary_socket.close()
             except:
                 pass
             self.primary_socket = None
+        # our log starts over from what we have, a backup that connects gets it as a
+        # snapshot, and the numbering carries on from the primary's so clients can resume
+        with self.history_lock:
+            self.replication_log.restart(self.history.tail() + self.room_history.tail(), self.applied_seq)
+        self.take_messages()
+        # everyone already here hears it from us, everyone still retrying the primary finds us there
+        leader = encode_leader(self.takeover_port or self.port)
+        for client in self.clients.snapshot():
+            client.send(leader)
+        if self.takeover_port:
+            threading.Thread(target=self.take_over_port, daemon=True).start()
+        if self.backup_address is not None:
+            threading.Thread(target=self.connect_to_backup, daemon=True).start()
+        log_event("promotion_done", clients=len(self.clients))
 
-    def handle_client(self, client_socket, address):
-        # handle messages from a single client
-        while self.is_running:
+    def take_over_port(self):
+        # the port only frees up once the old primary's process is really gone
+        failed = False
+        while self.is_running and self.takeover_socket is None:
             try:
-                # get a message from the client
-                message = receive_message(client_socket)
-                if not message:
-                    break
-                    
-                # send the message to all other clients
-                self.broadcast(message, client_socket)
-                
-            except Exception as e:
-                print(f"Error handling client {address}: {e}")
-                break
-                
-        # clean up when the client disconnects
-        if client_socket in self.clients:
-            self.clients.remove(client_socket)
-        client_socket.close()
-        print(f"Client {address} disconnected")
-
-    def broadcast(self, message, sender_socket):
-        # send the message to all clients except the sender
-        disconnected_clients = []
-        for client in self.clients:
-            if client != sender_socket:  # don't send the message back to the sender
-                try:
-                    send_message(client, message)
-                except:
-                    disconnected_clients.append(client)
-        
-        # remove any clients that disconnected while we were sending
-        for client in disconnected_clients:
-            if client in self.clients:
-                self.clients.remove(client)
-                client.close()
+                takeover_socket = self.listen(self.takeover_port)
+            except OSError as e:
+                if not failed:
+                    print(f"Port {self.takeover_port} is still taken, retrying: {e}")
+                    failed = True
+                time.sleep(TAKEOVER_RETRY_INTERVAL)
+                continue
+            self.takeover_socket = takeover_socket
+            print(f"Took over port {self.takeover_port} for clients")
+            log_event("port_taken_over", port=self.takeover_port)
+            self.accept_clients(takeover_socket)
 
     def stop(self):
-        # stop the server and clean up
-        self.is_running = False
-        for client in self.clients:
-            try:
-                client.close()
-            except:
-                pass
+        if self.takeover_socket:
+            self.takeover_socket.close()
         if self.primary_socket:
             try:
                 self.primary_socket.close()
             except:
                 pass
+        super().stop()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="backup chat server")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="threaded runs one thread per client, asyncio runs every client on one event loop")
+    parser.add_argument("--queue-frames", type=int, default=DEFAULT_MAX_FRAMES,
+                        help="most frames queued for one client")
+    parser.add_argument("--queue-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                        help="most bytes queued for one client")
+    parser.add_argument("--slow-consumer-policy", choices=POLICIES, default=POLICY_DROP_OLDEST,
+                        help="what to do when a client's queue is full")
+    parser.add_argument("--flush-delay", type=float, default=DEFAULT_FLUSH_DELAY,
+                        help="seconds a writer waits to batch more frames into one send")
+    parser.add_argument("--flush-bytes", type=int, default=DEFAULT_FLUSH_BYTES,
+                        help="send a batch as soon as this many bytes are waiting")
+    parser.add_argument("--wal-dir", default=None,
+                        help="once promoted, keep every message in a write-ahead log in this directory")
+    parser.add_argument("--durability", choices=DURABILITIES, default=DURABILITY_INTERVAL,
+                        help="none never fsyncs, interval fsyncs every --sync-interval, batch fsyncs every batch")
+    parser.add_argument("--commit-interval", type=float, default=DEFAULT_COMMIT_INTERVAL,
+                        help="seconds the log waits to group more messages into one write")
+    parser.add_argument("--sync-interval", type=float, default=DEFAULT_SYNC_INTERVAL,
+                        help="seconds between fsyncs with interval durability")
+    parser.add_argument("--history-messages", type=int, default=DEFAULT_HISTORY_MESSAGES,
+                        help="most recent messages kept in memory")
+    parser.add_argument("--history-bytes", type=int, default=DEFAULT_HISTORY_BYTES,
+                        help="most bytes of recent messages kept in memory")
+    parser.add_argument("--replay-messages", type=int, default=DEFAULT_REPLAY_MESSAGES,
+                        help="recent messages sent to every client when it connects")
+    parser.add_argument("--port", type=int, default=BACKUP_PORT,
+                        help="port the primary replicates to and clients can reach us on")
+    parser.add_argument("--takeover-port", type=int, default=PRIMARY_PORT,
+                        help="once promoted, take clients on this port too, the primary's, 0 to only use --port")
+    parser.add_argument("--backup-address", type=parse_address, default=None, metavar="HOST:PORT",
+                        help="once promoted, replicate to the backup server listening here")
+    parser.add_argument("--peers", nargs="+", default=list(DEFAULT_PEERS), metavar="HOST",
+                        help="hosts the primary may replicate to us from, by default only this machine")
+    parser.add_argument("--replication-mode", choices=MODES, default=MODE_ASYNC,
+                        help="once promoted, async fans out right away, semi-sync and sync wait for our backup's ack")
+    parser.add_argument("--ack-timeout", type=float, default=DEFAULT_ACK_TIMEOUT,
+                        help="seconds semi-sync waits for an ack before fanning out anyway")
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL,
+                        help="seconds the primary's link may go quiet before it sends a heartbeat, "
+                             "set the same on both servers, and ours once promoted")
+    parser.add_argument("--phi-threshold", type=float, default=DEFAULT_PHI_THRESHOLD,
+                        help="how suspicious the failure detector gets before we take over, "
+                             "higher waits longer and fails over wrongly less often")
+    parser.add_argument("--acceptable-pause", type=float, default=DEFAULT_ACCEPTABLE_PAUSE,
+                        help="seconds of silence on top of the primary's usual that we always put up with")
+    parser.add_argument("--node-id", default=None,
+                        help="who we say we are to the primary and our own backup, by default our host name and port")
+    parser.add_argument("--stats-port", type=int, default=None,
+                        help="serve metrics for scraping on this port")
+    parser.add_argument("--profile", action="store_true",
+                        help="start with profiling on, SIGUSR1 or a 'profile on' control frame switches it later")
+    parser.add_argument("--profile-dir", default=DEFAULT_PROFILE_DIR,
+                        help="where profile dumps are written")
+    parser.add_argument("--profile-interval", type=float, default=DEFAULT_DUMP_INTERVAL,
+                        help="seconds between profile dumps while profiling")
+    parser.add_argument("--profile-top", type=int, default=DEFAULT_TOP_BROADCASTS,
+                        help="how many of the slowest broadcasts to keep")
+    args = parser.parse_args()
+
+    profiler.configure(args.profile_dir, args.profile_interval, args.profile_top)
+    install_signal_handler()
+    if args.profile:
+        profiler.start()
+
     # create and start the server
-    server = BackupServer()
+    queue_options = dict(queue_frames=args.queue_frames, queue_bytes=args.queue_bytes,
+                         slow_consumer_policy=args.slow_consumer_policy,
+                         flush_delay=args.flush_delay, flush_bytes=args.flush_bytes,
+                         history_messages=args.history_messages, history_bytes=args.history_bytes,
+                         replay_messages=args.replay_messages, stats_port=args.stats_port)
+    wal_options = dict(wal_dir=args.wal_dir, durability=args.durability,
+                       commit_interval=args.commit_interval, sync_interval=args.sync_interval)
+    takeover_options = dict(port=args.port, takeover_port=args.takeover_port or None,
+                            backup_address=args.backup_address, replication_mode=args.replication_mode,
+                            ack_timeout=args.ack_timeout, node_id=args.node_id, peers=args.peers)
+    detector_options = dict(heartbeat_interval=args.heartbeat_interval, phi_threshold=args.phi_threshold,
+                            acceptable_pause=args.acceptable_pause)
+    if args.engine == "asyncio":
+        from async_server import AsyncBackupServer
+        server = AsyncBackupServer(**queue_options, **wal_options, **takeover_options, **detector_options)
+    else:
+        server = BackupServer(**queue_options, **wal_options, **takeover_options, **detector_options)
     try:
         server.start()
     except KeyboardInterrupt:
@@ -0,0 +1,77 @@
+"""
+benchmark for write coalescing on a bursty connection.
+
+pushes bursts of chat frames through a ClientConnection whose other end
+is read as fast as possible, then reports how many send syscalls the
+writer needed per delivered frame for a few flush delays. the old
+writer did one sendall per frame, so that's the 1.0 baseline.
+
+usage: python benchmarks/bench_coalesce.py [--bursts 50] [--burst-size 200]
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import encode_message
+from connection import ClientConnection
+
+
+def drain(sock, expected):
+    # read until we've seen every byte the writer should send
+    received = 0
+    while received < expected:
+        data = sock.recv(1 << 20)
+        if not data:
+            break
+        received += len(data)
+
+
+def run(flush_delay, bursts, burst_size, gap):
+    """
+    send bursts through one connection.
+
+    Returns:
+        (send calls, frames sent, seconds taken)
+    """
+    server_sock, client_sock = socket.socketpair()
+    connection = ClientConnection(server_sock, "bench", max_frames=burst_size * bursts,
+                                  max_bytes=1 << 30, flush_delay=flush_delay)
+    frame = encode_message("bob: " + "y" * 80)
+    reader = threading.Thread(target=drain, args=(client_sock, len(frame) * bursts * burst_size))
+    reader.start()
+    connection.start()
+    start = time.perf_counter()
+    for _ in range(bursts):
+        for _ in range(burst_size):
+            connection.send(frame)
+        time.sleep(gap)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    calls, frames = connection.send_calls, connection.frames_sent
+    connection.close()
+    client_sock.close()
+    return calls, frames, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="send syscalls per frame with write coalescing")
+    parser.add_argument("--bursts", type=int, default=50)
+    parser.add_argument("--burst-size", type=int, default=200)
+    parser.add_argument("--gap", type=float, default=0.01, help="seconds between bursts")
+    parser.add_argument("--delays", type=float, nargs="+", default=[0.0, 0.001, 0.002, 0.005])
+    args = parser.parse_args()
+
+    print(f"{args.bursts} bursts of {args.burst_size} frames, per-frame sendall baseline is 1.000")
+    print(f"{'flush delay':>12} {'send calls':>11} {'frames':>8} {'calls/frame':>12}")
+    for delay in args.delays:
+        calls, frames, _ = run(delay, args.bursts, args.burst_size, args.gap)
+        print(f"{delay:>12.3f} {calls:>11} {frames:>8} {calls / max(frames, 1):>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+"""
+failover benchmark: how long chat is down when the primary dies under load.
+
+every run starts backup_server.py and primary_server.py, connects simulated
+clients to the primary and has some of them send numbered messages at a
+fixed rate, traced the way client.py sends them so each is resent after a
+reconnect or a leader frame until its receipt comes back. after a warm-up the primary is killed with SIGKILL. clients
+reconnect as soon as they notice, trying the backup's port and the
+primary's port in turn since the promoted backup takes that over, and
+keep sending. with --reconnect fixed they retry every --reconnect-delay
+seconds, with --reconnect backoff they wait a decorrelated jittered
+backoff starting from it and race both ports (see reconnect.py). the
+backup prints timestamped event lines (see log_event in
+common.py) for losing the primary, the heartbeat timeout and promotion, so
+each run breaks the outage down into:
+
+- backup_noticed: kill until the backup saw the primary's connection drop
+- detected: kill until the backup's failure detector gave up on the primary
+- promotion: how long promote_to_primary took
+- port_taken_over: kill until the promoted backup was listening on the primary's port
+- clients_reconnected: kill until the clients were connected to the backup
+- clients_delivering: kill until the clients got a message sent after the kill,
+  the max is when every client is chatting again
+
+and counts deliveries that never happened and ones that happened twice, a
+message sent again under a new number, not one a replay or resume repeated.
+each run also has a reconnect_curve, how many clients got back in during
+each 25ms after the kill, to show whether they came back in a burst.
+runs are repeated with fresh servers and the medians reported, as json.
+
+usage: python benchmarks/bench_failover.py [--runs 3] [--clients 20] [--senders 5] [--rate 100]
+                                           [--warmup 2] [--after 8] [--engine threaded] [--reconnect fixed]
+                                           [--server-args "--replication-mode semi-sync"] [--output result.json]
+"""
+import argparse
+import json
+import os
+import re
+import shlex
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import (
+    PRIMARY_PORT, BACKUP_PORT, FRAME_TRACED, FRAME_RECEIPT, FRAME_LEADER, get_reader, send_encoded
+)
+from delivery import ClientSession
+from handshake import ROLE_CLIENT, encode_hello
+from reconnect import Backoff, race_connect
+from tracing import encode_traced, decode_traced
+from bench_load import start_server, percentile, git_commit
+
+# every benchmark message is this, the sender, its number and when it was sent
+MARKER = b"failover "
+# the width of a reconnect_curve bucket
+CURVE_BUCKET = 0.025  # seconds
+# a log_event line, found anywhere in a line since another thread's print can end up in front of it
+EVENT_PATTERN = re.compile(r"event (\d+\.\d+) (\w+)")
+# what the backup has to log for a run's breakdown to mean anything
+REQUIRED_EVENTS = ("primary_lost", "heartbeat_timeout", "promotion_started", "promotion_done", "port_taken_over")
+
+
+class FailoverClient:
+    """
+    a simulated client that moves to the backup when it loses the primary.
+
+    the receive thread owns the connection and does the reconnecting, the
+    send thread keeps what it sends in a ClientSession, the way client.py
+    does, and everything without a receipt goes again after a reconnect or
+    a leader frame.
+    """
+
+    def __init__(self, index: int, reconnect_delay: float, reconnect: str = "fixed"):
+        self.index = index
+        self.reconnect_delay = reconnect_delay
+        self.reconnect = reconnect
+        self.sock = self.connect(PRIMARY_PORT)
+        self.send_lock = threading.Lock()
+        self.session = ClientSession()
+        self.running = True
+        # when we noticed the primary was gone and when we were on the backup again
+        self.disconnected_at = None
+        self.reconnected_at = None
+        # (sender, number, send time, receive time) for every message we got
+        self.received = []
+        # numbers and send times of the messages we sent, the session resends them until they're confirmed
+        self.sent = {}
+        # the number each message reached us with, and how often one came again under another number
+        self.seqs = {}
+        self.repeated = 0
+
+    def connect(self, port):
+        sock = socket.create_connection(('127.0.0.1', port))
+        self.greet(sock)
+        return sock
+
+    def greet(self, sock):
+        # say we're a client, or the server waits to find out before sending us anything
+        send_encoded(sock, encode_hello(ROLE_CLIENT, 0, f"bench-{self.index}"))
+        sock.settimeout(0.5)
+
+    def receive(self, stop_at):
+        while self.running and time.time() < stop_at:
+            # straight from the reader, errors are expected here and receive_frame would print them
+            try:
+                frame = get_reader(self.sock).read_frame()
+            except socket.timeout:
+                continue
+            except OSError:
+                frame = None
+            if frame is None:
+                self.fail_over(stop_at)
+                continue
+            now = time.time()
+            frame_type, payload = frame
+            if frame_type == FRAME_RECEIPT:
+                self.session.receipt(payload)
+            elif frame_type == FRAME_LEADER:
+                # a backup that has taken over, what it turned away before that goes again
+                self.send_frames(self.session.unacked_frames())
+            elif frame_type == FRAME_TRACED:
+                trace, text = decode_traced(payload)
+                if not text.startswith(MARKER):
+                    continue
+                if not self.session.delivered(trace):
+                    # the replay and a resume repeat what we have, only a new number means it was sent twice
+                    if self.seqs.get(trace.trace_id, trace.seq) != trace.seq:
+                        self.repeated += 1
+                    continue
+                self.seqs[trace.trace_id] = trace.seq
+                sender, number, sent_at = text[len(MARKER):].split(b" ", 3)[:3]
+                self.received.append((int(sender), int(number), float(sent_at), now))
+
+    def fail_over(self, stop_at):
+        # a second failure means the backup went too, there's nowhere left to go
+        if self.disconnected_at is not None:
+            self.running = False
+            return
+        self.disconnected_at = time.time()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        # the backup is reachable on its own port first and on the primary's once it takes it over
+        ports = (BACKUP_PORT, PRIMARY_PORT)
+        if self.reconnect == "backoff":
+            self.back_off(ports, stop_at)
+            return
+        attempt = 0
+        while self.running and time.time() < stop_at:
+            try:
+                self.use(self.connect(ports[attempt % len(ports)]))
+                return
+            except OSError:
+                attempt += 1
+                time.sleep(self.reconnect_delay)
+
+    def back_off(self, ports, stop_at):
+        # the way client.py reconnects, a jittered wait and then whichever port answers first
+        backoff = Backoff(base=self.reconnect_delay)
+        addresses = [('127.0.0.1', port) for port in ports]
+        while self.running and time.time() < stop_at:
+            time.sleep(backoff.next())
+            try:
+                sock, _ = race_connect(addresses)
+                self.greet(sock)
+            except OSError:
+                continue
+            self.use(sock)
+            return
+
+    def use(self, sock):
+        # ask for what we missed and resend what has no receipt before the sender can use the new connection
+        with self.send_lock:
+            try:
+                for frame in self.session.reconnect_frames():
+                    sock.sendall(frame)
+            except OSError:
+                pass
+            self.sock = sock
+        self.reconnected_at = time.time()
+
+    def send_frames(self, frames):
+        with self.send_lock:
+            try:
+                for frame in frames:
+                    self.sock.sendall(frame)
+            except OSError:
+                pass
+
+    def send(self, count, interval, size):
+        start = time.perf_counter()
+        for number in range(count):
+            delay = start + number * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            sent_at = time.time()
+            text = MARKER + f"{self.index} {number} {sent_at:.6f} ".encode()
+            frame = self.session.sending(encode_traced((text + b"x" * max(size - len(text), 0)).decode()))
+            self.sent[number] = sent_at
+            self.send_frames([frame])
+
+
+def parse_events(lines):
+    """
+    the first time of every "event <time> <name> ..." line in a server's output.
+
+    Raises:
+        RuntimeError: if one of the required events isn't there, the breakdown would be missing it
+    """
+    events = {}
+    for line in lines:
+        for match in EVENT_PATTERN.finditer(line):
+            events.setdefault(match.group(2), float(match.group(1)))
+    missing = [event for event in REQUIRED_EVENTS if event not in events]
+    if missing:
+        raise RuntimeError(f"the backup never logged {', '.join(missing)}:\n{''.join(lines)}")
+    return events
+
+
+def since(moment, start):
+    return round(moment - start, 3) if moment is not None else None
+
+
+def spread(values):
+    # p50 and max of the values we have, and how many clients never got there
+    present = sorted(value for value in values if value is not None)
+    return {
+        "p50": percentile(present, 0.5),
+        "max": present[-1] if present else None,
+        "missing": len(values) - len(present),
+    }
+
+
+def curve(values):
+    # how many of the values fall in each CURVE_BUCKET from 0 up to the last one
+    present = [value for value in values if value is not None]
+    counts = [0] * (int(max(present) / CURVE_BUCKET) + 1 if present else 0)
+    for value in present:
+        counts[int(value / CURVE_BUCKET)] += 1
+    return counts
+
+
+def run_once(args):
+    """
+    one failover under load.
+
+    Returns:
+        a dict with the time breakdown and the message counts
+    """
+    backup_output = []
+    backup = start_server("backup_server.py", ["--engine", args.engine], "listening", output=backup_output)
+    primary = None
+    clients = []
+    try:
+        primary = start_server("primary_server.py", ["--engine", args.engine] + shlex.split(args.server_args),
+                               "Backup caught up")
+        clients = [FailoverClient(index, args.reconnect_delay, args.reconnect) for index in range(args.clients)]
+        total = args.warmup + args.after
+        stop_at = time.time() + total + args.drain
+        per_sender = args.rate / args.senders
+        threads = [threading.Thread(target=client.receive, args=(stop_at,)) for client in clients]
+        threads += [threading.Thread(target=client.send, args=(int(per_sender * total), 1 / per_sender, args.size))
+                    for client in clients[:args.senders]]
+        for thread in threads:
+            thread.start()
+
+        time.sleep(args.warmup)
+        killed_at = time.time()
+        primary.kill()
+        for thread in threads:
+            thread.join()
+        # give the backup's output a moment to catch up with us
+        time.sleep(0.1)
+    finally:
+        for client in clients:
+            client.running = False
+            client.sock.close()
+        for process in (primary, backup):
+            if process is not None:
+                process.kill()
+                process.wait()
+
+    events = parse_events(backup_output)
+    lost = duplicated = 0
+    delivered_somewhere = set()
+    for client in clients:
+        got = [(sender, number) for sender, number, _, _ in client.received]
+        unique = set(got)
+        delivered_somewhere |= unique
+        duplicated += len(got) - len(unique) + client.repeated
+        expected = {(other.index, number) for other in clients[:args.senders] if other is not client
+                    for number in other.sent}
+        lost += len(expected - unique)
+    sent = {(client.index, number) for client in clients[:args.senders] for number in client.sent}
+    reconnected = [since(client.reconnected_at, killed_at) for client in clients]
+    return {
+        "breakdown": {
+            "backup_noticed": since(events["primary_lost"], killed_at),
+            "detected": since(events["heartbeat_timeout"], killed_at),
+            "promotion": round(events["promotion_done"] - events["promotion_started"], 3),
+            "promoted": since(events["promotion_done"], killed_at),
+            "port_taken_over": since(events["port_taken_over"], killed_at),
+            "clients_noticed": spread([since(client.disconnected_at, killed_at) for client in clients]),
+            "clients_reconnected": spread(reconnected),
+            "clients_delivering": spread([
+                since(min((received for _, _, sent_at, received in client.received if sent_at > killed_at),
+                          default=None), killed_at)
+                for client in clients
+            ]),
+        },
+        "sent": len(sent),
+        "lost_deliveries": lost,
+        "duplicate_deliveries": duplicated,
+        "lost_everywhere": len(sent - delivered_somewhere),
+        "reconnect_curve": curve(reconnected),
+    }
+
+
+def median_of(runs, path):
+    # median of one breakdown value across runs, skipping runs that never got there
+    values = []
+    for run in runs:
+        value = run
+        for key in path:
+            value = value[key] if value is not None else None
+        if value is not None:
+            values.append(value)
+    return round(statistics.median(values), 3) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="time how long a primary failure takes to recover from")
+    parser.add_argument("--runs", type=int, default=3, help="failovers to run, each with fresh servers")
+    parser.add_argument("--clients", type=int, default=20, help="connected clients")
+    parser.add_argument("--senders", type=int, default=5, help="how many of the clients send")
+    parser.add_argument("--rate", type=float, default=100, help="messages per second across all senders")
+    parser.add_argument("--size", type=int, default=100, help="message size in bytes")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of load before the primary is killed")
+    parser.add_argument("--after", type=float, default=8, help="seconds of load after the primary is killed")
+    parser.add_argument("--drain", type=float, default=1, help="seconds to keep receiving after sending stops")
+    parser.add_argument("--reconnect-delay", type=float, default=0.05,
+                        help="seconds between a client's attempts to reach the backup, the first wait with backoff")
+    parser.add_argument("--reconnect", choices=["fixed", "backoff"], default="fixed",
+                        help="retry at a fixed delay, or race both ports after a jittered exponential backoff")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--server-args", default="", help="extra arguments for primary_server.py")
+    parser.add_argument("--output", default=None, help="write the json here as well as to stdout")
+    args = parser.parse_args()
+    args.senders = max(min(args.senders, args.clients), 1)
+
+    runs = []
+    for run in range(args.runs):
+        runs.append(run_once(args))
+        print(f"run {run + 1}/{args.runs}: {json.dumps(runs[-1]['breakdown'])}", file=sys.stderr)
+
+    summary = {}
+    for key, value in runs[0]["breakdown"].items():
+        if isinstance(value, dict):
+            summary[key] = {part: median_of(runs, ("breakdown", key, part)) for part in value}
+        else:
+            summary[key] = median_of(runs, ("breakdown", key))
+    for key in ("lost_deliveries", "duplicate_deliveries", "lost_everywhere"):
+        summary[key] = median_of(runs, (key,))
+    result = {
+        "commit": git_commit(),
+        "config": vars(args),
+        "median": summary,
+        "runs": runs,
+    }
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+microbenchmark for the broadcast fan-out path.
+
+measures how many bytes get allocated per broadcast as the room grows,
+comparing encoding the message for every recipient against encoding it
+once and sharing the frame. no sockets are involved, recipients are
+plain outbound queues so only the fan-out itself is measured.
+
+usage: python benchmarks/bench_fanout.py [--sizes 1 10 100 1000] [--rounds 200]
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import encode_message
+from connection import OutboundQueue
+
+MESSAGE = "alice: " + "x" * 120
+
+
+def per_recipient(queues, message):
+    # the old way, one encode and one frame per recipient
+    for queue in queues:
+        queue.put(encode_message(message))
+
+
+def encode_once(queues, message):
+    # the new way, one frame shared by every recipient
+    frame = encode_message(message)
+    for queue in queues:
+        queue.put(frame)
+
+
+def measure(fanout, size, rounds):
+    """
+    run a fan-out function a number of times and see what it allocated.
+
+    Returns:
+        the average number of bytes allocated per broadcast
+    """
+    # big enough that nothing gets dropped during the run
+    queues = [OutboundQueue(max_frames=rounds + 1, max_bytes=1 << 30) for _ in range(size)]
+    # warm up so the deques have grown before we start counting
+    fanout(queues, MESSAGE)
+    for queue in queues:
+        queue.drain()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(rounds):
+        fanout(queues, MESSAGE)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bytes allocated per broadcast by room size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"message is {len(MESSAGE)} chars, {args.rounds} broadcasts per size")
+    print(f"{'room size':>10} {'per-recipient B':>16} {'encode-once B':>14} {'ratio':>7}")
+    for size in args.sizes:
+        old = measure(per_recipient, size, args.rounds)
+        new = measure(encode_once, size, args.rounds)
+        print(f"{size:>10} {old:>16.0f} {new:>14.0f} {old / max(new, 1):>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,366 @@
+"""
+load generator and latency benchmark for the real chat servers.
+
+starts backup_server.py and primary_server.py as subprocesses, connects
+simulated clients to the primary and has some of them send messages at a
+fixed total rate. every message carries its send time, so each delivery
+gives one end-to-end broadcast latency sample. reports messages and
+deliveries per second, latency percentiles and the servers' cpu time and
+memory as json, so runs can be compared between versions.
+
+clients run as threads, on one asyncio loop, or as several processes each
+running an asyncio loop (--client-mode process). with --trace the messages
+are sent traced, and the servers' timestamps split each latency into
+network, queueing, replication and fan out time.
+
+usage: python benchmarks/bench_load.py [--clients 100] [--senders 10] [--rate 1000] [--size 100]
+                                       [--duration 10] [--client-mode asyncio] [--engine threaded]
+                                       [--server-args "--flush-delay 0.001"] [--trace] [--output result.json]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from common import PRIMARY_PORT, FRAME_CHAT, FRAME_TRACED, FrameDecoder, encode_message, send_encoded, receive_frame
+from handshake import ROLE_CLIENT, encode_hello
+from tracing import encode_traced, decode_traced, hops
+
+# every benchmark message starts with this and its send time
+MARKER = b"bench "
+
+
+def make_message(size, trace=False):
+    # the send time goes in when the message is sent, the rest is padding up to size
+    encode = encode_traced if trace else encode_message
+
+    def build():
+        text = MARKER + f"{time.time():.6f} ".encode()
+        return encode((text + b"x" * max(size - len(text), 0)).decode())
+    return build
+
+
+def latency_of(payload, now):
+    # seconds since a benchmark message was sent, None for anything else
+    if not payload.startswith(MARKER):
+        return None
+    return now - float(payload[len(MARKER):].split(b" ", 1)[0])
+
+
+def sample_of(frame_type, payload, now):
+    # seconds per hop of a benchmark message, only the total for untraced ones
+    if frame_type == FRAME_TRACED:
+        trace, text = decode_traced(payload)
+        return hops(trace, now) if text.startswith(MARKER) else None
+    if frame_type == FRAME_CHAT:
+        latency = latency_of(payload, now)
+        return {"total": latency} if latency is not None else None
+    return None
+
+
+def schedule(senders, rate, duration):
+    # how many messages each sender sends and how far apart
+    per_sender = rate / max(senders, 1)
+    return int(per_sender * duration), 1.0 / per_sender if per_sender else 0
+
+
+async def run_async_clients(port, clients, senders, rate, size, duration, drain, trace=False):
+    """
+    run clients on one event loop.
+
+    Returns:
+        (messages sent, list of samples of seconds per hop)
+    """
+    latencies = []
+    build = make_message(size, trace)
+    connections = []
+    for index in range(clients):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        # say we're a client, or the server waits to find out before sending us anything
+        writer.write(encode_hello(ROLE_CLIENT, 0, f"bench-{index}"))
+        connections.append((reader, writer))
+    count, interval = schedule(senders, rate, duration)
+    stop_at = time.time() + duration + drain
+
+    async def receive(reader):
+        decoder = FrameDecoder()
+        while time.time() < stop_at:
+            try:
+                data = await asyncio.wait_for(reader.read(65536), stop_at - time.time())
+            except asyncio.TimeoutError:
+                break
+            if not data:
+                break
+            now = time.time()
+            for frame_type, payload in decoder.feed(data):
+                sample = sample_of(frame_type, payload, now)
+                if sample is not None:
+                    latencies.append(sample)
+
+    async def send(writer):
+        start = time.perf_counter()
+        for i in range(count):
+            # pace against the start time so a slow send doesn't lower the rate
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            writer.write(build())
+            await writer.drain()
+        return count
+
+    receivers = [asyncio.ensure_future(receive(reader)) for reader, _ in connections]
+    sent = await asyncio.gather(*(send(writer) for _, writer in connections[:senders]))
+    await asyncio.gather(*receivers)
+    for _, writer in connections:
+        writer.close()
+    return sum(sent), latencies
+
+
+def run_asyncio_clients(port, clients, senders, rate, size, duration, drain, trace=False):
+    return asyncio.run(run_async_clients(port, clients, senders, rate, size, duration, drain, trace))
+
+
+def run_threaded_clients(port, clients, senders, rate, size, duration, drain, trace=False):
+    """
+    run every client on its own threads, the way client.py does.
+
+    Returns:
+        (messages sent, list of samples of seconds per hop)
+    """
+    latencies = []
+    lock = threading.Lock()
+    build = make_message(size, trace)
+    sockets = [socket.create_connection(('127.0.0.1', port)) for _ in range(clients)]
+    for index, sock in enumerate(sockets):
+        # say we're a client, or the server waits to find out before sending us anything
+        send_encoded(sock, encode_hello(ROLE_CLIENT, 0, f"bench-{index}"))
+    count, interval = schedule(senders, rate, duration)
+    stop_at = time.time() + duration + drain
+
+    def receive(sock):
+        sock.settimeout(0.5)
+        samples = []
+        while time.time() < stop_at:
+            try:
+                frame = receive_frame(sock)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if frame is None:
+                break
+            sample = sample_of(frame[0], frame[1], time.time())
+            if sample is not None:
+                samples.append(sample)
+        with lock:
+            latencies.extend(samples)
+
+    def send(sock):
+        start = time.perf_counter()
+        for i in range(count):
+            delay = start + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            send_encoded(sock, build())
+
+    threads = [threading.Thread(target=receive, args=(sock,)) for sock in sockets]
+    threads += [threading.Thread(target=send, args=(sock,)) for sock in sockets[:senders]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for sock in sockets:
+        sock.close()
+    return count * senders, latencies
+
+
+def process_clients(args):
+    # runs in a client process, one share of the clients on an asyncio loop
+    return run_asyncio_clients(*args)
+
+
+def run_process_clients(port, clients, senders, rate, size, duration, drain, processes, trace=False):
+    """
+    split the clients and senders across processes, each running an asyncio loop.
+
+    Returns:
+        (messages sent, list of samples of seconds per hop)
+    """
+    shares = []
+    for index in range(processes):
+        share_clients = clients // processes + (index < clients % processes)
+        share_senders = senders // processes + (index < senders % processes)
+        share_rate = rate * share_senders / max(senders, 1)
+        shares.append((port, share_clients, share_senders, share_rate, size, duration, drain, trace))
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(process_clients, shares)
+    return sum(sent for sent, _ in results), [sample for _, samples in results for sample in samples]
+
+
+def process_usage(pid):
+    """
+    cpu seconds used so far and current and peak resident memory of a process.
+
+    Returns:
+        a dict, empty where /proc isn't available
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # the command name can have spaces in it, so count fields from the closing paren
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return {}
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {
+        "cpu_seconds": (int(fields[11]) + int(fields[12])) / ticks,
+        "rss_bytes": int(status["VmRSS"].split()[0]) * 1024,
+        "peak_rss_bytes": int(status["VmHWM"].split()[0]) * 1024,
+    }
+
+
+def percentile(samples, fraction):
+    # samples must already be sorted
+    if not samples:
+        return None
+    return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+
+def in_ms(value):
+    return round(value * 1000, 3) if value is not None else None
+
+
+def start_server(script, args, ready_line, timeout=10, output=None):
+    """
+    start a server with unbuffered output and wait until it prints ready_line.
+
+    Args:
+        output: a list to keep collecting the server's output lines in, they're thrown away if not given
+    """
+    process = subprocess.Popen([sys.executable, "-u", os.path.join(ROOT, script)] + args,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    deadline = time.time() + timeout
+    lines = output if output is not None else []
+
+    def drain():
+        # keep reading so the server never blocks on a full pipe
+        for line in process.stdout:
+            if output is not None:
+                output.append(line)
+
+    while time.time() < deadline:
+        line = process.stdout.readline()
+        if not line:
+            break
+        lines.append(line)
+        if ready_line in line:
+            threading.Thread(target=drain, daemon=True).start()
+            return process
+    process.kill()
+    raise RuntimeError(f"{script} didn't become ready:\n{''.join(lines)}")
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load generator and latency benchmark for the chat servers")
+    parser.add_argument("--clients", type=int, default=100, help="connected clients")
+    parser.add_argument("--senders", type=int, default=10, help="how many of the clients send")
+    parser.add_argument("--rate", type=float, default=1000, help="messages per second across all senders")
+    parser.add_argument("--size", type=int, default=100, help="message size in bytes")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send for")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to keep receiving after sending stops")
+    parser.add_argument("--client-mode", choices=["threaded", "asyncio", "process"], default="asyncio")
+    parser.add_argument("--client-processes", type=int, default=os.cpu_count() or 1,
+                        help="client processes for --client-mode process")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--server-args", default="", help="extra arguments for primary_server.py")
+    parser.add_argument("--trace", action="store_true",
+                        help="send traced messages and split the latency up by hop")
+    parser.add_argument("--output", default=None, help="write the json here as well as to stdout")
+    args = parser.parse_args()
+    senders = min(args.senders, args.clients)
+
+    backup = start_server("backup_server.py", ["--engine", args.engine], "listening")
+    primary = None
+    try:
+        # clients can only connect once the primary has its backup, or the threaded
+        # primary would take the first local client for the backup
+        primary = start_server("primary_server.py", ["--engine", args.engine] + shlex.split(args.server_args),
+                               "Backup caught up")
+        before = {name: process_usage(p.pid) for name, p in (("primary", primary), ("backup", backup))}
+        start = time.time()
+        if args.client_mode == "threaded":
+            sent, samples = run_threaded_clients(PRIMARY_PORT, args.clients, senders, args.rate,
+                                                 args.size, args.duration, args.drain, args.trace)
+        elif args.client_mode == "asyncio":
+            sent, samples = run_asyncio_clients(PRIMARY_PORT, args.clients, senders, args.rate,
+                                                args.size, args.duration, args.drain, args.trace)
+        else:
+            sent, samples = run_process_clients(PRIMARY_PORT, args.clients, senders, args.rate, args.size,
+                                                args.duration, args.drain, args.client_processes, args.trace)
+        elapsed = time.time() - start
+        after = {name: process_usage(p.pid) for name, p in (("primary", primary), ("backup", backup))}
+    finally:
+        for process in (primary, backup):
+            if process is not None:
+                process.kill()
+                process.wait()
+
+    latencies = sorted(sample["total"] for sample in samples)
+    servers = {}
+    for name in ("primary", "backup"):
+        usage = after[name]
+        if usage:
+            cpu = usage["cpu_seconds"] - before[name]["cpu_seconds"]
+            usage = dict(usage, cpu_seconds=round(cpu, 3), cpu_percent=round(100 * cpu / elapsed, 1))
+        servers[name] = usage
+    expected = sent * (args.clients - 1)
+    result = {
+        "commit": git_commit(),
+        "config": dict(vars(args), senders=senders),
+        "sent": sent,
+        "delivered": len(latencies),
+        "delivery_ratio": round(len(latencies) / expected, 4) if expected else None,
+        "messages_per_sec": round(sent / args.duration, 1),
+        "deliveries_per_sec": round(len(latencies) / args.duration, 1),
+        "latency_ms": {
+            name: in_ms(value)
+            for name, value in (("p50", percentile(latencies, 0.5)), ("p99", percentile(latencies, 0.99)),
+                                ("p999", percentile(latencies, 0.999)),
+                                ("max", latencies[-1] if latencies else None))
+        },
+        "servers": servers,
+    }
+    if args.trace:
+        # each hop's percentiles on their own, they don't add up to the total's percentiles
+        result["hops_ms"] = {}
+        for hop in ("network", "queueing", "replication", "fan_out"):
+            values = sorted(sample[hop] for sample in samples if hop in sample)
+            result["hops_ms"][hop] = {"p50": in_ms(percentile(values, 0.5)), "p99": in_ms(percentile(values, 0.99))}
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+throughput benchmark for the write-ahead log's durability modes.
+
+a few threads append chat frames the way broadcasting client threads would,
+waiting for their record to be committed when the mode asks for it, and we
+report messages per second, how many messages each group commit batch held
+and how many fsyncs it took. the first row is the naive write plus fsync per
+message that group commit replaces.
+
+usage: python benchmarks/bench_wal.py [--messages 20000] [--threads 8] [--commit-interval 0] [--dir /tmp/wal-bench]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import encode_message
+from wal import WriteAheadLog, DURABILITIES, DURABILITY_BATCH, DEFAULT_COMMIT_INTERVAL
+
+
+def run_naive(directory, messages, frame):
+    # one write and one fsync per message, what you get without group commit
+    fd = os.open(os.path.join(directory, "naive.log"), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    start = time.perf_counter()
+    for _ in range(messages):
+        os.write(fd, frame)
+        os.fsync(fd)
+    elapsed = time.perf_counter() - start
+    os.close(fd)
+    return elapsed, messages, messages
+
+
+def run(directory, durability, messages, threads, frame, commit_interval):
+    """
+    append messages from several threads.
+
+    Returns:
+        (seconds taken, batches written, fsyncs done)
+    """
+    wal = WriteAheadLog(directory, durability=durability, commit_interval=commit_interval)
+    wal.start()
+    per_thread = messages // threads
+
+    def writer():
+        for _ in range(per_thread):
+            seq = wal.append(frame)
+            if durability == DURABILITY_BATCH:
+                wal.wait(seq)
+
+    workers = [threading.Thread(target=writer) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # the last batch only counts once it's committed
+    wal.wait(wal.last_seq)
+    elapsed = time.perf_counter() - start
+    wal.close()
+    return elapsed, wal.batches, wal.syncs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="write-ahead log throughput by durability mode")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8, help="concurrent appenders")
+    parser.add_argument("--size", type=int, default=100, help="message size in bytes")
+    parser.add_argument("--commit-interval", type=float, default=DEFAULT_COMMIT_INTERVAL)
+    parser.add_argument("--dir", default=None,
+                        help="where to write, each run gets a fresh directory in it, defaults to the temp dir")
+    args = parser.parse_args()
+
+    # a fresh directory every time, so a leftover run's logs are neither in the way nor recovered
+    base = tempfile.mkdtemp(prefix="wal-bench-", dir=args.dir)
+    frame = encode_message("x" * args.size)
+    messages = args.messages - args.messages % args.threads
+    print(f"{messages} messages of {args.size} bytes from {args.threads} threads in {base}")
+    print(f"{'mode':>10} {'msgs/sec':>10} {'msgs/batch':>11} {'fsyncs':>8}")
+    try:
+        # the naive baseline gets a tenth of the messages, it's that slow
+        naive_dir = os.path.join(base, "naive")
+        os.makedirs(naive_dir)
+        elapsed, batches, syncs = run_naive(naive_dir, max(messages // 10, 1), frame)
+        print(f"{'naive':>10} {batches / elapsed:>10.0f} {1:>11.1f} {syncs:>8}")
+        for durability in DURABILITIES:
+            directory = os.path.join(base, durability)
+            elapsed, batches, syncs = run(directory, durability, messages, args.threads,
+                                          frame, args.commit_interval)
+            print(f"{durability:>10} {messages / elapsed:>10.0f} "
+                  f"{messages / max(batches, 1):>11.1f} {syncs:>8}")
+    finally:
+        if args.dir is None:
+            shutil.rmtree(base, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
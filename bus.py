@@ -0,0 +1,334 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+from collections import deque
+from common import FRAME_HEADER, FRAME_BUS, FRAME_CLAIM, encode_frame, receive_frame, send_vectored
+
+# every bus frame is the id of the worker it came from and the number the hub gave it,
+# followed by the frame being broadcast. one with no frame is a worker joining
+BUS_HEADER = struct.Struct('!HQ')
+# what a FRAME_CLAIM frame does and what it's for
+CLAIM = 1
+RELEASE = 2
+CLAIM_USER = 1    # a username to log in as
+CLAIM_MEMBER = 2  # a member id to join rooms as
+# a FRAME_CLAIM payload is the op, the kind, the worker and its token for the connection, then the name
+CLAIM_HEADER = struct.Struct('!BBHQ')
+# how long a client waits for the hub to hand its claim back before it's turned down
+CLAIM_TIMEOUT = 5.0  # seconds
+
+
+def complete_frames(buffer) -> int:
+    """how many bytes at the start of buffer are whole frames."""
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(buffer):
+        length, _ = FRAME_HEADER.unpack_from(buffer, offset)
+        if offset + FRAME_HEADER.size + length > len(buffer):
+            break
+        offset += FRAME_HEADER.size + length
+    return offset
+
+
+def encode_claim(op: int, kind: int, name: str, worker_id: int, token: int) -> bytes:
+    return encode_frame(FRAME_CLAIM, CLAIM_HEADER.pack(op, kind, worker_id, token) + name.encode('utf-8'))
+
+
+def decode_claim(payload: bytes):
+    """
+    split a FRAME_CLAIM payload up.
+
+    Returns:
+        an (op, kind, name, worker id, token) tuple
+    """
+    op, kind, worker_id, token = CLAIM_HEADER.unpack_from(payload)
+    return op, kind, bytes(payload[CLAIM_HEADER.size:]).decode('utf-8'), worker_id, token
+
+
+def is_claim_frame(frame) -> bool:
+    return len(frame) >= FRAME_HEADER.size and frame[FRAME_HEADER.size - 1] == FRAME_CLAIM
+
+
+class ClaimTable:
+    """
+    who holds every username and member id, across all the workers.
+
+    each worker's UserIndex and RoomIndex only see their own connections, so
+    two workers would both hand out the same name. claims and releases go
+    round the hub instead, every worker applies them in the hub's order and
+    they all agree on who got a name first. a holder is a worker id and that
+    worker's token for one of its connections.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.holders = {}
+
+    def apply(self, op: int, kind: int, name: str, worker_id: int, token: int) -> bool:
+        """
+        apply a claim or release in the hub's order.
+
+        Returns:
+            whether a claim was won, the holder claiming again wins too
+        """
+        holder = (worker_id, token)
+        with self.lock:
+            current = self.holders.get((kind, name))
+            if op == CLAIM:
+                if current is not None and current != holder:
+                    return False
+                self.holders[(kind, name)] = holder
+            elif current == holder:
+                del self.holders[(kind, name)]
+        return True
+
+    def apply_frame(self, frame) -> bool:
+        """apply an encoded FRAME_CLAIM frame."""
+        return self.apply(*decode_claim(memoryview(frame)[FRAME_HEADER.size:]))
+
+    def holds(self, kind: int, name: str, worker_id: int, token: int) -> bool:
+        return self.holders.get((kind, name)) == (worker_id, token)
+
+    def held_by(self, worker_id: int, token: int) -> list:
+        """the (kind, name) of everything one connection holds, to release when it closes."""
+        with self.lock:
+            return [key for key, holder in self.holders.items() if holder == (worker_id, token)]
+
+
+class PendingClaim:
+    """a claim a client's thread waits on, the worker's bus reader settles it when the hub hands it back."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.won = False
+
+    def settle(self, won: bool) -> None:
+        self.won = won
+        self.event.set()
+
+    def wait(self, timeout: float = CLAIM_TIMEOUT) -> bool:
+        """whether the claim was won, false if the hub never handed it back."""
+        return self.event.wait(timeout) and self.won
+
+
+class HubProtocol(asyncio.Protocol):
+    """the hub's end of one worker's unix socket."""
+
+    def __init__(self, hub):
+        self.hub = hub
+        self.transport = None
+        # bytes of a frame that hasn't fully arrived yet
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.hub.worker_joined(self)
+
+    def data_received(self, data):
+        # pass on every whole frame as it arrived, without decoding it
+        self.buffer += data
+        end = complete_frames(self.buffer)
+        if end:
+            chunk = bytes(self.buffer[:end])
+            del self.buffer[:end]
+            self.hub.forward(chunk)
+
+    def connection_lost(self, exc):
+        self.hub.worker_left(self)
+
+    def pause_writing(self):
+        self.hub.writer_paused(self)
+
+    def resume_writing(self):
+        self.hub.writer_resumed(self)
+
+
+class FanoutHub:
+    """
+    puts every worker's broadcasts into one order and sends them to every worker.
+
+    a worker never fans out a message itself, it publishes it here and fans it
+    out when it comes back, so every worker (and through worker 0, the backup)
+    sees the same messages in the same order. the hub numbers them in that
+    order and every worker uses its numbers, one that joins late included. a
+    worker that can't keep up stops the hub reading from everyone until it
+    has caught up.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # every connected worker and the ones whose socket buffer is full
+        self.workers = []
+        self.slow = set()
+        # the number of the last frame we forwarded
+        self.seq = 0
+
+    def run(self, ready: threading.Event = None) -> None:
+        """listen on the unix socket and forward frames until the process ends."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server = loop.run_until_complete(loop.create_unix_server(lambda: HubProtocol(self), self.path))
+        if ready is not None:
+            ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.close()
+
+    def forward(self, chunk: bytes) -> None:
+        # number every frame in the chunk, then every worker gets the same bytes, the one that sent them included
+        chunk = bytearray(chunk)
+        offset = 0
+        while offset < len(chunk):
+            length, _ = FRAME_HEADER.unpack_from(chunk, offset)
+            end = offset + FRAME_HEADER.size + length
+            worker_id, seq = BUS_HEADER.unpack_from(chunk, offset + FRAME_HEADER.size)
+            if length == BUS_HEADER.size:
+                # a worker joining with the last number in its log, ours carry on after it
+                self.seq = max(self.seq, seq)
+                del chunk[offset:end]
+                continue
+            self.seq += 1
+            BUS_HEADER.pack_into(chunk, offset + FRAME_HEADER.size, worker_id, self.seq)
+            offset = end
+        if not chunk:
+            return
+        chunk = bytes(chunk)
+        for worker in self.workers:
+            worker.transport.write(chunk)
+
+    def worker_joined(self, worker) -> None:
+        self.workers.append(worker)
+        if self.slow:
+            worker.transport.pause_reading()
+
+    def worker_left(self, worker) -> None:
+        if worker in self.workers:
+            self.workers.remove(worker)
+        self.writer_resumed(worker)
+
+    def writer_paused(self, worker) -> None:
+        if not self.slow:
+            for other in self.workers:
+                other.transport.pause_reading()
+        self.slow.add(worker)
+
+    def writer_resumed(self, worker) -> None:
+        if worker not in self.slow:
+            return
+        self.slow.discard(worker)
+        if not self.slow:
+            for other in self.workers:
+                other.transport.resume_reading()
+
+
+class BusLink:
+    """
+    a worker's connection to the hub.
+
+    the hub hands each worker's frames back in the order it sent them, so
+    the local senders of what we published just wait in a queue for their
+    frame to come round again.
+    """
+
+    def __init__(self, path: str, worker_id: int, seq: int = 0):
+        """
+        Args:
+            path: the hub's unix socket
+            worker_id: our id, the hub passes it on with everything we publish
+            seq: the last number in our log, the hub's numbering carries on after it
+        """
+        self.worker_id = worker_id
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        # senders of the frames we've published that haven't come back yet
+        self.senders = deque()
+        # keeps frames from different client threads from interleaving on the socket
+        self.lock = threading.Lock()
+        self.header = BUS_HEADER.pack(worker_id, 0)
+        # the hub's number for the frame receive returned last
+        self.seq = 0
+        send_vectored(self.sock, [FRAME_HEADER.pack(BUS_HEADER.size, FRAME_BUS), BUS_HEADER.pack(worker_id, seq)])
+
+    def publish(self, frame: bytes, sender) -> None:
+        """send a frame to the hub for every worker to fan out."""
+        header = FRAME_HEADER.pack(BUS_HEADER.size + len(frame), FRAME_BUS) + self.header
+        with self.lock:
+            self.senders.append(sender)
+            send_vectored(self.sock, [header, frame])
+
+    def receive(self):
+        """
+        wait for the next frame in the hub's order.
+
+        Returns:
+            a (frame, sender) tuple where sender is only set for frames we published,
+            or None once the hub is gone. seq is the hub's number for the frame
+        """
+        frame = receive_frame(self.sock)
+        if frame is None:
+            return None
+        _, payload = frame
+        worker_id, self.seq = BUS_HEADER.unpack_from(payload)
+        sender = self.senders.popleft() if worker_id == self.worker_id else None
+        return payload[BUS_HEADER.size:], sender
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def run_worker(worker_id: int, bus_path: str, options: dict) -> None:
+    # runs in the worker process
+    from primary_server import PrimaryServer
+    if options.get('stats_port') is not None:
+        # every worker keeps its own metrics, so each needs a port of its own
+        options = dict(options, stats_port=options['stats_port'] + worker_id)
+    server = PrimaryServer(bus_path=bus_path, worker_id=worker_id, **options)
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+def run_workers(count: int, options: dict) -> None:
+    """
+    run count primary worker processes that share the port and the hub.
+
+    Args:
+        count: how many worker processes to start
+        options: keyword arguments for every worker's PrimaryServer
+    """
+    directory = tempfile.mkdtemp(prefix="chat-bus-")
+    path = os.path.join(directory, "hub.sock")
+    hub = FanoutHub(path)
+    ready = threading.Event()
+    threading.Thread(target=hub.run, args=(ready,), daemon=True).start()
+    ready.wait()
+    print(f"Fan-out hub listening on {path}, starting {count} workers")
+
+    # the hub's thread is already running here, so the workers start from a fresh
+    # interpreter rather than a fork that could inherit one of its locks held
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    try:
+        for worker_id in range(count):
+            process = context.Process(target=run_worker, args=(worker_id, path, options), daemon=True)
+            process.start()
+            processes.append(process)
+        for process in processes:
+            process.join()
+            print(f"Worker {processes.index(process)} exited with code {process.exitcode}")
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        shutil.rmtree(directory, ignore_errors=True)
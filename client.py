@@ -1,23 +1,79 @@
-import socket
+import argparse
 import threading
 import time
-from common import PRIMARY_PORT, send_message, receive_message
+import uuid
+from collections import deque
+from statistics import median
+from common import (
+    PRIMARY_PORT, BACKUP_PORT, FRAME_HISTORY, FRAME_HEARTBEAT, FRAME_TRACED, FRAME_ROOM, FRAME_ROOM_CHAT,
+    FRAME_IDENTIFY, FRAME_DIRECT, FRAME_LEADER, FRAME_RECEIPT, FRAME_RESUME, send_encoded, receive_frame,
+    parse_address
+)
+from delivery import ClientSession, Endpoints, encode_resume, decode_resume
+from handshake import ROLE_CLIENT, encode_hello
+from history import HISTORY_LIMIT, encode_history, decode_history
+from metrics import Metrics
+from reconnect import Backoff, race_connect
+from replication import decode_leader
+from tracing import encode_traced, decode_traced, hops
+from users import encode_identify, encode_direct, decode_direct
+from rooms import (
+    ROOM_JOIN, ROOM_LEAVE, ROOM_RESTORE, encode_room, decode_room, encode_room_message, decode_room_message,
+    decode_room_seq
+)
+
+# how many of the latest messages /latency looks at
+LATENCY_WINDOW = 100
+# the order /latency prints the hops in
+HOP_NAMES = ("network", "queueing", "replication", "fan_out", "total")
 
 class ChatClient:
-    def __init__(self, server_ip: str = "127.0.0.1", server_port: int = PRIMARY_PORT):
-        # where to connect to
-        self.server_ip = server_ip
-        self.server_port = server_port
+    def __init__(self, server_ip: str = "127.0.0.1", server_port: int = PRIMARY_PORT, stats_port: int = None,
+                 username: str = None, endpoints: list = None):
+        # the servers to try in order, the primary and then its backup unless we're told otherwise
+        self.endpoints = Endpoints(endpoints or [(server_ip, server_port), (server_ip, BACKUP_PORT)])
+        # where we got up to and what we sent that the server hasn't confirmed, across reconnects
+        self.session = ClientSession()
+        # set while a /history reply is coming in, what it sends may well be things we've seen
+        self.reading_history = False
         # socket for talking to the server
         self.socket = None
         # flag to control the client's main loop
         self.is_running = True
         # how many times we've tried to reconnect
         self.reconnect_attempts = 0
+        # held while connecting, so the sender and the listener losing the server together
+        # open one socket between them and don't interleave what they send on it
+        self.connect_lock = threading.Lock()
+        # held while writing a frame, the sender and the listener both write to the socket
+        # and two sendalls at once could interleave their bytes
+        self.send_lock = threading.Lock()
         # how many times to try reconnecting before giving up
-        self.max_reconnect_attempts = 5
-        # how long to wait between reconnection attempts
-        self.reconnect_delay = 2  # seconds
+        self.max_reconnect_attempts = 10
+        # how long to wait before each round of reconnecting, growing and jittered so clients
+        # that lost the same server don't all come back at once
+        self.backoff = Backoff()
+        # when we lost the server, so we can tell how long getting it back took
+        self.disconnected_at = None
+        # counters and histograms for the stats endpoint, they do nothing without a port
+        self.stats_port = stats_port
+        self.metrics = Metrics(enabled=stats_port is not None)
+        self.messages_sent = self.metrics.counter("chat_client_messages_sent_total", "chat messages we sent")
+        self.messages_received = self.metrics.counter("chat_client_messages_received_total",
+                                                      "chat messages we received")
+        self.reconnect_attempts_total = self.metrics.counter("chat_client_reconnect_attempts_total",
+                                                             "times we tried to reconnect")
+        self.reconnects = self.metrics.counter("chat_client_reconnects_total", "times we got back in")
+        self.reconnect_seconds = self.metrics.histogram("chat_client_reconnect_seconds",
+                                                        "time from losing the server to being connected again")
+        # per hop latency of the messages we received most recently
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        # the name we log in as, without one we can't send or get direct messages
+        self.username = username
+        # who we are to the servers' room lists, it outlives reconnects so we get our rooms back
+        self.member_id = username or uuid.uuid4().hex
+        # the room what we type goes to, None for everyone
+        self.room = None
 
     def connect(self) -> bool:
         """
@@ -27,85 +83,231 @@ class ChatClient:
             bool: true if we connected, false if we didn't
         """
         try:
-            # create a socket and connect to the server
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.server_ip, self.server_port))
-            print(f"Connected to server at {self.server_ip}:{self.server_port}")
+            # race the servers, the one we were on first, and take whichever answers
+            connection, (server_ip, server_port) = race_connect(self.endpoints.ordered())
+            self.endpoints.use((server_ip, server_port))
+            print(f"Connected to server at {server_ip}:{server_port}")
+            # say we're a client first, so the server doesn't wait to find out
+            send_encoded(connection, encode_hello(ROLE_CLIENT, 0, self.member_id))
+            # log in again and ask to be put back in whatever rooms we had joined
+            if self.username:
+                send_encoded(connection, encode_identify(self.username))
+            send_encoded(connection, encode_room(ROOM_RESTORE, self.member_id))
+            # then ask for what we missed and resend what the last server never confirmed
+            for frame in self.session.reconnect_frames():
+                send_encoded(connection, frame)
+            # only now can the sender use it, or what it sends could land in the middle of the above
+            self.socket = connection
             self.reconnect_attempts = 0
+            self.backoff.reset()
+            if self.disconnected_at is not None:
+                self.reconnects.inc()
+                self.reconnect_seconds.observe(time.time() - self.disconnected_at)
+                self.disconnected_at = None
             return True
         except Exception as e:
             print(f"Connection error: {e}")
             return False
 
+    def send(self, frame: bytes) -> None:
+        """write one whole frame to the server, whichever thread we're on."""
+        with self.send_lock:
+            send_encoded(self.socket, frame)
+
     def send_user_input(self) -> None:
         """handle sending messages that the user types."""
+        connection = None
         while self.is_running:
             try:
                 # get a message from the user
                 message = input()
                 if not self.is_running:
                     break
-                if self.socket:
-                    # send the message to the server
-                    send_message(self.socket, message)
+                # the socket this message goes out on, if it fails the listener may have replaced it already
+                connection = self.socket
+                if not message:
+                    # an empty frame is how the server sees a closed connection, so don't send one
+                    continue
+                if self.socket and message.startswith("/history"):
+                    # ask for what was said in the last few minutes, ten by default
+                    parts = message.split()
+                    minutes = float(parts[1]) if len(parts) > 1 else 10
+                    self.reading_history = True
+                    self.send(encode_history(0, time.time() - minutes * 60))
+                elif message.startswith("/latency"):
+                    self.print_latency()
+                elif self.socket and message.startswith("/msg "):
+                    # a direct message, only the one user gets it
+                    parts = message.split(None, 2)
+                    if len(parts) < 3:
+                        print("Usage: /msg <user> <message>")
+                        continue
+                    self.send(encode_direct(parts[1], parts[2]))
+                    self.messages_sent.inc()
+                elif self.socket and message.startswith("/join "):
+                    # later messages go to the room until we leave it
+                    self.room = message.split(None, 1)[1].strip()
+                    self.send(encode_room(ROOM_JOIN, self.member_id, self.room))
+                elif self.socket and message.startswith("/leave"):
+                    parts = message.split(None, 1)
+                    room = parts[1].strip() if len(parts) > 1 else self.room
+                    if room:
+                        self.send(encode_room(ROOM_LEAVE, self.member_id, room))
+                    if room == self.room:
+                        self.room = None
+                elif self.socket and self.room:
+                    self.send(encode_room_message(self.room, message))
+                    self.messages_sent.inc()
+                elif self.socket:
+                    # send the message to the server, traced so everyone can see where the time went,
+                    # it's kept until the server confirms it and resent if we reconnect before that
+                    self.send(self.session.sending(encode_traced(message)))
+                    self.messages_sent.inc()
                 else:
                     print("Not connected to server. Attempting to reconnect...")
                     if not self.reconnect():
                         break
             except Exception as e:
                 print(f"Error sending message: {e}")
-                if not self.reconnect():
+                if not self.reconnect(connection):
                     break
 
     def listen_for_messages(self) -> None:
         """handle receiving messages from the server."""
+        connection = None
         while self.is_running:
             try:
-                if not self.socket:
+                connection = self.socket
+                if not connection:
                     if not self.reconnect():
                         break
                     continue
 
-                # get a message from the server
-                message = receive_message(self.socket)
-                if not message:
+                # get a frame from the server
+                frame = receive_frame(connection)
+                if frame is None:
                     print("Connection lost. Attempting to reconnect...")
-                    if not self.reconnect():
+                    if not self.reconnect(connection):
                         break
                     continue
-                # show the message to the user
-                print(message)
+                frame_type, payload = frame
+                if frame_type == FRAME_HEARTBEAT:
+                    continue
+                if frame_type == FRAME_HISTORY:
+                    # the server has sent all the history we asked for
+                    _, _, count = decode_history(payload)
+                    self.reading_history = False
+                    print(f"--- end of history, {count} messages ---")
+                    continue
+                if frame_type == FRAME_RECEIPT:
+                    self.session.receipt(payload)
+                    continue
+                if frame_type == FRAME_RESUME:
+                    # the server has sent what we missed while we were away, or as much as it sends at once
+                    seq, count = decode_resume(payload)
+                    if count >= HISTORY_LIMIT:
+                        self.send(encode_resume(seq))
+                    elif count:
+                        print(f"--- caught up on {count} missed messages ---")
+                    continue
+                if frame_type == FRAME_ROOM:
+                    # the server confirming a join or leave, or a room we got back after reconnecting
+                    op, _, room = decode_room(payload)
+                    print(f"--- {'joined' if op == ROOM_JOIN else 'left'} {room} ---")
+                    continue
+                if frame_type == FRAME_LEADER:
+                    # a promoted backup telling us where to reconnect if it goes too
+                    server_ip, _ = self.endpoints.current()
+                    port = decode_leader(payload)
+                    self.endpoints.prefer((server_ip, port))
+                    print(f"--- the primary is now on port {port} ---")
+                    # a backup turns messages away until it takes over, so whatever has no receipt goes again
+                    for unacked in self.session.unacked_frames():
+                        self.send(unacked)
+                    continue
+                if frame_type == FRAME_IDENTIFY:
+                    print(f"--- logged in as {payload.decode('utf-8')} ---")
+                    continue
+                if frame_type == FRAME_DIRECT:
+                    sender, text = decode_direct(payload)
+                    self.messages_received.inc()
+                    print(f"(private) {sender}: {text.decode('utf-8', 'replace')}")
+                    continue
+                if frame_type == FRAME_ROOM_CHAT:
+                    room, text = decode_room_message(payload)
+                    # numbered like traced messages, so a resume carries on after it
+                    self.session.numbered(decode_room_seq(payload))
+                    self.messages_received.inc()
+                    print(f"[{room}] {text.decode('utf-8', 'replace')}")
+                    continue
+                if frame_type == FRAME_TRACED:
+                    trace, payload = decode_traced(payload)
+                    # the replay and a resume can both send what we've already shown
+                    if not self.session.delivered(trace) and not self.reading_history:
+                        continue
+                    self.latencies.append(hops(trace, time.time()))
+                # show the message to the user, the servers pass messages on without
+                # decoding them so a broken one is shown mangled instead of cutting us off
+                self.messages_received.inc()
+                print(payload.decode('utf-8', 'replace'))
             except Exception as e:
                 print(f"Error receiving message: {e}")
-                if not self.reconnect():
+                if not self.reconnect(connection):
                     break
 
-    def reconnect(self) -> bool:
+    def print_latency(self) -> None:
+        """print the median of each hop over the messages we received most recently."""
+        if not self.latencies:
+            print("No traced messages received yet")
+            return
+        parts = []
+        for name in HOP_NAMES:
+            values = [latency[name] for latency in self.latencies if name in latency]
+            if values:
+                parts.append(f"{name} {median(values) * 1000:.2f}ms")
+        print(f"Median over the last {len(self.latencies)} messages: " + ", ".join(parts))
+
+    def reconnect(self, lost=None) -> bool:
         """
-        try to reconnect to the server if we got disconnected.
+        try to reconnect if we got disconnected, after a jittered wait that grows
+        with every attempt, to whichever server answers first. the one we were
+        on gets a head start, so losing the primary moves us to its backup.
+        
+        Args:
+            lost: the socket that failed, None if we had none
         
         Returns:
             bool: true if we reconnected, false if we didn't
         """
-        if self.reconnect_attempts >= self.max_reconnect_attempts:
-            print("Max reconnection attempts reached. Giving up.")
-            return False
+        with self.connect_lock:
+            # the other thread saw the same failure and has already got us a new connection
+            if self.socket is not None and self.socket is not lost:
+                return True
 
-        self.reconnect_attempts += 1
-        print(f"Reconnection attempt {self.reconnect_attempts}/{self.max_reconnect_attempts}")
-        
-        if self.socket:
-            try:
-                self.socket.close()
-            except:
-                pass
-            self.socket = None
+            if self.reconnect_attempts >= self.max_reconnect_attempts:
+                print("Max reconnection attempts reached. Giving up.")
+                return False
+
+            self.reconnect_attempts += 1
+            self.reconnect_attempts_total.inc()
+            if self.disconnected_at is None:
+                self.disconnected_at = time.time()
+            print(f"Reconnection attempt {self.reconnect_attempts}/{self.max_reconnect_attempts}")
+            
+            if self.socket:
+                try:
+                    self.socket.close()
+                except:
+                    pass
+                self.socket = None
 
-        time.sleep(self.reconnect_delay)
-        return self.connect()
+            time.sleep(self.backoff.next())
+            return self.connect()
 
     def start(self) -> None:
         """start the chat client."""
+        if self.stats_port is not None:
+            self.metrics.serve(self.stats_port)
         if not self.connect():
             print("Failed to connect to server. Exiting.")
             return
@@ -135,10 +337,20 @@ class ChatClient:
             except:
                 pass
             self.socket = None
+        self.metrics.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="chat client")
+    parser.add_argument("--username", default=None,
+                        help="log in under this name so others can send you direct messages")
+    parser.add_argument("--stats-port", type=int, default=None,
+                        help="serve reconnect and message metrics for scraping on this port")
+    parser.add_argument("--servers", type=parse_address, nargs="+", default=None, metavar="HOST:PORT",
+                        help="servers to try in order, the primary first, by default both on this machine")
+    args = parser.parse_args()
+
     # create and start the client
-    client = ChatClient()
+    client = ChatClient(stats_port=args.stats_port, username=args.username, endpoints=args.servers)
     try:
         client.start()
     except KeyboardInterrupt:
@@ -4,7 +4,17 @@ import socket
 import threading
 import time
 import sys
-from common import PRIMARY_PORT, send_message, receive_message
+from common import (
+    PRIMARY_PORT, BACKUP_PORT, FRAME_CHAT, FRAME_TRACED, FRAME_DIRECT, FRAME_CONTROL, FRAME_LEADER, FRAME_RECEIPT,
+    FRAME_RESUME, send_encoded, receive_frame
+)
+from delivery import ClientSession, Endpoints, encode_resume, decode_resume
+from handshake import ROLE_CLIENT, encode_hello
+from history import HISTORY_LIMIT
+from reconnect import Backoff, race_connect
+from replication import decode_leader
+from tracing import encode_traced, decode_traced, hops
+from users import encode_identify, encode_direct, decode_direct
 
 class ChatClientGUI:
     def __init__(self, root, username="Anonymous", server_ip=None):
@@ -91,7 +101,15 @@ class ChatClientGUI:
         self.is_connected = False
         self.reconnect_attempts = 0
         self.max_reconnect_attempts = 5
-        self.reconnect_delay = 2
+        # how long to wait before each round of reconnecting, growing and jittered
+        self.backoff = Backoff()
+        # the servers to try in order, taken from the fields when we connect by hand
+        self.endpoints = None
+        # where we got up to and what we sent that the server hasn't confirmed, across reconnects
+        self.session = ClientSession()
+        # held while writing a frame, the window and the receive thread both write to the socket
+        # and two sendalls at once could interleave their bytes
+        self.send_lock = threading.Lock()
 
         # if we were given a server IP, try to connect automatically
         if server_ip:
@@ -111,18 +129,35 @@ class ChatClientGUI:
     def toggle_connection(self):
         # connect or disconnect based on current state
         if not self.is_connected:
+            self.endpoints = None
             self.connect()
         else:
             self.disconnect()
 
     def connect(self):
+        if self.endpoints is None:
+            # the server in the fields first, then the other one on the same machine
+            server_ip, server_port = self.server_ip.get(), int(self.server_port.get())
+            others = [(server_ip, port) for port in (PRIMARY_PORT, BACKUP_PORT) if port != server_port]
+            self.endpoints = Endpoints([(server_ip, server_port)] + others)
         try:
-            # create a socket and connect to the server
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.server_ip.get(), int(self.server_port.get())))
+            # race the servers, the one we were on first, and take whichever answers
+            connection, address = race_connect(self.endpoints.ordered())
+            self.endpoints.use(address)
+            self.server_port.set(str(address[1]))
+            # say we're a client first, so the server doesn't wait to find out
+            send_encoded(connection, encode_hello(ROLE_CLIENT, 0, self.username))
+            # log in so people can send us direct messages
+            send_encoded(connection, encode_identify(self.username))
+            # then ask for what we missed and resend what the last server never confirmed
+            for frame in self.session.reconnect_frames():
+                send_encoded(connection, frame)
+            # only now can the window send on it, or a message could land in the middle of the above
+            self.socket = connection
             self.is_connected = True
             self.is_running = True
             self.reconnect_attempts = 0
+            self.backoff.reset()
             
             # update the UI to show we're connected
             self.connect_button.config(text="Disconnect")
@@ -134,10 +169,17 @@ class ChatClientGUI:
             self.receive_thread.start()
             
             self.display_message("System", f"Connected to server as {self.username}")
+            return True
             
         except Exception as e:
             self.display_message("System", f"Connection error: {str(e)}")
             self.status_label.config(text="Connection failed")
+            return False
+
+    def send(self, frame):
+        # write one whole frame to the server, from the window or the receive thread
+        with self.send_lock:
+            send_encoded(self.socket, frame)
 
     def disconnect(self):
         # stop everything and clean up
@@ -165,9 +207,17 @@ class ChatClientGUI:
         message = self.message_input.get()
         if message:
             try:
+                if message.startswith("@") and " " in message:
+                    # "@bob hi" goes to bob alone
+                    username, text = message[1:].split(" ", 1)
+                    self.send(encode_direct(username, text))
+                    self.display_message(f"{self.username} to {username}", text)
+                    self.message_input.delete(0, tk.END)
+                    return
                 # add our username to the message
                 full_message = f"{self.username}: {message}"
-                send_message(self.socket, full_message)
+                # kept until the server confirms it and resent if we reconnect before that
+                self.send(self.session.sending(encode_traced(full_message)))
                 self.display_message(self.username, message)
                 self.message_input.delete(0, tk.END)
             except Exception as e:
@@ -182,12 +232,52 @@ class ChatClientGUI:
                     break
                     
                 # get a message from the server
-                message = receive_message(self.socket)
-                if not message:
+                frame = receive_frame(self.socket)
+                if frame is None:
+                    # the server went away, try it and then the others
+                    if self.is_running and not self.reconnect():
+                        self.disconnect()
                     break
+                frame_type, payload = frame
+                if frame_type == FRAME_DIRECT:
+                    sender, text = decode_direct(payload)
+                    self.display_message(f"{sender} (private)", text.decode('utf-8', 'replace'))
+                    continue
+                if frame_type == FRAME_LEADER:
+                    # a promoted backup, reconnect to it from now on
+                    port = decode_leader(payload)
+                    self.endpoints.prefer((self.endpoints.current()[0], port))
+                    self.server_port.set(str(port))
+                    self.display_message("System", f"The primary is now on port {port}")
+                    # a backup turns messages away until it takes over, so whatever has no receipt goes again
+                    for unacked in self.session.unacked_frames():
+                        self.send(unacked)
+                    continue
+                if frame_type == FRAME_RECEIPT:
+                    self.session.receipt(payload)
+                    continue
+                if frame_type == FRAME_RESUME:
+                    # the server has sent what we missed while we were away, or as much as it sends at once
+                    seq, count = decode_resume(payload)
+                    if count >= HISTORY_LIMIT:
+                        self.send(encode_resume(seq))
+                    elif count:
+                        self.display_message("System", f"Caught up on {count} missed messages")
+                    continue
+                if frame_type == FRAME_CONTROL:
+                    self.display_message("System", payload.decode('utf-8'))
+                    continue
+                if frame_type == FRAME_TRACED:
+                    trace, payload = decode_traced(payload)
+                    # the replay and a resume can both send what we've already shown
+                    if not self.session.delivered(trace):
+                        continue
+                    self.show_latency(hops(trace, time.time()))
+                elif frame_type != FRAME_CHAT:
+                    continue
                     
-                # show the message in the chat
-                self.display_message("", message)
+                # show the message in the chat, the servers never check that it decodes
+                self.display_message("", payload.decode('utf-8', 'replace'))
                 
             except Exception as e:
                 if self.is_running:
@@ -195,6 +285,12 @@ class ChatClientGUI:
                     self.disconnect()
                 break
 
+    def show_latency(self, latency):
+        # put where the last message's time went next to the connection status
+        parts = [f"{name} {latency[name] * 1000:.1f}ms" for name in ("network", "queueing", "fan_out", "total")
+                 if name in latency]
+        self.status_label.config(text="Connected, last message " + ", ".join(parts))
+
     def display_message(self, sender, message):
         # add a message to the chat display
         self.message_display.config(state=tk.NORMAL)
@@ -206,7 +302,7 @@ class ChatClientGUI:
         self.message_display.config(state=tk.DISABLED)
 
     def reconnect(self):
-        # try to reconnect to the server
+        # try to reconnect, to whichever server answers first after a jittered wait
         if self.reconnect_attempts >= self.max_reconnect_attempts:
             self.display_message("System", "Max reconnection attempts reached. Giving up.")
             return False
@@ -221,7 +317,7 @@ class ChatClientGUI:
                 pass
             self.socket = None
 
-        time.sleep(self.reconnect_delay)
+        time.sleep(self.backoff.next())
         return self.connect()
 
 if __name__ == "__main__":
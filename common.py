@@ -1,29 +1,454 @@
+import os
 import socket
+import struct
+import threading
+import time
+import weakref
 
 # these are the ports we use for the primary and backup servers
 PRIMARY_PORT = 5000
 BACKUP_PORT = 5001
-# how often we check if the primary server is still alive
-HEARTBEAT_INTERVAL = 2  # seconds
-# how many missed heartbeats before we assume the primary is dead
+# how long a server's link to its backup may go without a frame before it sends a heartbeat
+HEARTBEAT_INTERVAL = 1  # seconds
+# how many missed heartbeats before the backup assumes the primary is dead, while its
+# failure detector hasn't seen enough of the link to judge for itself
 HEARTBEAT_TIMEOUT = 3   # number of missed heartbeats
-# how much data we can receive at once
-BUFFER_SIZE = 1024
+# how often a promoted backup tries to take over the primary's client port while it's still held
+TAKEOVER_RETRY_INTERVAL = 0.25  # seconds
+# how many pending connections the kernel may queue for us, enough for every client
+# reconnecting at once after a failover without their SYNs being dropped
+LISTEN_BACKLOG = 1024
+# how much data we read from a socket at once, big enough to pull in a whole batch of frames
+BUFFER_SIZE = 65536
+# how many spare receive buffers BUFFER_POOL keeps for new connections
+DEFAULT_POOL_BUFFERS = 64
 
-def send_message(sock: socket.socket, message: str) -> None:
+# most buffers one sendmsg call will take
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+# every frame on the wire is a 4 byte payload length, a 1 byte frame type and then the payload
+FRAME_HEADER = struct.Struct('!IB')
+# anything bigger than this is treated as a corrupt stream
+MAX_FRAME_SIZE = 1024 * 1024
+# the kinds of frames we send
+FRAME_CHAT = 1
+FRAME_HEARTBEAT = 2
+FRAME_CONTROL = 3
+# primary to backup: an 8 byte sequence number followed by a complete frame
+FRAME_REPLICATE = 4
+# backup to primary: the 8 byte sequence number of the last entry it applied
+FRAME_ACK = 5
+# backup to primary when the link comes up: the log id and sequence number it has applied up to,
+# primary to backup in reply: the log id and the sequence number the entries that follow pick up from
+FRAME_CATCHUP = 6
+# primary to backup: log id, the sequence number the snapshot covers up to, then the recent frames
+FRAME_SNAPSHOT = 7
+# client to server: asks for the messages after a sequence number or time in the write-ahead log,
+# server to client: follows the replayed messages and says where they got up to
+FRAME_HISTORY = 8
+# between primary workers and their fan-out hub: the origin worker's id, then the frame being broadcast
+FRAME_BUS = 9
+# a chat message that starts with a TRACE_HEADER, the servers fill in its hops on the way through
+FRAME_TRACED = 10
+# client to server: join, leave or get back rooms, server to client: confirms a join or leave,
+# primary to backup: the membership change, see rooms.py
+FRAME_ROOM = 11
+# a chat message for one room only, the room name comes first
+FRAME_ROOM_CHAT = 12
+# client to server: the username to log in as, server to client: the login worked
+FRAME_IDENTIFY = 13
+# a message for one user, see users.py
+FRAME_DIRECT = 14
+# primary to backup and between workers: a username logging in or out
+FRAME_PRESENCE = 15
+# server to client: this server has taken over as the primary, the port it takes clients on follows
+FRAME_LEADER = 16
+# server to client: a traced message the client sent is in, see delivery.py
+FRAME_RECEIPT = 17
+# client to server after a reconnect: asks for the messages after the last sequence number it got,
+# server to client: follows the resent messages and says where they got up to
+FRAME_RESUME = 18
+# the first frame on a connection: whether it's a client or a server replicating to us, who
+# it is and its epoch, a server answers a replicating peer with its own, see handshake.py
+FRAME_HELLO = 19
+# between primary workers, over the fan-out hub: a worker claiming or releasing a username or member id, see bus.py
+FRAME_CLAIM = 20
+FRAME_TYPES = (FRAME_CHAT, FRAME_HEARTBEAT, FRAME_CONTROL, FRAME_REPLICATE, FRAME_ACK,
+               FRAME_CATCHUP, FRAME_SNAPSHOT, FRAME_HISTORY, FRAME_BUS, FRAME_TRACED,
+               FRAME_ROOM, FRAME_ROOM_CHAT, FRAME_IDENTIFY, FRAME_DIRECT, FRAME_PRESENCE,
+               FRAME_LEADER, FRAME_RECEIPT, FRAME_RESUME, FRAME_HELLO, FRAME_CLAIM)
+# a trace id and when the client sent the message, the primary received it, the
+# backup had it and fan out started, each 0 until that hop has happened, then
+# the sequence number the primary gave it, 0 until it has one
+TRACE_HEADER = struct.Struct('!QddddQ')
+
+
+# heartbeats never change so we only build the frame once
+HEARTBEAT_FRAME = FRAME_HEADER.pack(0, FRAME_HEARTBEAT)
+
+
+class ProtocolError(Exception):
+    """raised when the bytes on a connection don't form a valid frame."""
+
+
+def encode_frame(frame_type: int, payload: bytes) -> bytes:
     """
-    send a message through a socket connection.
+    turn a payload into a frame ready to go on the wire.
     
     Args:
-        sock: the socket to send the message through
-        message: the message to send
+        frame_type: one of the FRAME_* constants
+        payload: the raw bytes to carry
+        
+    Returns:
+        the header and payload as one bytes object
+    """
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"frame of {len(payload)} bytes is bigger than {MAX_FRAME_SIZE}")
+    return FRAME_HEADER.pack(len(payload), frame_type) + payload
+
+
+class FrameDecoder:
+    """
+    streaming frame parser that keeps leftover bytes between reads.
+    
+    feed it whatever recv returned and it hands back every complete frame,
+    holding on to a partial frame until the rest of it arrives.
+    """
+
+    def __init__(self):
+        # bytes we've received but haven't turned into frames yet
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        """
+        add received bytes and pull out all the complete frames.
+        
+        Args:
+            data: bytes that just came off the socket
+            
+        Returns:
+            a list of (frame_type, payload) tuples, possibly empty
+        """
+        self.buffer += data
+        frames = []
+        offset = 0
+        header_size = FRAME_HEADER.size
+        while len(self.buffer) - offset >= header_size:
+            length, frame_type = FRAME_HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError(f"frame length {length} is bigger than {MAX_FRAME_SIZE}")
+            if frame_type not in FRAME_TYPES:
+                raise ProtocolError(f"unknown frame type {frame_type}")
+            end = offset + header_size + length
+            if end > len(self.buffer):
+                break
+            frames.append((frame_type, bytes(self.buffer[offset + header_size:end])))
+            offset = end
+        # drop everything we've consumed so only the partial frame stays around
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+class BufferPool:
+    """
+    spare receive buffers, so connections coming and going don't keep
+    allocating and freeing BUFFER_SIZE bytearrays.
+    """
+
+    def __init__(self, size: int = BUFFER_SIZE, keep: int = DEFAULT_POOL_BUFFERS):
+        self.size = size
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.free = []
+
+    def get(self) -> bytearray:
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return bytearray(self.size)
+
+    def put(self, buffer: bytearray) -> None:
+        # a buffer that grew for an oversized frame isn't worth keeping
+        if len(buffer) != self.size:
+            return
+        with self.lock:
+            if len(self.free) < self.keep:
+                self.free.append(buffer)
+
+
+# every connection's receive buffer comes from here
+BUFFER_POOL = BufferPool()
+
+
+class FrameBuffer:
+    """
+    a pooled receive buffer that frames are parsed out of in place.
+
+    the socket writes straight into the free space at the end, through
+    recv_into or an asyncio buffered protocol, and each complete frame comes
+    back as a memoryview of the buffer, header and all. nothing is copied
+    between the socket and whoever handles the frame, but a view is only
+    good until the next call to space(), anything kept longer has to be
+    copied out with bytes().
+    """
+
+    def __init__(self, pool: BufferPool = None):
+        self.pool = pool or BUFFER_POOL
+        self.buffer = self.pool.get()
+        self.view = memoryview(self.buffer)
+        # the next frame starts at start and what we've received ends at end
+        self.start = 0
+        self.end = 0
+
+    def space(self) -> memoryview:
+        """where the next read should go, making room first if the buffer is full."""
+        if self.start == self.end:
+            # everything has been handed out, start again at the front
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            self.make_room()
+        return self.view[self.end:]
+
+    def filled(self, count: int) -> None:
+        """record that a read put count bytes into the space we gave it."""
+        self.end += count
+
+    def make_room(self) -> None:
+        # move the partial frame to the front, or into a bigger buffer if it fills this one
+        waiting = self.end - self.start
+        if self.start:
+            self.view[:waiting] = self.view[self.start:self.end]
+        else:
+            buffer = bytearray(len(self.buffer) * 2)
+            buffer[:waiting] = self.view[:waiting]
+            self.pool.put(self.buffer)
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start = 0
+        self.end = waiting
+
+    def has_frame(self) -> bool:
+        """whether a whole frame is already waiting in the buffer."""
+        if self.end - self.start < FRAME_HEADER.size:
+            return False
+        length, _ = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        return self.start + FRAME_HEADER.size + length <= self.end
+
+    def next_frame(self):
+        """
+        take the next complete frame out of the buffer.
+
+        Returns:
+            a (frame_type, frame) tuple where frame is a memoryview of the
+            whole encoded frame, or None until the rest of it arrives
+        """
+        if self.end - self.start < FRAME_HEADER.size:
+            return None
+        length, frame_type = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"frame length {length} is bigger than {MAX_FRAME_SIZE}")
+        if frame_type not in FRAME_TYPES:
+            raise ProtocolError(f"unknown frame type {frame_type}")
+        end = self.start + FRAME_HEADER.size + length
+        if end > self.end:
+            return None
+        frame = self.view[self.start:end]
+        self.start = end
+        return frame_type, frame
+
+    def release(self) -> None:
+        """give the buffer back to the pool, nothing can be read after this."""
+        buffer, self.buffer = self.buffer, None
+        self.view = None
+        if buffer is not None:
+            self.pool.put(buffer)
+
+
+class FrameReader:
+    """reads frames from one socket, one recv_into can yield many frames."""
+
+    def __init__(self, sock: socket.socket, pool: BufferPool = None):
+        self.sock = sock
+        self.frames = FrameBuffer(pool)
+
+    @property
+    def pending(self) -> bool:
+        """whether a whole frame has already been read off the socket and is waiting."""
+        return self.frames.has_frame()
+
+    def read_view(self):
+        """
+        get the next frame from the socket without copying it.
+
+        Returns:
+            a (frame_type, frame) tuple with the whole encoded frame as a
+            memoryview that's only good until the next read, or None if the
+            connection closed
+        """
+        while True:
+            frame = self.frames.next_frame()
+            if frame is not None:
+                return frame
+            count = self.sock.recv_into(self.frames.space())
+            if not count:
+                return None
+            self.frames.filled(count)
+
+    def read_frame(self):
+        """
+        get the next frame from the socket.
+        
+        Returns:
+            a (frame_type, payload) tuple, or None if the connection closed
+        """
+        frame = self.read_view()
+        if frame is None:
+            return None
+        frame_type, view = frame
+        return frame_type, bytes(view[FRAME_HEADER.size:])
+
+
+# one reader per socket so leftover bytes survive between calls
+_readers = weakref.WeakKeyDictionary()
+_readers_lock = threading.Lock()
+
+
+def get_reader(sock: socket.socket) -> FrameReader:
+    """
+    get the frame reader for a socket, creating it the first time.
+    
+    Args:
+        sock: the socket to read from
+        
+    Returns:
+        the FrameReader that owns this socket's receive buffer
+    """
+    with _readers_lock:
+        reader = _readers.get(sock)
+        if reader is None:
+            reader = FrameReader(sock)
+            _readers[sock] = reader
+        return reader
+
+
+def release_reader(sock: socket.socket) -> None:
+    """
+    hand a socket's receive buffer back to the pool once nothing will read from it again.
+
+    only the thread that reads the socket may call this, the buffer could
+    otherwise go to another connection while a recv_into is still filling it.
+    """
+    with _readers_lock:
+        reader = _readers.pop(sock, None)
+    if reader is not None:
+        reader.frames.release()
+
+
+def send_frame(sock: socket.socket, frame_type: int, payload: bytes) -> None:
+    """
+    send one frame through a socket connection.
+    
+    Args:
+        sock: the socket to send the frame through
+        frame_type: one of the FRAME_* constants
+        payload: the raw bytes to carry
+    """
+    send_encoded(sock, encode_frame(frame_type, payload))
+
+
+def receive_frame(sock: socket.socket):
+    """
+    receive one frame from a socket connection.
+    
+    Args:
+        sock: the socket to receive the frame from
+        
+    Returns:
+        a (frame_type, payload) tuple, or None if the connection closed
+    """
+    try:
+        return get_reader(sock).read_frame()
+    except Exception as e:
+        print(f"Error receiving message: {e}")
+        raise
+
+
+def encode_message(message: str, frame_type: int = FRAME_CHAT) -> bytes:
+    """
+    encode and frame a text message once so it can be sent to many sockets.
+    
+    Args:
+        message: the message to encode
+        frame_type: what kind of frame to wrap it in, chat by default
+        
+    Returns:
+        the framed message, immutable so every recipient can share it
+    """
+    return encode_frame(frame_type, message.encode('utf-8'))
+
+def send_encoded(sock: socket.socket, frame: bytes) -> None:
+    """
+    send an already encoded frame through a socket connection.
+    
+    Args:
+        sock: the socket to send the frame through
+        frame: bytes from encode_frame or encode_message
     """
     try:
-        sock.sendall(message.encode('utf-8'))
+        sock.sendall(frame)
     except Exception as e:
         print(f"Error sending message: {e}")
         raise
 
+def send_vectored(sock: socket.socket, buffers: list) -> int:
+    """
+    send a batch of frames with as few syscalls as possible.
+    
+    uses one scatter/gather sendmsg for the whole batch and only loops
+    when the kernel takes part of it.
+    
+    Args:
+        sock: the socket to send the frames through
+        buffers: bytes-like objects to send back to back
+        
+    Returns:
+        how many send syscalls it took
+    """
+    if not hasattr(sock, 'sendmsg'):
+        # no scatter/gather on this platform, one joined send is the next best thing
+        sock.sendall(b''.join(buffers))
+        return 1
+    calls = 0
+    buffers = list(buffers)
+    start = 0
+    while start < len(buffers):
+        sent = sock.sendmsg(buffers[start:start + IOV_MAX])
+        calls += 1
+        # skip past whatever the kernel took, keeping the rest of a partly sent buffer
+        while start < len(buffers) and sent >= len(buffers[start]):
+            sent -= len(buffers[start])
+            start += 1
+        if sent:
+            buffers[start] = memoryview(buffers[start])[sent:]
+    return calls
+
+def send_message(sock: socket.socket, message: str, frame_type: int = FRAME_CHAT) -> None:
+    """
+    send a message through a socket connection.
+    
+    Args:
+        sock: the socket to send the message through
+        message: the message to send
+        frame_type: what kind of frame to wrap it in, chat by default
+    """
+    send_frame(sock, frame_type, message.encode('utf-8'))
+
 def receive_message(sock: socket.socket) -> str:
     """
     receive a message from a socket connection.
@@ -32,13 +457,26 @@ def receive_message(sock: socket.socket) -> str:
         sock: the socket to receive the message from
         
     Returns:
-        the received message as a string
+        the received message as a string, or an empty string if the connection closed
     """
-    try:
-        return sock.recv(BUFFER_SIZE).decode('utf-8')
-    except Exception as e:
-        print(f"Error receiving message: {e}")
-        raise
+    frame = receive_frame(sock)
+    if frame is None:
+        return ""
+    frame_type, payload = frame
+    if frame_type == FRAME_HEARTBEAT:
+        return format_heartbeat()
+    if frame_type == FRAME_TRACED:
+        payload = payload[TRACE_HEADER.size:]
+    return payload.decode('utf-8')
+
+def send_heartbeat(sock: socket.socket) -> None:
+    """
+    send a heartbeat frame through a socket connection.
+    
+    Args:
+        sock: the socket to send the heartbeat through
+    """
+    send_encoded(sock, HEARTBEAT_FRAME)
 
 def format_heartbeat() -> str:
     """
@@ -61,6 +499,33 @@ def is_heartbeat(message: str) -> bool:
     """
     return message.strip() == "HEARTBEAT"
 
+def parse_address(text: str) -> tuple:
+    """
+    turn "host:port" into an address to connect to, for command line flags.
+
+    Args:
+        text: the host and port, a bare ":port" means this machine
+
+    Returns:
+        a (host, port) tuple
+    """
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+def log_event(event: str, **details) -> None:
+    """
+    print a timestamped line for something worth timing, like a failover step.
+
+    the lines look like "event 1700000000.123456 heartbeat_timeout silent_for=3.1"
+    so benchmarks can pick them out of a server's output and line them up.
+
+    Args:
+        event: what happened, one word
+        details: anything else worth knowing, printed as key=value
+    """
+    fields = "".join(f" {key}={value}" for key, value in details.items())
+    print(f"event {time.time():.6f} {event}{fields}", flush=True)
+
 def broadcast(message: str, sender_socket: socket.socket, sockets: list) -> None:
     """
     send a message to all connected clients except the sender.
@@ -70,6 +535,8 @@ def broadcast(message: str, sender_socket: socket.socket, sockets: list) -> None
         sender_socket: the socket of the person who sent the message
         sockets: all the connected clients
     """
-    for socket in sockets:
-        if socket != sender_socket:  # don't send the message back to the sender
-            send_message(socket, message) 
\ No newline at end of file
+    # encode once and hand the same bytes to every recipient
+    frame = encode_message(message)
+    for sock in sockets:
+        if sock != sender_socket:  # don't send the message back to the sender
+            send_encoded(sock, frame) 
\ No newline at end of file
@@ -0,0 +1,317 @@
+import itertools
+import socket
+import threading
+import time
+from collections import deque
+from common import IOV_MAX, encode_message, send_vectored
+from profiling import profiler
+
+# what to do when a client can't keep up with what we're sending it
+POLICY_DROP_OLDEST = "drop_oldest"  # throw away the oldest queued frames to make room
+POLICY_COALESCE = "coalesce"        # drop the oldest frames past the byte limit, merge the rest at the frame limit
+POLICY_DISCONNECT = "disconnect"    # hang up once too many bytes are queued
+POLICIES = (POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT)
+
+# default limits for one client's outbound queue
+DEFAULT_MAX_FRAMES = 1024
+DEFAULT_MAX_BYTES = 1024 * 1024
+# how long a writer waits for more frames before flushing a batch, and how big a batch gets
+DEFAULT_FLUSH_DELAY = 0.002  # seconds
+DEFAULT_FLUSH_BYTES = 64 * 1024
+# the backup link must never silently drop frames, so it gets a big queue and
+# is dropped and reconnected if the backup still can't keep up
+BACKUP_QUEUE_BYTES = 64 * 1024 * 1024
+
+
+class OutboundQueue:
+    """
+    bounded queue of frames waiting to be written to one connection.
+
+    putting never blocks, when the queue is full the slow consumer policy
+    decides what gives.
+    """
+
+    def __init__(self, max_frames: int = DEFAULT_MAX_FRAMES, max_bytes: int = DEFAULT_MAX_BYTES,
+                 policy: str = POLICY_DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown slow consumer policy {policy!r}")
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.policy = policy
+        # frames waiting to be written, oldest first
+        self.frames = deque()
+        # alongside each of them the sizes of the frames it holds, more than one once coalesced
+        self.parts = deque()
+        # total size of everything in frames
+        self.queued_bytes = 0
+        # how many frames we've thrown away because the client was too slow
+        self.dropped = 0
+        # set once nothing more should go through this queue
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def put(self, data: bytes) -> bool:
+        """
+        queue a frame for writing.
+
+        Args:
+            data: the encoded frame
+
+        Returns:
+            false if the connection should be dropped as a slow consumer
+        """
+        with self.condition:
+            if self.closed:
+                return False
+            if self.policy == POLICY_DISCONNECT:
+                if self.queued_bytes + len(data) > self.max_bytes:
+                    return False
+            else:
+                self.make_room(len(data))
+            self.frames.append(data)
+            self.parts.append((len(data),))
+            self.queued_bytes += len(data)
+            self.condition.notify()
+            return True
+
+    def make_room(self, size: int) -> None:
+        # called with the lock held, frees space for a frame of the given size.
+        # the oldest frames go one at a time until the bytes fit, even out of a
+        # coalesced run, then coalesce merges what's left to get under the frame limit
+        while self.frames and self.queued_bytes + size > self.max_bytes:
+            self.drop_oldest()
+        if self.policy == POLICY_COALESCE:
+            if len(self.frames) >= self.max_frames:
+                # frames are self-delimiting so they can be glued together on the wire
+                merged = b''.join(self.frames)
+                parts = tuple(part for sizes in self.parts for part in sizes)
+                self.frames.clear()
+                self.parts.clear()
+                self.frames.append(merged)
+                self.parts.append(parts)
+            return
+        while self.frames and len(self.frames) >= self.max_frames:
+            self.drop_oldest()
+
+    def drop_oldest(self) -> None:
+        # called with the lock held, throws away the oldest queued frame
+        sizes = self.parts[0]
+        if len(sizes) == 1:
+            self.frames.popleft()
+            self.parts.popleft()
+        else:
+            self.frames[0] = self.frames[0][sizes[0]:]
+            self.parts[0] = sizes[1:]
+        self.queued_bytes -= sizes[0]
+        self.dropped += 1
+
+    def get_batch(self, flush_bytes: int = DEFAULT_FLUSH_BYTES, flush_delay: float = DEFAULT_FLUSH_DELAY,
+                  max_frames: int = IOV_MAX) -> list:
+        """
+        wait for frames and collect a batch of them to write in one go.
+
+        once the first frame is here we keep gathering until the batch
+        reaches flush_bytes or flush_delay has gone by, whichever is first.
+
+        Args:
+            flush_bytes: flush as soon as this many bytes are waiting
+            flush_delay: longest time to hold the first frame back
+            max_frames: most frames in one batch
+
+        Returns:
+            a list of frames, empty once the queue is closed
+        """
+        with self.condition:
+            while not self.frames and not self.closed:
+                self.condition.wait()
+            deadline = time.monotonic() + flush_delay
+            while (not self.closed and self.queued_bytes < flush_bytes
+                   and len(self.frames) < max_frames):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = []
+            size = 0
+            while self.frames and len(batch) < max_frames and size < flush_bytes:
+                data = self.frames.popleft()
+                self.parts.popleft()
+                size += len(data)
+                batch.append(data)
+            self.queued_bytes -= size
+            return batch
+
+    def drain(self) -> list:
+        """take every queued frame without waiting."""
+        with self.condition:
+            frames = list(self.frames)
+            self.frames.clear()
+            self.parts.clear()
+            self.queued_bytes = 0
+            return frames
+
+    def close(self) -> None:
+        """stop accepting frames and wake up anyone waiting in get."""
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+            self.parts.clear()
+            self.queued_bytes = 0
+            self.condition.notify_all()
+
+
+class ClientConnection:
+    """
+    a socket plus its outbound queue and the writer thread that drains it.
+
+    anyone can call send without blocking, only the writer thread ever
+    touches the socket, so one slow reader only ever holds up itself. the
+    writer flushes frames in batches with one sendmsg per batch.
+    """
+
+    def __init__(self, sock, address, max_frames: int = DEFAULT_MAX_FRAMES,
+                 max_bytes: int = DEFAULT_MAX_BYTES, policy: str = POLICY_DROP_OLDEST,
+                 flush_delay: float = DEFAULT_FLUSH_DELAY, flush_bytes: int = DEFAULT_FLUSH_BYTES):
+        self.sock = sock
+        self.address = address
+        self.queue = OutboundQueue(max_frames, max_bytes, policy)
+        # how the writer batches frames before each send
+        self.flush_delay = flush_delay
+        self.flush_bytes = flush_bytes
+        # how many send syscalls and frames the writer has done, to see how well batching works
+        self.send_calls = 0
+        self.frames_sent = 0
+        # set once the connection is closed so we only clean up once
+        self.closed = False
+        self.lock = threading.Lock()
+        self.writer_thread = None
+        # the id the server's client registry gave us
+        self.client_id = None
+
+    def start(self) -> None:
+        """start the writer thread for this connection."""
+        self.writer_thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def send(self, data: bytes) -> bool:
+        """
+        queue an encoded frame for this client.
+
+        Returns:
+            false if the client is gone or was dropped for being too slow
+        """
+        if self.queue.put(data):
+            return True
+        if not self.closed:
+            print(f"Disconnecting slow client {self.address}")
+            self.close()
+        return False
+
+    def send_message(self, message: str) -> bool:
+        """queue a chat message for this client."""
+        return self.send(encode_message(message))
+
+    def queue_depth(self) -> int:
+        """how many frames are waiting to be written to this client."""
+        return len(self.queue)
+
+    def write_loop(self) -> None:
+        # drain the queue into the socket in batches until the connection closes
+        while not self.closed:
+            batch = self.queue.get_batch(self.flush_bytes, self.flush_delay)
+            if not batch:
+                continue
+            try:
+                with profiler.span("sendall"):
+                    self.send_calls += send_vectored(self.sock, batch)
+                self.frames_sent += len(batch)
+            except Exception as e:
+                if not self.closed:
+                    print(f"Error sending to client {self.address}: {e}")
+                self.close()
+
+    def close(self) -> None:
+        """close the connection and stop the writer."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.queue.close()
+        try:
+            # shutdown wakes up a reader thread that's blocked in recv, close alone doesn't
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+
+class ClientRegistry:
+    """
+    every client connected to a server, safe to change from any thread.
+
+    each client gets an id and is kept in a dict under it, so adding and
+    removing one is O(1) however many are connected. fan out iterates a
+    snapshot tuple that is only rebuilt on the first read after a change, so
+    a broadcast never sees the registry change under it, and a burst of
+    connects and disconnects between two broadcasts costs one rebuild.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.ids = itertools.count(1)
+        # what snapshot hands out, and whether the dict has changed since it was built
+        self.cached = ()
+        self.stale = False
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    def __contains__(self, client) -> bool:
+        return self.clients.get(client.client_id) is client
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def add(self, client) -> int:
+        """register a client and give it its id."""
+        with self.lock:
+            client_id = next(self.ids)
+            client.client_id = client_id
+            self.clients[client_id] = client
+            self.stale = True
+        return client_id
+
+    def remove(self, client) -> bool:
+        """
+        take a client out.
+
+        Returns:
+            true if it was still registered, so only one of several threads
+            noticing it's gone does the cleanup
+        """
+        with self.lock:
+            if self.clients.get(client.client_id) is not client:
+                return False
+            del self.clients[client.client_id]
+            self.stale = True
+            return True
+
+    def get(self, client_id: int):
+        return self.clients.get(client_id)
+
+    def snapshot(self) -> tuple:
+        """every client right now, as a tuple nobody changes."""
+        if not self.stale:
+            return self.cached
+        with self.lock:
+            if self.stale:
+                self.cached = tuple(self.clients.values())
+                self.stale = False
+            return self.cached
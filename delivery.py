@@ -0,0 +1,271 @@
+import struct
+import threading
+from collections import OrderedDict, deque
+from common import FRAME_HEADER, FRAME_RECEIPT, FRAME_RESUME, TRACE_HEADER, encode_frame
+from history import HISTORY_LIMIT
+from tracing import Trace, is_traced
+from rooms import decode_room_seq, is_room_message
+
+# server to client once a message it sent is in: the message's trace id, which
+# is its idempotency key, and the sequence number it was given
+RECEIPT = struct.Struct('!QQ')
+# client to server after reconnecting: send me the messages after this sequence
+# number. server to client once they've all been sent: the sequence number of
+# the last one and how many there were
+RESUME = struct.Struct('!QI')
+# how many recent message ids a server remembers to drop resends with
+DEFAULT_DELIVERED_IDS = 10000
+# how many recent message ids a client remembers to drop messages it has already shown
+DEFAULT_SEEN_MESSAGES = 1000
+# how many sent messages a client keeps to resend until the server has them
+DEFAULT_MAX_UNACKED = 1000
+
+
+def encode_receipt(key: int, seq: int) -> bytes:
+    return encode_frame(FRAME_RECEIPT, RECEIPT.pack(key, seq))
+
+
+def decode_receipt(payload: bytes):
+    """
+    split a FRAME_RECEIPT payload up.
+
+    Returns:
+        a (key, seq) tuple
+    """
+    return RECEIPT.unpack_from(payload)
+
+
+def encode_resume(seq: int, count: int = 0) -> bytes:
+    """build a FRAME_RESUME request, or the reply that ends a resume."""
+    return encode_frame(FRAME_RESUME, RESUME.pack(seq, count))
+
+
+def decode_resume(payload: bytes):
+    """
+    split a FRAME_RESUME payload up.
+
+    Returns:
+        a (seq, count) tuple
+    """
+    return RESUME.unpack_from(payload)
+
+
+def trace_of(frame) -> Trace:
+    """the trace header of an encoded FRAME_TRACED frame."""
+    return Trace(*TRACE_HEADER.unpack_from(frame, FRAME_HEADER.size))
+
+
+def receipt_for(frame) -> bytes:
+    """the receipt for a traced frame that has been given its sequence number."""
+    trace = trace_of(frame)
+    return encode_receipt(trace.trace_id, trace.seq)
+
+
+def seq_of(frame) -> int:
+    """the sequence number a server gave a traced or room message, 0 for a frame it doesn't number."""
+    if is_traced(frame):
+        return trace_of(frame).seq
+    if is_room_message(frame):
+        return decode_room_seq(memoryview(frame)[FRAME_HEADER.size:])
+    return 0
+
+
+def last_seq_logged(frames) -> int:
+    """
+    the sequence number the newest of a run of logged messages was given.
+
+    a plain chat message carries no number, but it was given one, so every
+    one logged after the last numbered message adds one to it.
+
+    Args:
+        frames: logged messages, oldest first
+    """
+    last, after = 0, 0
+    for frame in frames:
+        seq = seq_of(frame)
+        if seq:
+            last, after = seq, 0
+        else:
+            after += 1
+    return last + after
+
+
+def frames_after(frames, seq: int, limit: int = HISTORY_LIMIT) -> list:
+    """
+    the traced and room messages numbered after seq, for a client resuming from it.
+
+    Args:
+        frames: a server's recent messages, oldest first
+        seq: the last sequence number the client was delivered
+        limit: the most frames to return, the oldest ones are kept
+
+    Returns:
+        up to limit frames, oldest first
+    """
+    after = [frame for frame in frames if seq_of(frame) > seq]
+    return after[:limit]
+
+
+class DeliveredIds:
+    """
+    the recent messages a server has taken in, by idempotency key.
+
+    a client that loses its connection resends whatever it has no receipt
+    for, possibly to a backup that has since taken over. the key of every
+    message, from clients or replicated from the primary, stays here for
+    the last max_ids messages, so a resend is answered with the original's
+    receipt instead of going out twice.
+    """
+
+    def __init__(self, max_ids: int = DEFAULT_DELIVERED_IDS):
+        self.max_ids = max_ids
+        self.lock = threading.Lock()
+        # key to sequence number, 0 while the first copy is still on its way through
+        self.ids = OrderedDict()
+
+    def claim(self, key: int):
+        """
+        take in a message unless it's a resend.
+
+        Returns:
+            None if the key is new and now ours, otherwise the sequence number
+            the first copy was given, 0 if it hasn't been given one yet
+        """
+        with self.lock:
+            seq = self.ids.get(key)
+            if seq is not None:
+                return seq
+            self.add(key, 0)
+        return None
+
+    def record(self, key: int, seq: int) -> None:
+        """remember the sequence number a message was given."""
+        with self.lock:
+            self.add(key, seq)
+
+    def add(self, key: int, seq: int) -> None:
+        # called with the lock held
+        self.ids[key] = seq
+        self.ids.move_to_end(key)
+        if len(self.ids) > self.max_ids:
+            self.ids.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+class ClientSession:
+    """
+    what a client keeps across reconnects so a failover neither loses nor repeats messages.
+
+    last_seq is the newest sequence number we were delivered, a reconnect
+    asks for what came after it. seen holds the trace ids of recent
+    messages, ours included, so one that arrives again through the replay
+    or a resume isn't shown twice. unacked holds what we sent that no
+    receipt has come back for, to be resent with the same trace id.
+    """
+
+    def __init__(self, seen_messages: int = DEFAULT_SEEN_MESSAGES, max_unacked: int = DEFAULT_MAX_UNACKED):
+        self.max_unacked = max_unacked
+        self.lock = threading.Lock()
+        self.last_seq = 0
+        self.seen = set()
+        self.seen_order = deque()
+        self.seen_messages = seen_messages
+        # trace id to the frame we sent, oldest first
+        self.unacked = OrderedDict()
+
+    def sending(self, frame: bytes) -> bytes:
+        """keep a traced frame we're about to send until its receipt comes back, returns the frame."""
+        key = trace_of(frame).trace_id
+        with self.lock:
+            self.remember(key)
+            self.unacked[key] = frame
+            if len(self.unacked) > self.max_unacked:
+                self.unacked.popitem(last=False)
+        return frame
+
+    def receipt(self, payload: bytes) -> None:
+        """the server has a message we sent, stop keeping it."""
+        key, _ = decode_receipt(payload)
+        with self.lock:
+            self.unacked.pop(key, None)
+
+    def delivered(self, trace: Trace) -> bool:
+        """
+        note a traced message that reached us.
+
+        Returns:
+            true if it's new, false if we've already shown it
+        """
+        with self.lock:
+            if trace.seq > self.last_seq:
+                self.last_seq = trace.seq
+            if trace.trace_id in self.seen:
+                return False
+            self.remember(trace.trace_id)
+        return True
+
+    def numbered(self, seq: int) -> None:
+        """note the number of an untraced message that reached us, a room message, so a resume carries on after it."""
+        with self.lock:
+            if seq > self.last_seq:
+                self.last_seq = seq
+
+    def remember(self, key: int) -> None:
+        # called with the lock held
+        self.seen.add(key)
+        self.seen_order.append(key)
+        if len(self.seen_order) > self.seen_messages:
+            self.seen.discard(self.seen_order.popleft())
+
+    def unacked_frames(self) -> list:
+        """everything we sent that no receipt has come back for, oldest first, to send again."""
+        with self.lock:
+            return list(self.unacked.values())
+
+    def reconnect_frames(self) -> list:
+        """what to send a server straight after reconnecting: the resume request, then every unacked message."""
+        with self.lock:
+            frames = [encode_resume(self.last_seq)] if self.last_seq else []
+            return frames + list(self.unacked.values())
+
+
+class Endpoints:
+    """
+    the servers a client can reach, in the order it tries them.
+
+    the first is normally the primary and the rest its backups. a server
+    that announces it's the primary now moves to the front.
+    """
+
+    def __init__(self, addresses):
+        self.addresses = list(addresses)
+        self.index = 0
+
+    def current(self) -> tuple:
+        return self.addresses[self.index]
+
+    def advance(self) -> tuple:
+        """move on to the next server, round to the first after the last."""
+        self.index = (self.index + 1) % len(self.addresses)
+        return self.current()
+
+    def prefer(self, address: tuple) -> None:
+        """make address the first one tried, and the one we're on."""
+        if address in self.addresses:
+            self.addresses.remove(address)
+        self.addresses.insert(0, address)
+        self.index = 0
+
+    def ordered(self) -> list:
+        """every server, the one we're on first and the rest in the order they'd be tried."""
+        return self.addresses[self.index:] + self.addresses[:self.index]
+
+    def use(self, address: tuple) -> None:
+        """note that we're on address now, whichever one of ours it is."""
+        if address in self.addresses:
+            self.index = self.addresses.index(address)
+
+    def __len__(self) -> int:
+        return len(self.addresses)
@@ -0,0 +1,119 @@
+import math
+import threading
+import time
+from collections import deque
+from statistics import fmean, pstdev
+from common import HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT
+
+# how suspicious the backup has to get before it calls the primary dead. phi is
+# -log10 of the chance that the primary is alive and only quiet, so at 8 we'd be
+# wrong about one silence in 10^8
+DEFAULT_PHI_THRESHOLD = 8.0
+# silence on top of what the intervals so far lead us to expect that we put up
+# with anyway, for pauses the history doesn't show yet
+DEFAULT_ACCEPTABLE_PAUSE = 0.5  # seconds
+# how many of the latest intervals between frames the detector judges by
+DEFAULT_WINDOW = 100
+# the least spread we assume intervals have, so a very regular link doesn't make us jumpy
+MIN_STD_DEVIATION = 0.1  # seconds
+# how many intervals we want before trusting phi, until then it's HEARTBEAT_TIMEOUT missed heartbeats
+MIN_SAMPLES = 5
+# how often the backup's monitoring loop asks the detector about the primary
+CHECK_INTERVAL = 0.1  # seconds
+
+
+def phi(elapsed: float, mean: float, std_deviation: float) -> float:
+    """
+    how suspicious a silence is, for frames that arrive normally distributed.
+
+    uses the logistic approximation of the normal tail from akka's phi accrual
+    detector, worked out in log space so it stays finite however long the
+    silence gets.
+
+    Args:
+        elapsed: seconds since the last frame arrived
+        mean: seconds we expect between frames
+        std_deviation: how much that varies
+
+    Returns:
+        -log10 of the chance a frame is still coming, 0 for no suspicion at all
+    """
+    y = (elapsed - mean) / std_deviation
+    z = y * (1.5976 + 0.070566 * y * y)
+    if z > 0:
+        return (z + math.log1p(math.exp(-z))) / math.log(10)
+    return math.log1p(math.exp(z)) / math.log(10)
+
+
+class PhiAccrualDetector:
+    """
+    decides when a peer that has gone quiet is dead, from how it usually behaves.
+
+    every frame from the peer counts as a sign of life, not just heartbeats,
+    and the detector keeps the recent intervals between them. instead of a
+    fixed timeout it works out phi for the current silence from their mean
+    and spread: a link that has been steady is given up on soon after it
+    goes quiet, one whose frames have been arriving late and unevenly, like
+    a primary under a load spike, gets longer before we fail over.
+
+    the sender only sends a heartbeat once it has had nothing else to send
+    for expected_interval, so the mean is never taken as less than that,
+    however fast data was flowing before the link went quiet.
+    """
+
+    def __init__(self, expected_interval: float = HEARTBEAT_INTERVAL, threshold: float = DEFAULT_PHI_THRESHOLD,
+                 acceptable_pause: float = DEFAULT_ACCEPTABLE_PAUSE, window: int = DEFAULT_WINDOW,
+                 missed_heartbeats: int = HEARTBEAT_TIMEOUT):
+        self.expected_interval = expected_interval
+        self.threshold = threshold
+        self.acceptable_pause = acceptable_pause
+        self.missed_heartbeats = missed_heartbeats
+        self.lock = threading.Lock()
+        self.intervals = deque(maxlen=window)
+        # monotonic time the last frame arrived, None until the peer first connects
+        self.last_arrival = None
+
+    def reset(self, now: float = None) -> None:
+        """the peer has just connected, the silence starts now. the intervals we had are kept."""
+        with self.lock:
+            self.last_arrival = time.monotonic() if now is None else now
+
+    def heartbeat(self, now: float = None):
+        """
+        note that a frame arrived from the peer.
+
+        Returns:
+            the seconds since the one before, None if it's the first
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            interval = None
+            if self.last_arrival is not None:
+                interval = now - self.last_arrival
+                self.intervals.append(interval)
+            self.last_arrival = now
+        return interval
+
+    def silence(self, now: float = None) -> float:
+        """seconds since the last frame arrived, 0 if the peer never connected."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return 0.0 if self.last_arrival is None else now - self.last_arrival
+
+    def phi(self, now: float = None) -> float:
+        """how suspicious the current silence is, infinite once it's certainly too long."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.last_arrival is None:
+                return 0.0
+            elapsed = now - self.last_arrival
+            intervals = list(self.intervals)
+        if len(intervals) < MIN_SAMPLES:
+            # too little to go on yet, fall back to a fixed number of missed heartbeats
+            return math.inf if elapsed > self.missed_heartbeats * self.expected_interval else 0.0
+        mean = max(fmean(intervals), self.expected_interval) + self.acceptable_pause
+        return phi(elapsed, mean, max(pstdev(intervals), MIN_STD_DEVIATION))
+
+    def suspects(self, now: float = None) -> bool:
+        """whether the peer has been quiet for long enough to give up on."""
+        return self.phi(now) >= self.threshold
@@ -0,0 +1,102 @@
+import socket
+import struct
+from collections import namedtuple
+from common import FRAME_HEADER, FRAME_HELLO, ProtocolError, encode_frame, get_reader
+
+# what a connection says it is in its hello
+ROLE_CLIENT = 1
+ROLE_PEER = 2  # a server that wants to replicate to us, or that answers our hello as our backup
+ROLES = (ROLE_CLIENT, ROLE_PEER)
+# a FRAME_HELLO payload is the role and the epoch, then the node id. the epoch
+# goes up by one every time a backup takes over, so a server can tell an old
+# primary from the one that replaced it
+HELLO = struct.Struct('!BQ')
+# how long a new connection has to say hello before we take it for a client
+# that doesn't, nothing is ever taken for a peer without one
+HELLO_WAIT = 0.5  # seconds
+# the hosts a backup takes a primary's hello from unless it's told others, its own machine.
+# anyone else saying it's a primary could take the backup over with a big enough epoch
+DEFAULT_PEERS = ("127.0.0.1",)
+
+Hello = namedtuple('Hello', ['role', 'epoch', 'node_id'])
+
+
+def encode_hello(role: int, epoch: int, node_id: str) -> bytes:
+    return encode_frame(FRAME_HELLO, HELLO.pack(role, epoch) + node_id.encode('utf-8'))
+
+
+def decode_hello(payload: bytes) -> Hello:
+    """
+    split a FRAME_HELLO payload up.
+
+    Returns:
+        a Hello
+
+    Raises:
+        ProtocolError: if it's too short or the role is one we don't know
+    """
+    if len(payload) < HELLO.size:
+        raise ProtocolError("hello is too short")
+    role, epoch = HELLO.unpack_from(payload)
+    if role not in ROLES:
+        raise ProtocolError(f"unknown role {role} in hello")
+    return Hello(role, epoch, bytes(payload[HELLO.size:]).decode('utf-8'))
+
+
+def default_node_id(port: int) -> str:
+    """a node id for a server that wasn't given one, its host name and port."""
+    return f"{socket.gethostname()}:{port}"
+
+
+def resolve_peers(hosts) -> frozenset:
+    """
+    the addresses a primary may connect to a backup from.
+
+    host names are looked up once, here, so a peer is checked against the
+    address it connected from and not against whatever DNS says later.
+
+    Args:
+        hosts: host names or IPv4 addresses
+
+    Returns:
+        every IPv4 address they stand for
+
+    Raises:
+        OSError: if a name doesn't resolve
+    """
+    addresses = set()
+    for host in hosts:
+        addresses.update(socket.gethostbyname_ex(host)[2])
+    return frozenset(addresses)
+
+
+def read_hello(sock: socket.socket, wait: float = HELLO_WAIT):
+    """
+    see whether a new connection starts with a hello, without taking anything else off it.
+
+    waits up to wait seconds for the first frame's header. anything that
+    isn't a hello is left where it is for whoever reads the connection next.
+
+    Args:
+        sock: a blocking socket that nothing has read from yet
+        wait: how long to give it
+
+    Returns:
+        the Hello it sent, or None if it sent something else first or nothing in time
+
+    Raises:
+        ProtocolError: if it sent a hello we can't make sense of
+    """
+    sock.settimeout(wait)
+    try:
+        header = sock.recv(FRAME_HEADER.size, socket.MSG_PEEK | getattr(socket, 'MSG_WAITALL', 0))
+    except socket.timeout:
+        return None
+    finally:
+        sock.settimeout(None)
+    if len(header) < FRAME_HEADER.size or header[-1] != FRAME_HELLO:
+        return None
+    frame = get_reader(sock).read_frame()
+    if frame is None:
+        return None
+    return decode_hello(frame[1])
@@ -0,0 +1,292 @@
+import bisect
+import mmap
+import os
+import struct
+from common import FRAME_HISTORY, encode_frame
+from wal import (
+    DEFAULT_INDEX_BYTES, RECORD_HEADER, segment_name, index_name, list_segments, read_index, parse_records
+)
+
+# the most messages one history request gets back, so a reply always fits in a client's queue
+HISTORY_LIMIT = 256
+
+# how many recent messages, and how many bytes of them, every server keeps in memory
+DEFAULT_HISTORY_MESSAGES = 1000
+DEFAULT_HISTORY_BYTES = 1024 * 1024
+# how many of those a client that has just connected is sent
+DEFAULT_REPLAY_MESSAGES = 50
+
+# client to server: send me messages after this sequence number, or from this
+# time on if it isn't 0, at most this many. server to client once they've all
+# been sent: the sequence number and time of the last one and how many there were
+HISTORY_REQUEST = struct.Struct('!QdI')
+
+
+def encode_history(seq: int, timestamp: float = 0.0, count: int = 0) -> bytes:
+    """build a FRAME_HISTORY request, or the reply that ends a replay."""
+    return encode_frame(FRAME_HISTORY, HISTORY_REQUEST.pack(seq, timestamp, count))
+
+
+def decode_history(payload: bytes):
+    """
+    split a FRAME_HISTORY payload up.
+
+    Returns:
+        a (seq, timestamp, count) tuple
+    """
+    return HISTORY_REQUEST.unpack_from(payload)
+
+
+class HistoryRing:
+    """
+    the most recent frames, limited by count and by bytes.
+
+    the slots are allocated once and reused, so memory stays flat however long
+    the server runs: at most max_messages references and max_bytes of frames.
+    not thread safe, callers hold their own lock.
+    """
+
+    def __init__(self, max_messages: int = DEFAULT_HISTORY_MESSAGES,
+                 max_bytes: int = DEFAULT_HISTORY_BYTES):
+        self.slots = [None] * max_messages
+        self.max_bytes = max_bytes
+        # index of the oldest frame, how many frames there are and their total size
+        self.start = 0
+        self.count = 0
+        self.bytes = 0
+
+    def append(self, frame: bytes) -> None:
+        """add a frame, dropping the oldest ones to make room."""
+        if not self.slots or len(frame) > self.max_bytes:
+            return
+        while self.count == len(self.slots) or self.bytes + len(frame) > self.max_bytes:
+            self.pop_oldest()
+        self.slots[(self.start + self.count) % len(self.slots)] = frame
+        self.count += 1
+        self.bytes += len(frame)
+
+    def extend(self, frames) -> None:
+        for frame in frames:
+            self.append(frame)
+
+    def pop_oldest(self) -> None:
+        frame = self.slots[self.start]
+        self.slots[self.start] = None
+        self.start = (self.start + 1) % len(self.slots)
+        self.count -= 1
+        self.bytes -= len(frame)
+
+    def clear(self) -> None:
+        while self.count:
+            self.pop_oldest()
+
+    def tail(self, count: int = None) -> list:
+        """
+        the newest frames.
+
+        Args:
+            count: how many, everything we have if not given
+
+        Returns:
+            up to count frames, oldest first
+        """
+        count = self.count if count is None else min(count, self.count)
+        first = self.start + self.count - count
+        return [self.slots[(first + i) % len(self.slots)] for i in range(count)]
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class Segment:
+    """
+    read side of one write-ahead log segment.
+
+    nothing is read until the segment is first asked for something, then the
+    file is mapped read-only and its sparse index loaded. the segment the log
+    is still appending to is remapped whenever it has grown. every client
+    handler shares one, so a refresh only ever swaps in a finished mapping or
+    index, a lookup running meanwhile sees the old one or the new one whole.
+    """
+
+    def __init__(self, directory: str, first_seq: int):
+        self.first_seq = first_seq
+        self.path = os.path.join(directory, segment_name(first_seq))
+        self.index_path = os.path.join(directory, index_name(first_seq))
+        # the current mapping and how much of the file it covers
+        self.map = None
+        self.size = 0
+        # the sparse index as parallel (seqs, times, offsets) lists so we can bisect on either key
+        self.index = ([], [], [])
+        # how big the segment was when we last loaded its index
+        self.indexed_size = -1
+
+    def view(self) -> memoryview:
+        """the whole segment as written so far, without copying it."""
+        size = os.path.getsize(self.path)
+        mapping = self.map
+        if size != self.size:
+            # views handed out earlier keep the old mapping alive until they're done with it
+            with open(self.path, 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) if size else None
+            self.map = mapping
+            self.size = size
+        return memoryview(mapping) if mapping is not None else memoryview(b'')
+
+    def load_index(self, data: memoryview) -> None:
+        # the index only changes while the log is still appending to this segment
+        if self.indexed_size == len(data):
+            return
+        entries = [entry for entry in read_index(self.index_path) if entry[2] < len(data)]
+        if not entries and len(data):
+            # a segment without an index, build one in memory with a single pass
+            last = -DEFAULT_INDEX_BYTES
+            offset = 0
+            for seq, timestamp, start, _, end in parse_records(data):
+                if offset - last >= DEFAULT_INDEX_BYTES:
+                    entries.append((seq, timestamp, offset))
+                    last = offset
+                offset = end
+        self.index = ([entry[0] for entry in entries], [entry[1] for entry in entries],
+                      [entry[2] for entry in entries])
+        self.indexed_size = len(data)
+
+    def offset_for_seq(self, seq: int) -> int:
+        """offset of an indexed record at or before seq, where a scan for it can start."""
+        self.load_index(self.view())
+        seqs, _, offsets = self.index
+        return offsets[bisect.bisect_right(seqs, seq) - 1] if seqs and seq >= seqs[0] else 0
+
+    def offset_for_time(self, timestamp: float) -> int:
+        """offset of an indexed record at or before timestamp, where a scan for it can start."""
+        self.load_index(self.view())
+        _, times, offsets = self.index
+        index = bisect.bisect_left(times, timestamp) - 1
+        return offsets[index] if index >= 0 else 0
+
+    def release(self) -> None:
+        """let go of the mapping, it's unmapped once the last frame handed out from it has been sent."""
+        self.map = None
+        self.size = 0
+        self.index = ([], [], [])
+        self.indexed_size = -1
+
+    def first_time(self):
+        """timestamp of the segment's first record, None if it has none yet."""
+        try:
+            data = self.view()
+        except FileNotFoundError:
+            return None
+        if len(data) < RECORD_HEADER.size:
+            return None
+        return RECORD_HEADER.unpack_from(data)[1]
+
+    def records(self, offset: int = 0):
+        """
+        walk the records from offset on.
+
+        Returns:
+            a generator of (seq, timestamp, frame) tuples, frame is a memoryview into the mapping
+        """
+        data = self.view()
+        for seq, timestamp, start, length, _ in parse_records(data, offset):
+            yield seq, timestamp, data[start:start + length]
+
+
+class HistoryReader:
+    """
+    answers "messages since seq X" and "messages since time T" from the write-ahead log.
+
+    finds the right segment by its name or first timestamp, the right spot
+    in it with the sparse index, then scans forward from there. frames come
+    back as slices of the mapped segment, ready to hand to sendmsg as they are.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        # segments we've opened, keyed by their first sequence number
+        self.segments = {}
+
+    def list_segments(self) -> list:
+        # the segments on disk now, forgetting any we had open that have since been deleted
+        firsts = list_segments(self.directory)
+        on_disk = set(firsts)
+        for first in list(self.segments):
+            if first not in on_disk:
+                segment = self.segments.pop(first, None)
+                if segment is not None:
+                    segment.release()
+        return firsts
+
+    def segment(self, first_seq: int) -> Segment:
+        segment = self.segments.get(first_seq)
+        if segment is None:
+            segment = self.segments[first_seq] = Segment(self.directory, first_seq)
+        return segment
+
+    def since_seq(self, seq: int, limit: int = HISTORY_LIMIT) -> list:
+        """
+        the oldest messages after seq.
+
+        Returns:
+            up to limit (seq, timestamp, frame) tuples, oldest first
+        """
+        firsts = self.list_segments()
+        start = max(bisect.bisect_right(firsts, seq + 1) - 1, 0)
+        return self.collect(firsts[start:], lambda segment: segment.offset_for_seq(seq + 1),
+                            lambda record: record[0] > seq, limit)
+
+    def since_time(self, timestamp: float, limit: int = HISTORY_LIMIT) -> list:
+        """
+        the oldest messages from timestamp on.
+
+        Returns:
+            up to limit (seq, timestamp, frame) tuples, oldest first
+        """
+        firsts = self.list_segments()
+        # binary search on the segments' first timestamps, only touching the ones we land on
+        low, high = 0, len(firsts)
+        while low < high:
+            middle = (low + high) // 2
+            first_time = self.segment(firsts[middle]).first_time()
+            if first_time is not None and first_time < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        start = max(low - 1, 0)
+        return self.collect(firsts[start:], lambda segment: segment.offset_for_time(timestamp),
+                            lambda record: record[1] >= timestamp, limit)
+
+    def collect(self, firsts: list, find_offset, wanted, limit: int) -> list:
+        # scan forward from the indexed spot in the first segment and the start of the rest
+        records = []
+        for position, first in enumerate(firsts):
+            segment = self.segment(first)
+            try:
+                offset = find_offset(segment) if position == 0 else 0
+                for record in segment.records(offset):
+                    if wanted(record):
+                        records.append(record)
+                        if len(records) >= limit:
+                            return records
+            except FileNotFoundError:
+                # deleted since we listed it, the next request forgets it
+                continue
+        return records
+
+    def frames(self, payload: bytes) -> list:
+        """
+        answer a FRAME_HISTORY request.
+
+        Returns:
+            the requested frames followed by the FRAME_HISTORY reply that ends them
+        """
+        seq, timestamp, limit = decode_history(payload)
+        limit = min(limit or HISTORY_LIMIT, HISTORY_LIMIT)
+        if timestamp:
+            records = self.since_time(timestamp, limit)
+        else:
+            records = self.since_seq(seq, limit)
+        if records:
+            seq, timestamp = records[-1][0], records[-1][1]
+        return [frame for _, _, frame in records] + [encode_history(seq, timestamp, len(records))]
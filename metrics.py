@@ -0,0 +1,260 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# where the stats endpoint listens, only this machine by default
+DEFAULT_STATS_HOST = '127.0.0.1'
+# upper bounds in seconds for latency histograms, 50us up to 10s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# upper bounds in seconds for the gap between heartbeats, which should sit around the send interval
+HEARTBEAT_BUCKETS = (0.5, 0.9, 0.95, 1.0, 1.05, 1.1, 1.25, 1.5, 2.0, 3.0, 5.0)
+
+
+def format_value(value) -> str:
+    # the text format wants +Inf rather than python's inf, and ints without a trailing .0
+    if value == float('inf'):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_label(value) -> str:
+    # a (host, port) address reads as host:port, and the text format escapes backslashes, quotes and newlines
+    if isinstance(value, tuple):
+        value = f"{value[0]}:{value[1]}"
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    """a value that only goes up, like messages received."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        yield self.name, self.value
+
+
+class Gauge:
+    """
+    a value that goes up and down, like connected clients.
+
+    with a function the value is read from it on every scrape instead, so
+    nothing on the hot path has to keep it up to date.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value) -> None:
+        self.value = value
+
+    def inc(self, amount=1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1) -> None:
+        self.inc(-amount)
+
+    def samples(self):
+        yield self.name, self.function() if self.function is not None else self.value
+
+
+class LabelledGauge(Gauge):
+    """
+    a gauge with one sample per label value, like each client's queue depth.
+
+    the function returns a dict from label value to value and is read on
+    every scrape, so a label value that's gone simply stops showing up.
+    """
+
+    def __init__(self, name: str, help: str, label: str, function):
+        super().__init__(name, help, function)
+        self.label = label
+
+    def samples(self):
+        for key, value in self.function().items():
+            yield f'{self.name}{{{self.label}="{format_label(key)}"}}', value
+
+
+class Histogram:
+    """counts observations into fixed buckets, like how long each fan out took."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = tuple(buckets)
+        # one count per bucket plus one for everything above the last bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        # the text format wants cumulative buckets
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{format_value(bound)}"}}', cumulative
+        yield f"{self.name}_sum", total
+        yield f"{self.name}_count", cumulative
+
+
+class NullMetric:
+    """stands in for every metric when metrics are off, so updating one costs a call that does nothing."""
+
+    def inc(self, amount=1) -> None:
+        pass
+
+    def dec(self, amount=1) -> None:
+        pass
+
+    def set(self, value) -> None:
+        pass
+
+    def observe(self, value) -> None:
+        pass
+
+
+NULL_METRIC = NullMetric()
+
+
+class Metrics:
+    """
+    the metrics one process keeps, rendered in the prometheus text format.
+
+    when disabled every metric handed out is the shared NullMetric, so code
+    can update metrics unconditionally and pay next to nothing for it.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.metrics = []
+        # the stats endpoint, once serve has started it
+        self.server = None
+
+    def add(self, metric):
+        if not self.enabled:
+            return NULL_METRIC
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name: str, help: str, function=None):
+        return self.add(Gauge(name, help, function))
+
+    def labelled_gauge(self, name: str, help: str, label: str, function):
+        return self.add(LabelledGauge(name, help, label, function))
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        """every metric in the prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                # a gauge whose function failed shouldn't take the whole scrape down with it
+                print(f"Error reading metric {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, value in samples:
+                lines.append(f"{name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = DEFAULT_STATS_HOST) -> None:
+        """answer GET requests with the current metrics on a background thread."""
+        if not self.enabled or self.server is not None:
+            return
+        metrics = self
+
+        class StatsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # scrapes come every few seconds, don't fill the server's output with them
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), StatsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class ServerMetrics(Metrics):
+    """the metrics every chat server keeps, whichever role and engine it runs."""
+
+    def __init__(self, enabled: bool = True):
+        super().__init__(enabled)
+        self.messages_in = self.counter("chat_messages_received_total", "chat messages received from clients")
+        self.bytes_in = self.counter("chat_received_bytes_total", "bytes of chat frames received from clients")
+        self.messages_out = self.counter("chat_messages_sent_total", "chat frames queued for clients")
+        self.bytes_out = self.counter("chat_sent_bytes_total", "bytes of chat frames queued for clients")
+        self.fanout_seconds = self.histogram("chat_fanout_seconds",
+                                             "time to queue one message for every client")
+        self.heartbeats_sent = self.counter("chat_heartbeats_sent_total", "heartbeats sent to the backup")
+        self.heartbeat_interval = self.histogram("chat_heartbeat_interval_seconds",
+                                                 "how long the primary's link was quiet before each heartbeat arrived",
+                                                 HEARTBEAT_BUCKETS)
+
+    def watch(self, server) -> None:
+        """add the gauges that are read off the server itself on every scrape."""
+        self.gauge("chat_connected_clients", "clients connected right now", lambda: len(server.clients))
+        self.gauge("chat_client_queue_frames", "frames waiting in every client's outbound queue",
+                   lambda: sum(server.queue_depths().values()))
+        self.gauge("chat_client_queue_frames_max", "frames waiting for the furthest behind client",
+                   lambda: max(server.queue_depths().values(), default=0))
+        self.labelled_gauge("chat_client_queue_depth", "frames waiting in each client's outbound queue",
+                            "client", server.queue_depths)
+        log = getattr(server, 'replication_log', None)
+        if log is not None:
+            self.gauge("chat_replication_lag_entries", "entries the backup hasn't acked yet",
+                       lambda: log.lag()["entries"])
+            self.gauge("chat_replication_lag_seconds", "age of the oldest entry the backup hasn't acked",
+                       lambda: log.lag()["seconds"])
+            self.gauge("chat_replication_ack_latency_seconds", "how long the backup took to ack most recently",
+                       lambda: log.lag()["ack_latency"])
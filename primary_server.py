@@ -1,161 +1,267 @@
+import argparse
 import socket
 import threading
-import time
-import json
-from common import PRIMARY_PORT, BACKUP_PORT, send_message, receive_message
-
-class PrimaryServer:
-    def __init__(self):
-        # keep track of all connected clients
-        self.clients = []
-        # flag to control the server's main loop
-        self.is_running = True
-        # flag to track if we're connected to the backup server
-        self.backup_connected = False
-        # socket for talking to the backup server
-        self.backup_socket = None
-        # thread that handles backup server connection
-        self.backup_thread = None
+from common import (
+    PRIMARY_PORT, BACKUP_PORT, FRAME_HEADER, FRAME_CONTROL, HEARTBEAT_INTERVAL, encode_message, parse_address
+)
+from connection import (
+    POLICIES, POLICY_DROP_OLDEST, DEFAULT_MAX_FRAMES, DEFAULT_MAX_BYTES, DEFAULT_FLUSH_DELAY, DEFAULT_FLUSH_BYTES
+)
+from replication import MODES, MODE_ASYNC, DEFAULT_ACK_TIMEOUT
+from history import HistoryReader, DEFAULT_HISTORY_MESSAGES, DEFAULT_HISTORY_BYTES, DEFAULT_REPLAY_MESSAGES
+from bus import (
+    BusLink, ClaimTable, PendingClaim, CLAIM, RELEASE, CLAIM_USER, CLAIM_MEMBER, encode_claim, is_claim_frame
+)
+from server_core import ThreadedServer
+from rooms import decode_room
+from tracing import sequenced
+from users import decode_direct, is_direct_message
+from profiling import (
+    profiler, install_signal_handler, DEFAULT_PROFILE_DIR, DEFAULT_DUMP_INTERVAL, DEFAULT_TOP_BROADCASTS
+)
+from wal import DURABILITIES, DURABILITY_INTERVAL, DURABILITY_BATCH, DEFAULT_COMMIT_INTERVAL, DEFAULT_SYNC_INTERVAL
+
+class PrimaryServer(ThreadedServer):
+    def __init__(self, port=PRIMARY_PORT, backup_address=('127.0.0.1', BACKUP_PORT), bus_path=None, worker_id=0,
+                 **options):
+        super().__init__(port, backup_address=backup_address, **options)
+        # when we're one of several worker processes, the hub that orders every
+        # worker's broadcasts and our id, worker 0 is the one that logs and replicates
+        self.bus_path = bus_path
+        self.worker_id = worker_id
+        # who holds which username and member id on every worker, in the hub's order
+        self.claims = ClaimTable()
 
     def start(self):
-        # create a socket to listen for connections
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # allow reusing the port if it's still in use
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # bind to all network interfaces on our port
-        server_socket.bind(('0.0.0.0', PRIMARY_PORT))
-        # start listening for connections
-        server_socket.listen(5)
-        print(f"Primary server listening on port {PRIMARY_PORT}")
-
-        # start a thread to connect to the backup server
-        self.backup_thread = threading.Thread(target=self.connect_to_backup, daemon=True)
-        self.backup_thread.start()
-
-        # main loop to accept new connections
-        while self.is_running:
-            try:
-                # wait for a new connection
-                client_socket, address = server_socket.accept()
-                print(f"New connection from {address}")
-                
-                # check if this is the backup server trying to connect
-                if address[0] == '127.0.0.1' and not self.backup_connected:
-                    self.backup_socket = client_socket
-                    self.backup_connected = True
-                    print("Backup server connected")
-                    continue
-                
-                # add the new client to our list
-                self.clients.append(client_socket)
-                
-                # start a thread to handle this client's messages
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, address),
-                    daemon=True
-                )
-                client_thread.start()
-                
-            except Exception as e:
-                if self.is_running:
-                    print(f"Error accepting connection: {e}")
+        # every worker listens on the same port when there are several
+        self.server_socket = self.listen(self.port, reuse_port=self.bus_path is not None)
+        print(f"Primary server listening on port {self.port}")
 
-    def connect_to_backup(self):
-        # keep trying to connect to the backup server
-        while self.is_running and not self.backup_connected:
-            try:
-                # create a socket to connect to the backup
-                backup_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                backup_socket.connect(('127.0.0.1', BACKUP_PORT))
-                self.backup_socket = backup_socket
-                self.backup_connected = True
-                print("Connected to backup server")
-                
-                # start sending heartbeat messages to the backup
-                heartbeat_thread = threading.Thread(target=self.send_heartbeat, daemon=True)
-                heartbeat_thread.start()
-                
-            except Exception as e:
-                print(f"Failed to connect to backup server: {e}")
-                time.sleep(1)
-
-    def send_heartbeat(self):
-        # keep sending heartbeat messages to the backup
-        while self.is_running and self.backup_connected:
-            try:
-                send_message(self.backup_socket, "HEARTBEAT")
-                time.sleep(1)
-            except:
-                self.backup_connected = False
-                print("Lost connection to backup server")
-                break
+        # start logging messages to disk if we were given somewhere to put them
+        self.open_wal()
+
+        if self.stats_port is not None:
+            self.metrics.serve(self.stats_port)
+
+        if self.bus_path:
+            self.join_bus()
+
+        # start a thread to connect to the backup server, only one worker talks to it
+        if self.worker_id == 0:
+            threading.Thread(target=self.connect_to_backup, daemon=True).start()
+
+        self.accept_clients(self.server_socket)
+
+    def open_wal(self):
+        if self.worker_id != 0:
+            # worker 0 writes the log, the others can still serve history out of it
+            if self.wal_options is not None and self.history_reader is None:
+                self.history_reader = HistoryReader(self.wal_options['directory'])
+            return
+        if self.wal is not None:
+            return
+        super().open_wal()
+        if self.wal is not None:
+            # after a restart carry on numbering from what we logged before it, a client
+            # resuming across the restart would get nothing and our numbers would repeat
+            seq = self.recover_log()
+            with self.history_lock:
+                self.replication_log.restart(self.history.tail() + self.room_history.tail(), seq)
+
+    def replicate(self, frame):
+        if self.bus is None:
+            return super().replicate(frame)
+        # the hub numbered the frame read_bus is delivering, every worker uses its number
+        seq = self.bus.seq
+        if self.worker_id != 0:
+            # only worker 0 keeps the log
+            return seq, sequenced(frame, seq), False
+        return super().replicate(frame, seq)
+
+    def join_bus(self):
+        # connect to the hub and fan out everything it sends us, in its order. the hub's
+        # numbering carries on from our log, worker 0's is the only one that has anything in it
+        self.bus = BusLink(self.bus_path, self.worker_id, self.replication_log.last_seq)
+        bus_thread = threading.Thread(target=self.read_bus, daemon=True)
+        bus_thread.start()
+        print(f"Worker {self.worker_id} joined the fan-out hub")
 
-    def handle_client(self, client_socket, address):
-        # handle messages from a single client
+    def read_bus(self):
+        # every worker's broadcasts, ours included, come back from the hub in one order
         while self.is_running:
             try:
-                # get a message from the client
-                message = receive_message(client_socket)
-                if not message:
-                    break
-                    
-                # send the message to all other clients
-                self.broadcast(message, client_socket)
-                
-            except Exception as e:
-                print(f"Error handling client {address}: {e}")
+                item = self.bus.receive()
+            except Exception:
+                item = None
+            if item is None:
+                if self.is_running:
+                    print("Lost connection to the fan-out hub")
                 break
-                
-        # clean up when the client disconnects
-        if client_socket in self.clients:
-            self.clients.remove(client_socket)
-        client_socket.close()
-        print(f"Client {address} disconnected")
-
-    def broadcast(self, message, sender_socket):
-        # send the message to the backup server if it's connected
-        if self.backup_connected:
-            try:
-                send_message(self.backup_socket, message)
-            except:
-                self.backup_connected = False
-                print("Lost connection to backup server")
-        
-        # send the message to all clients except the sender
-        disconnected_clients = []
-        for client in self.clients:
-            if client != sender_socket:  # don't send the message back to the sender
-                try:
-                    send_message(client, message)
-                except:
-                    disconnected_clients.append(client)
+            frame, sender = item
+            if is_claim_frame(frame):
+                # every worker applies the claim, the one that made it wakes its client up
+                won = self.claims.apply_frame(frame)
+                if sender is not None:
+                    sender.settle(won)
+                continue
+            self.deliver(frame, sender)
+
+    def broadcast_frame(self, frame, sender):
+        # with several workers the hub decides the order, we deliver it when it comes back
+        if self.bus is not None:
+            self.bus.publish(frame, sender)
+            return
         
-        # remove any clients that disconnected while we were sending
-        for client in disconnected_clients:
-            if client in self.clients:
-                self.clients.remove(client)
-                client.close()
+        self.deliver(frame, sender)
+
+    def claim(self, kind, name, connection):
+        # each worker only knows its own connections, so a name goes round the hub and
+        # whichever claim it hands out first, from any worker, gets it
+        token = id(connection)
+        if self.claims.holds(kind, name, self.worker_id, token):
+            return True
+        pending = PendingClaim()
+        self.bus.publish(encode_claim(CLAIM, kind, name, self.worker_id, token), pending)
+        return pending.wait()
+
+    def release(self, kind, name, connection):
+        self.bus.publish(encode_claim(RELEASE, kind, name, self.worker_id, id(connection)), None)
+
+    def identify(self, connection, payload):
+        if self.bus is None:
+            return super().identify(connection, payload)
+        username = bytes(payload).decode('utf-8')
+        if not self.claim(CLAIM_USER, username, connection):
+            connection.send(encode_message(f"{username} is logged in on another connection", FRAME_CONTROL))
+            return
+        previous = self.users.name_of(connection)
+        super().identify(connection, payload)
+        if previous is not None and previous != username:
+            self.release(CLAIM_USER, previous, connection)
+
+    def room_command(self, connection, payload):
+        if self.bus is None:
+            return super().room_command(connection, payload)
+        _, member, _ = decode_room(payload)
+        # a connection already speaking for another member is turned down by the room index itself
+        if self.rooms.member_of.get(connection) in (None, member) and not self.claim(CLAIM_MEMBER, member, connection):
+            connection.send(encode_message(f"member {member} is in use on another connection", FRAME_CONTROL))
+            return
+        super().room_command(connection, payload)
+
+    def client_gone(self, connection):
+        super().client_gone(connection)
+        if self.bus is not None and self.is_running:
+            for kind, name in self.claims.held_by(self.worker_id, id(connection)):
+                self.release(kind, name, connection)
+
+    def deliver(self, frame, sender):
+        if is_direct_message(frame):
+            # a direct message another worker sent over the hub, for whoever has the user
+            username, inner = decode_direct(memoryview(frame)[FRAME_HEADER.size:])
+            recipient = self.users.connection_of(username)
+            if recipient is not None:
+                recipient.send(bytes(inner))
+            return
+        super().deliver(frame, sender)
 
     def stop(self):
-        # stop the server and clean up
-        self.is_running = False
-        for client in self.clients:
-            try:
-                client.close()
-            except:
-                pass
-        if self.backup_socket:
-            try:
-                self.backup_socket.close()
-            except:
-                pass
+        if self.bus:
+            self.bus.close()
+        super().stop()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="primary chat server")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+                        help="threaded runs one thread per client, asyncio runs every client on one event loop")
+    parser.add_argument("--queue-frames", type=int, default=DEFAULT_MAX_FRAMES,
+                        help="most frames queued for one client")
+    parser.add_argument("--queue-bytes", type=int, default=DEFAULT_MAX_BYTES,
+                        help="most bytes queued for one client")
+    parser.add_argument("--slow-consumer-policy", choices=POLICIES, default=POLICY_DROP_OLDEST,
+                        help="what to do when a client's queue is full")
+    parser.add_argument("--flush-delay", type=float, default=DEFAULT_FLUSH_DELAY,
+                        help="seconds a writer waits to batch more frames into one send")
+    parser.add_argument("--flush-bytes", type=int, default=DEFAULT_FLUSH_BYTES,
+                        help="send a batch as soon as this many bytes are waiting")
+    parser.add_argument("--replication-mode", choices=MODES, default=MODE_ASYNC,
+                        help="async fans out right away, semi-sync and sync wait for the backup's ack first")
+    parser.add_argument("--ack-timeout", type=float, default=DEFAULT_ACK_TIMEOUT,
+                        help="seconds semi-sync waits for an ack before fanning out anyway")
+    parser.add_argument("--heartbeat-interval", type=float, default=HEARTBEAT_INTERVAL,
+                        help="seconds the link to the backup may go quiet before we send a heartbeat")
+    parser.add_argument("--backup-address", type=parse_address, default=('127.0.0.1', BACKUP_PORT),
+                        metavar="HOST:PORT", help="where the backup server listens, it can be on another machine")
+    parser.add_argument("--node-id", default=None,
+                        help="who we say we are to the backup, by default our host name and port")
+    parser.add_argument("--wal-dir", default=None,
+                        help="keep every message in a write-ahead log in this directory")
+    parser.add_argument("--durability", choices=DURABILITIES, default=DURABILITY_INTERVAL,
+                        help="none never fsyncs, interval fsyncs every --sync-interval, batch fsyncs every batch")
+    parser.add_argument("--commit-interval", type=float, default=DEFAULT_COMMIT_INTERVAL,
+                        help="seconds the log waits to group more messages into one write")
+    parser.add_argument("--sync-interval", type=float, default=DEFAULT_SYNC_INTERVAL,
+                        help="seconds between fsyncs with interval durability")
+    parser.add_argument("--history-messages", type=int, default=DEFAULT_HISTORY_MESSAGES,
+                        help="most recent messages kept in memory")
+    parser.add_argument("--history-bytes", type=int, default=DEFAULT_HISTORY_BYTES,
+                        help="most bytes of recent messages kept in memory")
+    parser.add_argument("--replay-messages", type=int, default=DEFAULT_REPLAY_MESSAGES,
+                        help="recent messages sent to every client when it connects")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port, each on its own core, usernames and "
+                             "member ids are claimed through their fan-out hub so each is only used once")
+    parser.add_argument("--stats-port", type=int, default=None,
+                        help="serve metrics for scraping on this port, worker n uses this port + n")
+    parser.add_argument("--profile", action="store_true",
+                        help="start with profiling on, SIGUSR1 or a 'profile on' control frame switches it later")
+    parser.add_argument("--profile-dir", default=DEFAULT_PROFILE_DIR,
+                        help="where profile dumps are written")
+    parser.add_argument("--profile-interval", type=float, default=DEFAULT_DUMP_INTERVAL,
+                        help="seconds between profile dumps while profiling")
+    parser.add_argument("--profile-top", type=int, default=DEFAULT_TOP_BROADCASTS,
+                        help="how many of the slowest broadcasts to keep")
+    args = parser.parse_args()
+    if args.workers > 1:
+        if args.engine != "threaded":
+            parser.error("--workers needs the threaded engine")
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error("--workers needs SO_REUSEPORT, which this platform doesn't have")
+        # only worker 0 replicates and logs, so waiting on either would only hold back its own clients
+        if args.replication_mode != MODE_ASYNC or args.durability == DURABILITY_BATCH:
+            parser.error("--workers needs async replication and none or interval durability")
+
+    profiler.configure(args.profile_dir, args.profile_interval, args.profile_top)
+    install_signal_handler()
+    if args.profile:
+        profiler.start()
+
     # create and start the server
-    server = PrimaryServer()
-    try:
-        server.start()
-    except KeyboardInterrupt:
-        print("\nShutting down server...")
-        server.stop() 
\ No newline at end of file
+    queue_options = dict(queue_frames=args.queue_frames, queue_bytes=args.queue_bytes,
+                         slow_consumer_policy=args.slow_consumer_policy,
+                         flush_delay=args.flush_delay, flush_bytes=args.flush_bytes,
+                         history_messages=args.history_messages, history_bytes=args.history_bytes,
+                         replay_messages=args.replay_messages, stats_port=args.stats_port)
+    replication_options = dict(replication_mode=args.replication_mode, ack_timeout=args.ack_timeout,
+                               heartbeat_interval=args.heartbeat_interval, backup_address=args.backup_address,
+                               node_id=args.node_id)
+    wal_options = dict(wal_dir=args.wal_dir, durability=args.durability,
+                       commit_interval=args.commit_interval, sync_interval=args.sync_interval)
+    if args.workers > 1:
+        # the hub runs here and every worker is a PrimaryServer in its own process
+        from bus import run_workers
+        try:
+            run_workers(args.workers, dict(**queue_options, **replication_options, **wal_options))
+        except KeyboardInterrupt:
+            print("\nShutting down workers...")
+    else:
+        if args.engine == "asyncio":
+            from async_server import AsyncPrimaryServer
+            server = AsyncPrimaryServer(**queue_options, **replication_options, **wal_options)
+        else:
+            server = PrimaryServer(**queue_options, **replication_options, **wal_options)
+        try:
+            server.start()
+        except KeyboardInterrupt:
+            print("\nShutting down server...")
+            server.stop()
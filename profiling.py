@@ -0,0 +1,224 @@
+import heapq
+import ipaddress
+import os
+import signal
+import threading
+import time
+
+# where dumps go and how often they're written while profiling is on
+DEFAULT_PROFILE_DIR = "."
+DEFAULT_DUMP_INTERVAL = 10.0
+# how many of the slowest broadcasts to keep
+DEFAULT_TOP_BROADCASTS = 20
+# control commands a local client can send in a FRAME_CONTROL frame
+COMMAND_ON = "profile on"
+COMMAND_OFF = "profile off"
+COMMAND_DUMP = "profile dump"
+
+
+class NullSpan:
+    """what span hands out while profiling is off, entering and leaving it does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """times one call and charges its own time, minus any spans inside it, to its stack."""
+
+    __slots__ = ('profiler', 'name', 'stack', 'started', 'children')
+
+    def __init__(self, profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        local = self.profiler.local
+        stack = getattr(local, 'stack', None)
+        if stack is None:
+            stack = local.stack = []
+        stack.append(self)
+        self.stack = stack
+        self.children = 0.0
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        stack = self.stack
+        path = ";".join(span.name for span in stack)
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        self.profiler.add(path, elapsed - self.children)
+        return False
+
+
+class Profiler:
+    """
+    span timers for the hot paths, off until someone turns them on.
+
+    spans nest per thread, and each one's own time goes to its whole stack
+    of span names, so the dump is in the collapsed stack format flame graph
+    tools read. while profiling is on a thread rewrites the dump every
+    dump_interval seconds, along with the slowest broadcasts and how many
+    clients each went to.
+    """
+
+    def __init__(self, directory: str = DEFAULT_PROFILE_DIR, dump_interval: float = DEFAULT_DUMP_INTERVAL,
+                 top: int = DEFAULT_TOP_BROADCASTS):
+        self.directory = directory
+        self.dump_interval = dump_interval
+        self.top = top
+        self.enabled = False
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # microseconds of own time per collapsed stack, and a min heap of
+        # (seconds, fan out size, when) for the slowest broadcasts
+        self.totals = {}
+        self.slowest = []
+        self.dump_thread = None
+
+    def configure(self, directory: str = None, dump_interval: float = None, top: int = None) -> None:
+        if directory is not None:
+            self.directory = directory
+        if dump_interval is not None:
+            self.dump_interval = dump_interval
+        if top is not None:
+            self.top = top
+
+    def span(self, name: str):
+        """a context manager timing the code inside it, free while profiling is off."""
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name)
+
+    def add(self, path: str, seconds: float) -> None:
+        micros = int(seconds * 1000000)
+        with self.lock:
+            self.totals[path] = self.totals.get(path, 0) + micros
+
+    def record_broadcast(self, seconds: float, fan_out: int) -> None:
+        """remember a broadcast if it's among the slowest so far."""
+        if not self.enabled:
+            return
+        entry = (seconds, fan_out, time.time())
+        with self.lock:
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+    def start(self) -> None:
+        """start profiling, from fresh totals."""
+        with self.lock:
+            self.totals = {}
+            self.slowest = []
+        self.enabled = True
+        if self.dump_thread is None or not self.dump_thread.is_alive():
+            self.dump_thread = threading.Thread(target=self.dump_loop, daemon=True)
+            self.dump_thread.start()
+        print(f"Profiling on, dumping to {self.directory} every {self.dump_interval}s")
+
+    def stop(self) -> None:
+        """stop profiling and write what we have."""
+        if not self.enabled:
+            return
+        self.enabled = False
+        self.dump()
+        print("Profiling off")
+
+    def toggle(self) -> None:
+        if self.enabled:
+            self.stop()
+        else:
+            self.start()
+
+    def dump_loop(self) -> None:
+        while self.enabled:
+            time.sleep(self.dump_interval)
+            if self.enabled:
+                self.dump()
+
+    def paths(self) -> tuple:
+        pid = os.getpid()
+        return (os.path.join(self.directory, f"profile-{pid}.folded"),
+                os.path.join(self.directory, f"slowest-{pid}.txt"))
+
+    def dump(self) -> tuple:
+        """
+        write the collapsed stacks and the slowest broadcasts.
+
+        Returns:
+            the paths of the two files
+        """
+        with self.lock:
+            totals = sorted(self.totals.items())
+            slowest = sorted(self.slowest, reverse=True)
+        folded_path, slowest_path = self.paths()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # write then rename so a reader never sees half a file
+            with open(folded_path + ".tmp", "w") as f:
+                for path, micros in totals:
+                    f.write(f"{path} {micros}\n")
+            os.replace(folded_path + ".tmp", folded_path)
+            with open(slowest_path + ".tmp", "w") as f:
+                f.write("milliseconds fan_out time\n")
+                for seconds, fan_out, when in slowest:
+                    stamp = time.strftime("%H:%M:%S", time.localtime(when))
+                    f.write(f"{seconds * 1000:.3f} {fan_out} {stamp}\n")
+            os.replace(slowest_path + ".tmp", slowest_path)
+        except OSError as e:
+            print(f"Error writing profile: {e}")
+        return folded_path, slowest_path
+
+    def command(self, address, text: str):
+        """
+        carry out a control command from a client.
+
+        Args:
+            address: the client's address, only clients on this machine may profile us
+            text: the command
+
+        Returns:
+            the reply to send back, None if it wasn't a profiling command
+        """
+        if text not in (COMMAND_ON, COMMAND_OFF, COMMAND_DUMP):
+            return None
+        try:
+            local = ipaddress.ip_address(address[0]).is_loopback
+        except (TypeError, ValueError, IndexError):
+            local = False
+        if not local:
+            return "profiling commands are only taken from this machine"
+        if text == COMMAND_ON:
+            self.start()
+            return "profiling on"
+        if text == COMMAND_OFF:
+            self.stop()
+            return "profiling off"
+        return "profile written to " + " and ".join(self.dump())
+
+
+# one per process, signals and the writer threads all share it
+profiler = Profiler()
+
+
+def install_signal_handler() -> None:
+    """let SIGUSR1 switch profiling on and off, must be called from the main thread."""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+
+    def toggle(*_):
+        # the handler can interrupt the main thread while it holds the profiler's
+        # lock inside a span, so do the switching on a thread of its own
+        threading.Thread(target=profiler.toggle, daemon=True).start()
+
+    signal.signal(signal.SIGUSR1, toggle)
@@ -0,0 +1,160 @@
+import errno
+import random
+import selectors
+import socket
+import time
+
+# how long one connection attempt gets before we count that server as down
+CONNECT_TIMEOUT = 2.0  # seconds
+# how long an attempt has to itself before the next candidate is tried alongside it
+RACE_DELAY = 0.25  # seconds
+# the shortest and longest a client waits between rounds of reconnecting
+BACKOFF_BASE = 0.1  # seconds
+BACKOFF_CAP = 10.0  # seconds
+# what a non-blocking connect says when it has started but not finished
+IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY}
+
+
+def candidates(addresses) -> list:
+    """
+    resolve the servers we can reach into the addresses to try, in order.
+
+    each server's own addresses take turns between ipv6 and ipv4 so one
+    broken family doesn't hold up the other.
+
+    Args:
+        addresses: (host, port) tuples, the one to try first first
+
+    Returns:
+        (family, socket address, the (host, port) it came from) tuples
+    """
+    found = []
+    for endpoint in addresses:
+        try:
+            infos = socket.getaddrinfo(endpoint[0], endpoint[1], type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            print(f"Couldn't resolve {endpoint[0]}: {e}")
+            continue
+        by_family = {}
+        for family, _, _, _, sockaddr in infos:
+            resolved = by_family.setdefault(family, [])
+            if sockaddr not in resolved:
+                resolved.append(sockaddr)
+        while by_family:
+            for family in list(by_family):
+                found.append((family, by_family[family].pop(0), endpoint))
+                if not by_family[family]:
+                    del by_family[family]
+    return found
+
+
+def race_connect(addresses, timeout: float = CONNECT_TIMEOUT, delay: float = RACE_DELAY,
+                 source_address: tuple = None):
+    """
+    connect to whichever server answers first, happy eyeballs style.
+
+    the first candidate is tried straight away and each one after it delay
+    seconds later, or as soon as the one before it fails, so a server that
+    is down costs us one refused connection and one that isn't answering
+    at all costs us delay instead of the whole timeout. the first
+    connection to come up wins and the rest are closed.
+
+    Args:
+        addresses: (host, port) tuples in the order we'd like them
+        timeout: how long each attempt gets
+        delay: how long to wait on one attempt before starting the next
+        source_address: the (host, port) to connect from, if it matters
+
+    Returns:
+        (a connected blocking socket, the (host, port) it's connected to)
+
+    Raises:
+        OSError: if nothing could be connected to
+    """
+    pending = candidates(addresses)
+    if not pending:
+        raise OSError(f"Couldn't resolve any of {list(addresses)}")
+    selector = selectors.DefaultSelector()
+    # socket to (the (host, port) it's for, when it gives up)
+    attempts = {}
+    last_error = None
+    next_start = time.monotonic()
+    try:
+        while pending or attempts:
+            now = time.monotonic()
+            if pending and (now >= next_start or not attempts):
+                family, sockaddr, endpoint = pending.pop(0)
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                try:
+                    if source_address is not None:
+                        sock.bind(source_address)
+                    error = sock.connect_ex(sockaddr)
+                except OSError as e:
+                    error = e.errno
+                if error == 0:
+                    sock.setblocking(True)
+                    return sock, endpoint
+                if error in IN_PROGRESS:
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    attempts[sock] = (endpoint, now + timeout)
+                    next_start = now + delay
+                else:
+                    # refused outright, go straight on to the next one
+                    last_error = OSError(error, f"{endpoint[0]}:{endpoint[1]}: {errno.errorcode.get(error, error)}")
+                    sock.close()
+                continue
+
+            # sleep until something connects or fails, an attempt runs out or the next one is due
+            wake = min(deadline for _, deadline in attempts.values())
+            if pending:
+                wake = min(wake, next_start)
+            for key, _ in selector.select(max(wake - now, 0)):
+                sock = key.fileobj
+                endpoint, _ = attempts.pop(sock)
+                selector.unregister(sock)
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error == 0:
+                    sock.setblocking(True)
+                    return sock, endpoint
+                last_error = OSError(error, f"{endpoint[0]}:{endpoint[1]}: {errno.errorcode.get(error, error)}")
+                sock.close()
+                next_start = time.monotonic()
+            now = time.monotonic()
+            for sock, (endpoint, deadline) in list(attempts.items()):
+                if deadline <= now:
+                    del attempts[sock]
+                    selector.unregister(sock)
+                    sock.close()
+                    last_error = socket.timeout(f"{endpoint[0]}:{endpoint[1]}: timed out")
+    finally:
+        for sock in attempts:
+            sock.close()
+        selector.close()
+    raise last_error
+
+
+class Backoff:
+    """
+    how long to wait before the next round of reconnecting.
+
+    decorrelated jitter: each wait is random between base and three times
+    the last one, up to cap. the waits grow about exponentially while the
+    servers stay down, and clients that all lost the same server at once
+    spread out instead of coming back in lockstep.
+    """
+
+    def __init__(self, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP, rng: random.Random = None):
+        self.base = base
+        self.cap = cap
+        self.random = rng or random.Random()
+        self.delay = base
+
+    def next(self) -> float:
+        """the seconds to wait now, each call grows it."""
+        self.delay = min(self.cap, self.random.uniform(self.base, self.delay * 3))
+        return self.delay
+
+    def reset(self) -> None:
+        """we got back in, start from base next time."""
+        self.delay = self.base
@@ -0,0 +1,308 @@
+import random
+import struct
+import threading
+import time
+from collections import deque
+from common import (
+    FRAME_REPLICATE, FRAME_ACK, FRAME_CATCHUP, FRAME_SNAPSHOT, FRAME_LEADER, FRAME_HEADER, MAX_FRAME_SIZE,
+    encode_frame
+)
+
+# how the primary trades latency against what a failover can lose
+MODE_ASYNC = "async"          # fan out straight away, the backup catches up on its own
+MODE_SEMI_SYNC = "semi-sync"  # wait for the backup's ack before fan out, but only up to ack_timeout
+MODE_SYNC = "sync"            # wait for the backup's ack before fan out for as long as the backup is there
+MODES = (MODE_ASYNC, MODE_SEMI_SYNC, MODE_SYNC)
+
+# how long semi-sync waits for an ack before giving up on it
+DEFAULT_ACK_TIMEOUT = 0.5  # seconds
+
+# how many entries, and how many bytes of them, the primary keeps around for a backup that needs to catch up
+DEFAULT_RETAIN_ENTRIES = 10000
+DEFAULT_RETAIN_BYTES = 16 * 1024 * 1024
+# how many of the messages that fell out of the log a snapshot still carries
+DEFAULT_SNAPSHOT_MESSAGES = 100
+
+# sequence numbers go on the wire as unsigned 64 bit ints
+SEQ = struct.Struct('!Q')
+# a log id and a sequence number in that log
+POSITION = struct.Struct('!QQ')
+# the port a server that has taken over as primary takes clients on
+LEADER = struct.Struct('!H')
+
+
+def encode_entry(seq: int, frame: bytes) -> bytes:
+    """
+    wrap a frame in a replication entry.
+
+    Args:
+        seq: the entry's sequence number
+        frame: the complete encoded frame being replicated
+
+    Returns:
+        a FRAME_REPLICATE frame ready for the backup link
+    """
+    return FRAME_HEADER.pack(SEQ.size + len(frame), FRAME_REPLICATE) + SEQ.pack(seq) + frame
+
+
+def decode_entry(payload: bytes):
+    """
+    split a FRAME_REPLICATE payload back up.
+
+    Returns:
+        a (seq, frame) tuple
+    """
+    return SEQ.unpack_from(payload)[0], payload[SEQ.size:]
+
+
+def encode_ack(seq: int) -> bytes:
+    """build the cumulative ack the backup sends for everything up to seq."""
+    return encode_frame(FRAME_ACK, SEQ.pack(seq))
+
+
+def decode_ack(payload: bytes) -> int:
+    """get the sequence number out of a FRAME_ACK payload."""
+    return SEQ.unpack_from(payload)[0]
+
+
+def encode_position(frame_type: int, log_id: int, seq: int, body: bytes = b'') -> bytes:
+    """build a FRAME_CATCHUP or FRAME_SNAPSHOT frame for a position in a log."""
+    return encode_frame(frame_type, POSITION.pack(log_id, seq) + body)
+
+
+def decode_position(payload: bytes):
+    """
+    split a FRAME_CATCHUP or FRAME_SNAPSHOT payload up.
+
+    Returns:
+        a (log_id, seq, body) tuple, body is empty for catch-up frames
+    """
+    log_id, seq = POSITION.unpack_from(payload)
+    return log_id, seq, payload[POSITION.size:]
+
+
+def encode_leader(port: int) -> bytes:
+    """build the frame a promoted backup announces itself to its clients with."""
+    return encode_frame(FRAME_LEADER, LEADER.pack(port))
+
+
+def decode_leader(payload: bytes) -> int:
+    """get the client port out of a FRAME_LEADER payload."""
+    return LEADER.unpack_from(payload)[0]
+
+
+def split_frames(data: bytes) -> list:
+    """cut a run of back to back encoded frames into one bytes object per frame."""
+    frames = []
+    offset = 0
+    while offset < len(data):
+        length, _ = FRAME_HEADER.unpack_from(data, offset)
+        end = offset + FRAME_HEADER.size + length
+        frames.append(bytes(data[offset:end]))
+        offset = end
+    return frames
+
+
+class ReplicationLog:
+    """
+    numbers everything the primary replicates and tracks the backup's acks.
+
+    entries are numbered from 1 with no gaps. acks are cumulative, so one
+    ack covers every entry up to and including its sequence number, which
+    lets the backup ack a whole batch at once.
+
+    the newest retain_entries entries, up to retain_bytes of them, are kept
+    so a backup that reconnects can be sent just what it missed. entries that
+    fall out of the log leave their newest snapshot_messages frames behind,
+    as many as fit in one frame, as a compact snapshot for a backup that is
+    too far behind for that.
+    """
+
+    def __init__(self, mode: str = MODE_ASYNC, ack_timeout: float = DEFAULT_ACK_TIMEOUT,
+                 retain_entries: int = DEFAULT_RETAIN_ENTRIES, retain_bytes: int = DEFAULT_RETAIN_BYTES,
+                 snapshot_messages: int = DEFAULT_SNAPSHOT_MESSAGES):
+        if mode not in MODES:
+            raise ValueError(f"unknown replication mode {mode!r}")
+        self.mode = mode
+        self.ack_timeout = ack_timeout
+        self.retain_entries = retain_entries
+        self.retain_bytes = retain_bytes
+        # tells this log apart from the one a restarted primary would start
+        self.log_id = random.getrandbits(63) + 1
+        # (seq, frame) for the newest entries, oldest first, and their total size
+        self.entries = deque()
+        self.entries_bytes = 0
+        # frames that fell out of entries, the newest of them make up the snapshot,
+        # and their total size, which never grows past what one snapshot frame holds
+        self.snapshot = deque(maxlen=snapshot_messages)
+        self.snapshot_bytes = 0
+        # sequence number of the newest entry, 0 before the first one
+        self.last_seq = 0
+        # highest sequence number the backup has acked
+        self.acked_seq = 0
+        # (seq, time appended) for every entry the backup hasn't acked yet
+        self.unacked = deque()
+        # only set while a caught up backup is attached, so unacked can't grow without one
+        self.tracking = False
+        # how long the most recent ack took to come back after its entry was sent
+        self.last_ack_latency = 0.0
+        self.condition = threading.Condition()
+
+    def append(self, frame: bytes, seq: int = None):
+        """
+        give a frame the next sequence number.
+
+        Args:
+            frame: the complete encoded frame to replicate
+            seq: its number if it already has one, after last_seq but maybe not
+                right after, the next number if not given
+
+        Returns:
+            a (seq, entry) tuple where entry is ready to send to the backup
+        """
+        with self.condition:
+            self.last_seq = seq if seq is not None else self.last_seq + 1
+            seq = self.last_seq
+            self.entries.append((seq, frame))
+            self.entries_bytes += len(frame)
+            # past either cap the oldest entries go, a backup that needed them gets a snapshot
+            while len(self.entries) > self.retain_entries or self.entries_bytes > self.retain_bytes:
+                _, oldest = self.entries.popleft()
+                self.entries_bytes -= len(oldest)
+                self.keep_in_snapshot(oldest)
+            if self.tracking:
+                self.unacked.append((seq, time.monotonic()))
+        return seq, encode_entry(seq, frame)
+
+    def restart(self, frames, seq: int = 0) -> None:
+        """
+        start over as a new log, for a backup that has taken over as primary.
+
+        the new log id makes whatever backup connects to us next take a
+        snapshot, and frames, the messages we had before taking over, start
+        that snapshot off. numbering carries on after seq, the last entry
+        we applied from the old primary.
+        """
+        with self.condition:
+            self.log_id = random.getrandbits(63) + 1
+            self.entries.clear()
+            self.entries_bytes = 0
+            self.snapshot.clear()
+            self.snapshot_bytes = 0
+            for frame in frames:
+                self.keep_in_snapshot(frame)
+            self.last_seq = seq
+            self.acked_seq = seq
+            self.unacked.clear()
+            self.tracking = False
+            self.condition.notify_all()
+
+    def catch_up(self, log_id: int, seq: int) -> list:
+        """
+        work out what a (re)connecting backup needs.
+
+        if the backup's position is in our retained entries it gets just the
+        entries after it, otherwise a snapshot followed by every retained entry.
+
+        Args:
+            log_id: the log the backup's position refers to, 0 if it has none
+            seq: the last sequence number the backup applied from that log
+
+        Returns:
+            the frames to send the backup, in order
+        """
+        with self.condition:
+            first_seq = self.entries[0][0] if self.entries else self.last_seq + 1
+            if log_id == self.log_id and first_seq - 1 <= seq <= self.last_seq:
+                frames = [encode_position(FRAME_CATCHUP, self.log_id, seq)]
+                start = seq
+            else:
+                start = first_seq - 1
+                frames = [self.encode_snapshot(start)]
+            tail = [(s, frame) for s, frame in self.entries if s > start]
+            frames.extend(encode_entry(s, frame) for s, frame in tail)
+            # the backup now has everything up to start, the tail is in flight
+            now = time.monotonic()
+            self.acked_seq = start
+            self.unacked = deque((s, now) for s, _ in tail)
+            self.tracking = True
+            self.condition.notify_all()
+            return frames
+
+    def keep_in_snapshot(self, frame: bytes) -> None:
+        # called with the lock held, the oldest frames go once the rest fill a snapshot frame
+        if self.snapshot.maxlen == 0:
+            return
+        if len(self.snapshot) == self.snapshot.maxlen:
+            self.snapshot_bytes -= len(self.snapshot[0])
+        self.snapshot.append(frame)
+        self.snapshot_bytes += len(frame)
+        while self.snapshot and self.snapshot_bytes > MAX_FRAME_SIZE - POSITION.size:
+            self.snapshot_bytes -= len(self.snapshot.popleft())
+
+    def encode_snapshot(self, seq: int) -> bytes:
+        # called with the lock held, the snapshot always fits in one frame
+        return encode_position(FRAME_SNAPSHOT, self.log_id, seq, b''.join(self.snapshot))
+
+    def ack(self, seq: int) -> None:
+        """record a cumulative ack from the backup."""
+        with self.condition:
+            if seq <= self.acked_seq:
+                return
+            self.acked_seq = seq
+            now = time.monotonic()
+            while self.unacked and self.unacked[0][0] <= seq:
+                _, sent_at = self.unacked.popleft()
+                self.last_ack_latency = now - sent_at
+            self.condition.notify_all()
+
+    def reset(self) -> None:
+        """forget outstanding entries, used when the backup link drops."""
+        with self.condition:
+            self.unacked.clear()
+            self.tracking = False
+            self.condition.notify_all()
+
+    def wait_for_ack(self, seq: int, is_connected) -> bool:
+        """
+        block until the backup has acked seq, as the replication mode asks.
+
+        Args:
+            seq: the sequence number to wait for
+            is_connected: callable that says whether the backup link is still up
+
+        Returns:
+            true if the entry was acked, false if we gave up on it
+        """
+        if self.mode == MODE_ASYNC:
+            return False
+        deadline = time.monotonic() + self.ack_timeout
+        with self.condition:
+            while self.acked_seq < seq:
+                if not is_connected():
+                    return False
+                if self.mode == MODE_SEMI_SYNC:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                else:
+                    # sync still wakes up now and then to notice a dead backup
+                    self.condition.wait(self.ack_timeout)
+            return True
+
+    def lag(self) -> dict:
+        """
+        how far behind the backup is.
+
+        Returns:
+            entries not yet acked, age of the oldest of them in seconds and
+            the latency of the most recent ack
+        """
+        with self.condition:
+            oldest = time.monotonic() - self.unacked[0][1] if self.unacked else 0.0
+            return {
+                "entries": self.last_seq - self.acked_seq,
+                "seconds": oldest,
+                "ack_latency": self.last_ack_latency,
+            }
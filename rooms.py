@@ -0,0 +1,248 @@
+import struct
+import threading
+from common import FRAME_HEADER, FRAME_ROOM, FRAME_ROOM_CHAT, FRAME_CONTROL, ProtocolError, encode_frame
+
+# what a FRAME_ROOM frame asks for
+ROOM_JOIN = 1     # put the member in the room
+ROOM_LEAVE = 2    # take the member out of the room
+ROOM_RESTORE = 3  # a member reconnected, put its connection back in every room it had joined
+ROOM_CLEAR = 4    # primary to backup: forget every member, the full table follows as joins
+ROOM_OPS = (ROOM_JOIN, ROOM_LEAVE, ROOM_RESTORE, ROOM_CLEAR)
+# a FRAME_ROOM payload is the op and the member id's length, then the member id and the room name
+ROOM_OP = struct.Struct('!BB')
+# a FRAME_ROOM_CHAT payload is the sequence number the server gave it, 0 from a client,
+# then the room name's length and the name, then the message
+ROOM_SEQ = struct.Struct('!Q')
+ROOM_NAME = struct.Struct('!B')
+# names have to fit in those one byte lengths
+MAX_NAME_BYTES = 255
+
+
+def encode_room(op: int, member: str, room: str = "") -> bytes:
+    """
+    build a membership frame.
+
+    Args:
+        op: one of the ROOM_* ops
+        member: the id the member keeps across reconnects
+        room: the room, empty for restore and clear
+
+    Returns:
+        a FRAME_ROOM frame
+    """
+    member = member.encode('utf-8')
+    room = room.encode('utf-8')
+    if len(member) > MAX_NAME_BYTES or len(room) > MAX_NAME_BYTES:
+        raise ProtocolError(f"member ids and room names can be at most {MAX_NAME_BYTES} bytes")
+    return encode_frame(FRAME_ROOM, ROOM_OP.pack(op, len(member)) + member + room)
+
+
+def decode_room(payload: bytes):
+    """
+    split a FRAME_ROOM payload up.
+
+    Returns:
+        an (op, member, room) tuple
+    """
+    op, length = ROOM_OP.unpack_from(payload)
+    if op not in ROOM_OPS:
+        raise ProtocolError(f"unknown room op {op}")
+    start = ROOM_OP.size
+    member = bytes(payload[start:start + length]).decode('utf-8')
+    room = bytes(payload[start + length:]).decode('utf-8')
+    return op, member, room
+
+
+def encode_room_message(room: str, message: str, seq: int = 0) -> bytes:
+    """build the frame for a chat message to one room, a client leaves the numbering to the server."""
+    room = room.encode('utf-8')
+    if not room or len(room) > MAX_NAME_BYTES:
+        raise ProtocolError(f"room names have to be 1 to {MAX_NAME_BYTES} bytes")
+    header = ROOM_SEQ.pack(seq) + ROOM_NAME.pack(len(room))
+    return encode_frame(FRAME_ROOM_CHAT, header + room + message.encode('utf-8'))
+
+
+def decode_room_message(payload: bytes):
+    """
+    split a FRAME_ROOM_CHAT payload up.
+
+    Returns:
+        a (room, message bytes) tuple
+    """
+    start = ROOM_SEQ.size + ROOM_NAME.size
+    end = start + payload[ROOM_SEQ.size]
+    return bytes(payload[start:end]).decode('utf-8'), payload[end:]
+
+
+def decode_room_seq(payload: bytes) -> int:
+    """the sequence number in a FRAME_ROOM_CHAT payload, 0 if no server has numbered it."""
+    return ROOM_SEQ.unpack_from(payload)[0]
+
+
+def numbered_room_message(frame, seq: int) -> bytes:
+    """a copy of an encoded FRAME_ROOM_CHAT frame with the server's sequence number in it."""
+    start = FRAME_HEADER.size
+    return b''.join((frame[:start], ROOM_SEQ.pack(seq), frame[start + ROOM_SEQ.size:]))
+
+
+def room_of(frame) -> str:
+    """the room an encoded FRAME_ROOM_CHAT frame is for."""
+    return decode_room_message(memoryview(frame)[FRAME_HEADER.size:])[0]
+
+
+def is_room_frame(frame) -> bool:
+    """whether an encoded frame is a membership change rather than something to fan out."""
+    return len(frame) >= FRAME_HEADER.size and frame[FRAME_HEADER.size - 1] == FRAME_ROOM
+
+
+def is_room_message(frame) -> bool:
+    """whether an encoded frame is a chat message for one room."""
+    return len(frame) >= FRAME_HEADER.size and frame[FRAME_HEADER.size - 1] == FRAME_ROOM_CHAT
+
+
+def is_replayable(frame) -> bool:
+    """whether a frame belongs in the recent messages every new client is sent."""
+    return not is_room_frame(frame) and not is_room_message(frame)
+
+
+class RoomIndex:
+    """
+    who is in which room, for one server.
+
+    members maps a member id to the rooms it has joined. it doesn't depend
+    on any connection, so it's what gets replicated to the backup and what
+    a member reconnecting after a failover gets its rooms back from.
+
+    subscribers maps a room to the connections in it right now. each set is
+    a frozenset replaced on every change, so fan out reads it without the
+    lock and a message costs the size of its room, not every connection.
+
+    a member id belongs to the first connection that uses it until that
+    connection closes, and a connection only ever speaks for one member,
+    so nobody can join, leave or restore rooms for someone else.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.members = {}
+        self.subscribers = {}
+        # the rooms each connection is in, so a disconnect can be cleaned up
+        self.rooms_of = {}
+        # the connection each member id belongs to right now, and the other way round
+        self.owners = {}
+        self.member_of = {}
+
+    def recipients(self, room: str) -> frozenset:
+        return self.subscribers.get(room, frozenset())
+
+    def is_subscribed(self, connection, room: str) -> bool:
+        return connection in self.subscribers.get(room, ())
+
+    def subscribe(self, connection, room: str) -> None:
+        with self.lock:
+            self.subscribers[room] = self.subscribers.get(room, frozenset()) | {connection}
+            self.rooms_of.setdefault(connection, set()).add(room)
+
+    def unsubscribe(self, connection, room: str) -> None:
+        with self.lock:
+            self.remove(connection, room)
+            rooms = self.rooms_of.get(connection)
+            if rooms is not None:
+                rooms.discard(room)
+                if not rooms:
+                    del self.rooms_of[connection]
+
+    def remove(self, connection, room: str) -> None:
+        # called with the lock held
+        subscribers = self.subscribers.get(room)
+        if subscribers is None or connection not in subscribers:
+            return
+        subscribers = subscribers - {connection}
+        if subscribers:
+            self.subscribers[room] = subscribers
+        else:
+            del self.subscribers[room]
+
+    def drop(self, connection) -> None:
+        """take a closed connection out of every room, its member keeps its rooms."""
+        with self.lock:
+            for room in self.rooms_of.pop(connection, ()):
+                self.remove(connection, room)
+            # and the member id is free for the member's next connection
+            member = self.member_of.pop(connection, None)
+            if member is not None and self.owners.get(member) is connection:
+                del self.owners[member]
+
+    def claim(self, connection, member: str) -> bool:
+        """tie a member id to a connection, false if either already belongs to someone else."""
+        with self.lock:
+            owner = self.owners.get(member)
+            claimed = self.member_of.get(connection)
+            if (owner is not None and owner is not connection) or (claimed is not None and claimed != member):
+                return False
+            self.owners[member] = connection
+            self.member_of[connection] = member
+        return True
+
+    def apply(self, op: int, member: str, room: str) -> None:
+        """update the member table, for a membership frame from a client or replicated to us."""
+        with self.lock:
+            if op == ROOM_JOIN:
+                self.members.setdefault(member, set()).add(room)
+            elif op == ROOM_LEAVE:
+                rooms = self.members.get(member)
+                if rooms is not None:
+                    rooms.discard(room)
+                    if not rooms:
+                        del self.members[member]
+            elif op == ROOM_CLEAR:
+                self.members = {}
+
+    def apply_frame(self, frame) -> None:
+        """apply an encoded FRAME_ROOM frame to the member table."""
+        self.apply(*decode_room(memoryview(frame)[FRAME_HEADER.size:]))
+
+    def command(self, connection, payload: bytes):
+        """
+        carry out a join, leave or restore from a client.
+
+        Args:
+            connection: the client's connection, it's what gets subscribed
+            payload: the FRAME_ROOM payload it sent
+
+        Returns:
+            (frames to send back to the client, the membership frame every
+            server has to see or None)
+        """
+        op, member, room = decode_room(payload)
+        if not self.claim(connection, member):
+            error = f"member {member} is in use on another connection"
+            return [encode_frame(FRAME_CONTROL, error.encode('utf-8'))], None
+        if op == ROOM_RESTORE:
+            with self.lock:
+                rooms = sorted(self.members.get(member, ()))
+            for name in rooms:
+                self.subscribe(connection, name)
+            return [encode_room(ROOM_JOIN, member, name) for name in rooms], None
+        if not room or op not in (ROOM_JOIN, ROOM_LEAVE):
+            raise ProtocolError("clients can only join or leave a named room")
+        if op == ROOM_JOIN:
+            self.subscribe(connection, room)
+        else:
+            self.unsubscribe(connection, room)
+        self.apply(op, member, room)
+        # the same frame confirms it to the client and tells the other servers
+        frame = encode_room(op, member, room)
+        return [frame], frame
+
+    def can_see(self, connection, frame) -> bool:
+        """whether a frame from the history may go to a client, room messages only go to their room."""
+        if not is_room_message(frame):
+            return True
+        return self.is_subscribed(connection, room_of(frame))
+
+    def snapshot(self) -> list:
+        """the whole member table as frames, a clear and then one join per member and room."""
+        with self.lock:
+            pairs = [(member, room) for member, rooms in self.members.items() for room in rooms]
+        return [encode_room(ROOM_CLEAR, "")] + [encode_room(ROOM_JOIN, member, room) for member, room in pairs]
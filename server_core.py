@@ -0,0 +1,733 @@
+import abc
+import socket
+import threading
+import time
+from collections import deque
+from common import (
+    FRAME_CHAT, FRAME_ACK, FRAME_CATCHUP, FRAME_HISTORY, FRAME_CONTROL, FRAME_TRACED, FRAME_ROOM,
+    FRAME_ROOM_CHAT, FRAME_IDENTIFY, FRAME_DIRECT, FRAME_RESUME, FRAME_HELLO, FRAME_HEADER, TRACE_HEADER,
+    HEARTBEAT_FRAME, HEARTBEAT_INTERVAL, LISTEN_BACKLOG, ProtocolError, encode_message, receive_frame,
+    send_encoded, get_reader, release_reader
+)
+from connection import (
+    ClientConnection, ClientRegistry, POLICY_DROP_OLDEST, POLICY_DISCONNECT, DEFAULT_MAX_FRAMES,
+    DEFAULT_MAX_BYTES, DEFAULT_FLUSH_DELAY, DEFAULT_FLUSH_BYTES, BACKUP_QUEUE_BYTES
+)
+from replication import ReplicationLog, MODE_ASYNC, DEFAULT_ACK_TIMEOUT, decode_ack, decode_position
+from history import (
+    HistoryReader, HistoryRing, HISTORY_LIMIT, DEFAULT_HISTORY_MESSAGES, DEFAULT_HISTORY_BYTES, DEFAULT_REPLAY_MESSAGES,
+    encode_history, decode_history
+)
+from metrics import ServerMetrics
+from failure_detector import CHECK_INTERVAL
+from handshake import ROLE_PEER, encode_hello, decode_hello, read_hello, default_node_id
+from reconnect import CONNECT_TIMEOUT
+from tracing import is_traced, received_frame, stamp, sequenced
+from delivery import (
+    DeliveredIds, encode_receipt, encode_resume, decode_resume, frames_after, last_seq_logged, receipt_for, seq_of,
+    trace_of
+)
+from rooms import RoomIndex, decode_room_message, is_room_frame, is_room_message, room_of
+from users import UserIndex, encode_direct, is_presence_frame
+from profiling import profiler
+from wal import WriteAheadLog, DURABILITY_INTERVAL, DURABILITY_BATCH, DEFAULT_COMMIT_INTERVAL, DEFAULT_SYNC_INTERVAL
+
+# what a backup tells a client that sends it a message before it has taken over
+NOT_PRIMARY_FRAME = encode_message("this server is a backup, it takes messages once it takes over", FRAME_CONTROL)
+# how many messages a backup that has lost its primary holds for when it takes over, past that it turns them away
+WAITING_MESSAGES = 1000
+
+
+class FanOutTurns:
+    """
+    lets the threads delivering messages fan them out in the order they were numbered.
+
+    a thread takes a turn while it still holds the lock that numbered its
+    message, waits on the backup and the disk like before, then waits for
+    its turn before fan out. otherwise a message could reach the history and
+    the client queues ahead of one numbered before it, and a client resuming
+    from the later one would never be sent the earlier one.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        # the next turn to give out, the turn whose fan out may run now and
+        # turns after it that are already done, a delivery that failed early
+        # is done before its turn comes
+        self.issued = 0
+        self.serving = 0
+        self.finished = set()
+
+    def take(self) -> int:
+        """a turn after every one taken so far, take it under the lock that numbers messages."""
+        with self.condition:
+            turn = self.issued
+            self.issued += 1
+            return turn
+
+    def wait(self, turn: int) -> None:
+        """block until every turn before this one is done."""
+        with self.condition:
+            while self.serving != turn:
+                self.condition.wait()
+
+    def done(self, turn: int) -> None:
+        """finish a turn, every turn taken has to be done exactly once or the ones after it wait forever."""
+        with self.condition:
+            self.finished.add(turn)
+            while self.serving in self.finished:
+                self.finished.remove(self.serving)
+                self.serving += 1
+            self.condition.notify_all()
+
+
+class ChatServerCore(abc.ABC):
+    """
+    what every chat server does with its clients, whichever engine runs it.
+
+    the engine owns the sockets and hands each frame a client sends to
+    handle_frame. it provides broadcast_frame, which numbers, replicates,
+    logs and fans out a frame. a connection only needs an address and a
+    send method that never blocks and returns false once the client is gone.
+    """
+
+    def __init__(self, port: int, queue_frames: int = DEFAULT_MAX_FRAMES, queue_bytes: int = DEFAULT_MAX_BYTES,
+                 slow_consumer_policy: str = POLICY_DROP_OLDEST, flush_delay: float = DEFAULT_FLUSH_DELAY,
+                 flush_bytes: int = DEFAULT_FLUSH_BYTES, wal_dir: str = None, durability: str = DURABILITY_INTERVAL,
+                 commit_interval: float = DEFAULT_COMMIT_INTERVAL, sync_interval: float = DEFAULT_SYNC_INTERVAL,
+                 history_messages: int = DEFAULT_HISTORY_MESSAGES, history_bytes: int = DEFAULT_HISTORY_BYTES,
+                 replay_messages: int = DEFAULT_REPLAY_MESSAGES, stats_port: int = None, node_id: str = None):
+        # port we listen on for clients
+        self.port = port
+        # who we say we are in our hello, and the epoch, which goes up every time a backup takes over
+        self.node_id = node_id or default_node_id(port)
+        self.epoch = 0
+        # every connected client, any thread can add or remove one
+        self.clients = ClientRegistry()
+        # limits for each client's outbound queue and what to do when one fills up
+        self.queue_frames = queue_frames
+        self.queue_bytes = queue_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        # how long writers wait to batch frames together and how big a batch gets
+        self.flush_delay = flush_delay
+        self.flush_bytes = flush_bytes
+        # flag to control the server's main loop
+        self.is_running = True
+        # where and how durably to keep every message on disk, no disk log without a directory
+        self.wal_options = None
+        if wal_dir:
+            self.wal_options = dict(directory=wal_dir, durability=durability,
+                                    commit_interval=commit_interval, sync_interval=sync_interval)
+        self.wal = None
+        # serves history requests out of the write-ahead log once it's open
+        self.history_reader = None
+        # the most recent messages and how many of them a new client is sent
+        self.history = HistoryRing(history_messages, history_bytes)
+        self.replay_messages = replay_messages
+        # the most recent room messages, never replayed to everyone but there for members resuming
+        self.room_history = HistoryRing(history_messages, history_bytes)
+        # makes adding a client and remembering a message for replay atomic, so a
+        # new client sees every message exactly once, in the replay or live
+        self.history_lock = threading.Lock()
+        # who is in which room, room messages only go to the room's connections
+        self.rooms = RoomIndex()
+        # who is logged in as whom, direct messages go straight to the one connection
+        self.users = UserIndex()
+        # the idempotency keys of recent messages, so a client resending one after a reconnect doesn't repeat it
+        self.delivered = DeliveredIds()
+        # whether we number messages, a backup only does once it has taken over, and what
+        # clients sent a backup in the meantime, sent on first once it has
+        self.taking_messages = True
+        self.waiting = deque()
+        self.waiting_lock = threading.Lock()
+        # the hub that orders several workers' broadcasts, only a threaded primary worker has one
+        self.bus = None
+        # counters, gauges and histograms for the stats endpoint, they do nothing without a port
+        self.stats_port = stats_port
+        self.metrics = ServerMetrics(enabled=stats_port is not None)
+
+    @abc.abstractmethod
+    def broadcast_frame(self, frame: bytes, sender):
+        """
+        number, replicate, log and fan out a frame, each engine in its own way.
+
+        Args:
+            frame: the complete encoded frame
+            sender: the connection it came from, which doesn't get it back, or None
+        """
+
+    def handle_frame(self, connection, frame_type: int, frame) -> bool:
+        """
+        act on one frame from a client.
+
+        Args:
+            connection: the client it came from
+            frame_type: the frame's type
+            frame: the whole encoded frame, a view of the receive buffer that's only
+                good until the next read, anything kept has to be copied
+
+        Returns:
+            false if the client is done and should be disconnected
+        """
+        payload = frame[FRAME_HEADER.size:]
+        if frame_type == FRAME_HISTORY:
+            # history requests are answered from the write-ahead log
+            self.send_history(connection, payload)
+        elif frame_type == FRAME_RESUME:
+            self.resume(connection, payload)
+        elif frame_type == FRAME_CONTROL:
+            self.control(connection, payload)
+        elif frame_type == FRAME_ROOM:
+            self.room_command(connection, payload)
+        elif frame_type == FRAME_IDENTIFY:
+            self.identify(connection, payload)
+        elif frame_type == FRAME_DIRECT:
+            self.direct(connection, payload)
+        elif frame_type == FRAME_ROOM_CHAT:
+            # relayed as it came to the room's members only
+            room, text = decode_room_message(payload)
+            if room and text:
+                self.message_received(connection, bytes(frame), len(payload))
+        elif frame_type == FRAME_TRACED:
+            # relayed as it came with our receive time added, there's no text to decode
+            if len(payload) > TRACE_HEADER.size:
+                self.message_received(connection, received_frame(payload, time.time()), len(payload))
+        elif not payload:
+            return False
+        elif frame_type == FRAME_CHAT:
+            # sent to all other clients as it came, copied once out of the receive
+            # buffer and never decoded, clients decode it for themselves
+            self.message_received(connection, bytes(frame), len(payload))
+        # nothing else a client sends is a message for everyone
+        return True
+
+    def primary_lost(self) -> bool:
+        # whether a backup's primary has gone and we may be about to take over from it
+        return False
+
+    def message_received(self, connection, frame: bytes, size: int):
+        # count a message from a client and send it to everyone it's for
+        if not self.taking_messages:
+            with self.waiting_lock:
+                if not self.taking_messages:
+                    self.hold_message(connection, frame, size)
+                    return
+        self.accept_message(connection, frame, size)
+
+    def accept_message(self, connection, frame: bytes, size: int):
+        self.metrics.messages_in.inc()
+        self.metrics.bytes_in.inc(size)
+        with profiler.span("broadcast"):
+            self.broadcast_frame(frame, connection)
+
+    def hold_message(self, connection, frame: bytes, size: int):
+        # the primary numbers every message, ours would clash with its numbers and resuming
+        # clients would skip messages. once it's gone we keep them for when we take over,
+        # plain and room messages have no receipt and their clients would never send them again
+        if self.primary_lost() and len(self.waiting) < WAITING_MESSAGES:
+            self.waiting.append((connection, frame, size))
+            return
+        connection.send(NOT_PRIMARY_FRAME)
+
+    def take_messages(self):
+        """
+        start numbering messages once a backup has taken over.
+
+        what clients sent while the primary was gone goes out first, in the order it came,
+        and anything new waits behind it. call it once the replication log carries on
+        from the primary's numbering.
+        """
+        with self.waiting_lock:
+            while self.waiting:
+                self.accept_message(*self.waiting.popleft())
+            self.taking_messages = True
+
+    def refuse_waiting(self):
+        # the primary is back and numbers messages again, so what we held was never sent
+        with self.waiting_lock:
+            waiting = list(self.waiting)
+            self.waiting.clear()
+        for connection, _, _ in waiting:
+            connection.send(NOT_PRIMARY_FRAME)
+
+    def client_gone(self, connection):
+        # forget a client that disconnected, its member keeps its rooms for when it's back
+        self.clients.remove(connection)
+        self.rooms.drop(connection)
+        change = self.users.drop(connection)
+        if change is not None and self.is_running:
+            self.broadcast_frame(change, connection)
+
+    def add_client(self, connection):
+        # queue the replay as one frame-aligned chunk so it goes out in one write,
+        # nothing here waits on the new client's socket
+        with self.history_lock:
+            replay = self.history.tail(self.replay_messages)
+            if replay:
+                connection.send(b''.join(replay))
+            self.clients.add(connection)
+
+    def send_history(self, connection, payload):
+        # the frames are slices of the mapped log, so the client's writer sends
+        # them without them ever being copied, only the reply at the end is new
+        if self.history_reader is not None:
+            frames = self.history_reader.frames(payload)
+        else:
+            seq, timestamp, _ = decode_history(payload)
+            frames = [encode_history(seq, timestamp)]
+        for frame in frames:
+            # other rooms' messages are in the log too
+            if not self.rooms.can_see(connection, frame):
+                continue
+            if not connection.send(frame):
+                break
+
+    def resume(self, connection, payload):
+        # a client back after losing its connection, to us or to the server we took
+        # over from, send it the messages numbered after the last one it got
+        seq, _ = decode_resume(payload)
+        with self.history_lock:
+            frames = frames_after(self.history.tail(), seq)
+            room_frames = frames_after(self.room_history.tail(), seq)
+        # and the messages from the rooms it's in, which its rooms restore has just put it back in
+        frames += [frame for frame in room_frames if self.rooms.can_see(connection, frame)]
+        frames = sorted(frames, key=seq_of)[:HISTORY_LIMIT]
+        for frame in frames:
+            if not connection.send(frame):
+                return
+        last = seq_of(frames[-1]) if frames else seq
+        connection.send(encode_resume(last, len(frames)))
+
+    def control(self, connection, payload):
+        # profiling commands from someone on this machine, the reply goes back as a control frame
+        reply = profiler.command(connection.address, bytes(payload).decode('utf-8', 'replace').strip())
+        if reply is not None:
+            connection.send(encode_message(reply, FRAME_CONTROL))
+
+    def room_command(self, connection, payload):
+        # a join or leave takes effect for this connection straight away, the change
+        # then goes the way messages go so the backup and other workers see it in order
+        replies, change = self.rooms.command(connection, payload)
+        for reply in replies:
+            connection.send(reply)
+        if change is not None:
+            self.broadcast_frame(change, connection)
+
+    def identify(self, connection, payload):
+        # log the connection in, then tell the backup and the other workers who is online
+        replies, change = self.users.identify(connection, bytes(payload).decode('utf-8'))
+        for reply in replies:
+            connection.send(reply)
+        if change is not None:
+            self.broadcast_frame(change, connection)
+
+    def direct(self, connection, payload):
+        # one lookup and one send, a direct message never touches the other clients, the log or the backup
+        username, frame = self.users.route(connection, payload)
+        if username is None:
+            connection.send(encode_message(frame, FRAME_CONTROL))
+            return
+        recipient = self.users.connection_of(username)
+        if recipient is not None:
+            recipient.send(frame)
+        elif self.bus is not None:
+            # they're on another worker, the hub takes it to every worker addressed to them
+            self.bus.publish(encode_direct(username, frame), None)
+        else:
+            # kept for them, they may be reconnecting after a failover
+            self.users.hold(username, frame)
+
+    def apply_change(self, frame) -> bool:
+        # membership and presence frames only change our tables, true if it was one of them
+        if is_room_frame(frame):
+            self.rooms.apply_frame(frame)
+            return True
+        if is_presence_frame(frame):
+            self.users.apply_frame(frame)
+            return True
+        return False
+
+    def backup_hello(self, hello) -> bool:
+        # the backup answers our hello with its own, one that has followed a newer
+        # primary than us means a backup took over from us, so we keep our data to ourselves
+        if hello.epoch > self.epoch:
+            print(f"Backup {hello.node_id} is at epoch {hello.epoch}, ahead of our {self.epoch}, not replicating to it")
+            return False
+        print(f"Backup server {hello.node_id} at epoch {hello.epoch}")
+        return True
+
+    def recover_log(self) -> int:
+        """
+        put the newest messages from a write-ahead log we wrote before back in memory,
+        for clients resuming across our restart and for the backup's snapshot.
+
+        Returns:
+            the sequence number the newest logged message was given, 0 without a log
+        """
+        if self.wal is None:
+            return 0
+        start = max(self.wal.last_seq - HISTORY_LIMIT + 1, 1)
+        frames = [bytes(frame) for _, _, frame in self.wal.replay(start)]
+        with self.history_lock:
+            for frame in frames:
+                if is_room_message(frame):
+                    self.room_history.append(frame)
+                else:
+                    self.history.append(frame)
+        # the log numbers only messages, so the last one's number is at least as high as its record's
+        return max(self.wal.last_seq, last_seq_logged(frames))
+
+    def queue_depths(self):
+        # how many frames are waiting for each client, keyed by address
+        return {client.address: client.queue_depth() for client in self.clients.snapshot()}
+
+
+class ThreadedServer(ChatServerCore):
+    """
+    the thread per client engine: accepting, serving clients and replicating to a backup.
+
+    a primary runs all of it from the start, a backup only serves clients
+    until it's promoted, then replicates to a backup of its own the same way.
+    """
+
+    def __init__(self, port: int, replication_mode: str = MODE_ASYNC, ack_timeout: float = DEFAULT_ACK_TIMEOUT,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL, backup_address: tuple = None, **options):
+        super().__init__(port, **options)
+        # the socket we accept clients on
+        self.server_socket = None
+        # where the backup server listens, we always dial it
+        self.backup_address = backup_address
+        # flag to track if we're connected to the backup server
+        self.backup_connected = False
+        # outbound queue and writer for the backup socket
+        self.backup_link = None
+        # how long the link to the backup may go quiet before we send a heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        # when we last sent the backup anything, by time.monotonic
+        self.replicated_at = 0.0
+        # numbers everything we replicate and tracks the backup's acks
+        self.replication_log = ReplicationLog(replication_mode, ack_timeout)
+        # makes numbering an entry and queueing it for the backup one step,
+        # so entries always reach the backup in sequence order. reentrant so
+        # deliver can take its fan out turn in the same step
+        self.replication_lock = threading.RLock()
+        # fan out follows the numbering even when the waits before it finish out of order
+        self.turns = FanOutTurns()
+        self.metrics.watch(self)
+
+    def listen(self, port: int, reuse_port: bool = False):
+        # create a socket to listen for connections on every interface
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # allow reusing the port if it's still in use
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # every worker listens on the same port and the kernel spreads connections between them
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            server_socket.bind(('0.0.0.0', port))
+            server_socket.listen(LISTEN_BACKLOG)
+        except OSError:
+            server_socket.close()
+            raise
+        return server_socket
+
+    def accept_clients(self, server_socket):
+        # main loop to accept new connections
+        while self.is_running:
+            try:
+                # wait for a new connection
+                client_socket, address = server_socket.accept()
+                print(f"New connection from {address}")
+
+                # start a thread to find out who it is and then handle its messages
+                client_thread = threading.Thread(
+                    target=self.greet,
+                    args=(client_socket, address),
+                    daemon=True
+                )
+                client_thread.start()
+
+            except Exception as e:
+                if self.is_running:
+                    print(f"Error accepting connection: {e}")
+
+    def greet(self, client_socket, address):
+        # a connection is a client unless its hello says otherwise, we never go by its address
+        try:
+            hello = read_hello(client_socket)
+        except (OSError, ProtocolError) as e:
+            print(f"Error greeting {address}: {e}")
+            client_socket.close()
+            return
+        if hello is not None and hello.role == ROLE_PEER:
+            self.peer_connected(client_socket, address, hello)
+            return
+        if hello is not None:
+            print(f"Client {hello.node_id} connected from {address}")
+
+        # give the client its own outbound queue and writer thread
+        connection = ClientConnection(client_socket, address, self.queue_frames,
+                                      self.queue_bytes, self.slow_consumer_policy,
+                                      self.flush_delay, self.flush_bytes)
+        connection.start()
+
+        # catch the client up on recent messages and add it to our list, then handle its messages
+        self.add_client(connection)
+        self.handle_client(connection)
+
+    def peer_connected(self, peer_socket, address, hello):
+        # we dial our backup, nothing replicates to a primary
+        print(f"Refused {hello.node_id} at {address}, it wants to replicate to us but we're the primary")
+        peer_socket.close()
+
+    def handle_client(self, connection):
+        # handle messages from a single client
+        reader = get_reader(connection.sock)
+        while self.is_running and not connection.closed:
+            try:
+                # get a frame from the client, it's read in place in our receive buffer
+                # and is only good until the next read
+                with profiler.span("receive_frame"):
+                    received = reader.read_view()
+                if received is None or not self.handle_frame(connection, *received):
+                    break
+            except Exception as e:
+                if not connection.closed:
+                    print(f"Error handling client {connection.address}: {e}")
+                break
+
+        self.client_gone(connection)
+        connection.close()
+        # nothing reads this socket again, so its receive buffer can go to the next connection
+        release_reader(connection.sock)
+        print(f"Client {connection.address} disconnected")
+
+    def connect_to_backup(self):
+        # keep the link to the backup up, reconnecting whenever it drops
+        heartbeat_thread = threading.Thread(target=self.send_heartbeat, daemon=True)
+        heartbeat_thread.start()
+        while self.is_running:
+            if self.backup_link is None:
+                try:
+                    # connect to the backup and say we're the server it should follow
+                    backup_socket = socket.create_connection(self.backup_address, timeout=CONNECT_TIMEOUT)
+                    backup_socket.settimeout(None)
+                    send_encoded(backup_socket, encode_hello(ROLE_PEER, self.epoch, self.node_id))
+                    self.attach_backup(backup_socket, self.backup_address)
+                    print("Connected to backup server")
+                except Exception as e:
+                    print(f"Failed to connect to backup server: {e}")
+            time.sleep(1)
+
+    def attach_backup(self, backup_socket, address):
+        # the backup link gets the same batching writer as clients so
+        # replication never blocks whoever is broadcasting
+        self.backup_link = ClientConnection(backup_socket, address, DEFAULT_MAX_FRAMES,
+                                            BACKUP_QUEUE_BYTES, POLICY_DISCONNECT,
+                                            self.flush_delay, self.flush_bytes)
+        self.backup_link.start()
+
+        # the backup tells us where it's up to and then acks what it applies on
+        # the same socket, live entries only start flowing once it has caught up
+        ack_thread = threading.Thread(target=self.read_acks, args=(self.backup_link,), daemon=True)
+        ack_thread.start()
+
+    def read_acks(self, link):
+        # keep reading from the backup until the link goes away
+        while self.is_running and not link.closed:
+            try:
+                frame = receive_frame(link.sock)
+            except Exception:
+                frame = None
+            if frame is None:
+                break
+            frame_type, payload = frame
+            if frame_type == FRAME_ACK:
+                self.replication_log.ack(decode_ack(payload))
+            elif frame_type == FRAME_CATCHUP:
+                log_id, seq, _ = decode_position(payload)
+                self.catch_up_backup(link, log_id, seq)
+            elif frame_type == FRAME_HELLO and not self.backup_hello(decode_hello(payload)):
+                break
+        if link is self.backup_link:
+            self.lost_backup()
+
+    def catch_up_backup(self, link, log_id, seq):
+        # send the backup what it missed, then the whole member table and who is
+        # online, which it can't get from a snapshot of messages, holding the lock
+        # so no live entry can sneak in ahead of them, then let live entries through
+        with self.replication_lock:
+            frames = self.replication_log.catch_up(log_id, seq)
+            for frame in frames + self.rooms.snapshot() + self.users.snapshot():
+                link.send(frame)
+            self.backup_connected = True
+        print(f"Backup caught up from {seq} to {self.replication_log.last_seq} with {len(frames)} frames")
+
+    def lost_backup(self):
+        # stop replicating and let anyone waiting on an ack carry on
+        with self.replication_lock:
+            if self.backup_link is None:
+                return
+            self.backup_link.close()
+            self.backup_link = None
+            self.backup_connected = False
+        self.replication_log.reset()
+        print("Lost connection to backup server")
+
+    def open_wal(self):
+        # open the write-ahead log and start its group commit thread
+        if self.wal_options is None or self.wal is not None:
+            return
+        self.wal = WriteAheadLog(**self.wal_options)
+        self.wal.start()
+        self.history_reader = HistoryReader(self.wal.directory)
+        print(f"Logging messages to {self.wal.directory} from {self.wal.last_seq + 1} "
+              f"with {self.wal.durability} durability")
+
+    def persist(self, frame):
+        # queue the frame for the next group commit, returns the record to wait
+        # for before fan out, or None if we have no log or its mode doesn't wait
+        wal = self.wal
+        if wal is None:
+            return None
+        seq = wal.append(frame)
+        return seq if wal.durability == DURABILITY_BATCH else None
+
+    def replicate(self, frame, seq=None):
+        # number the frame and queue it for the backup in one step, every
+        # message goes in the log so a backup that connects later can catch up.
+        # seq is the number when someone else gives it, like the hub with several workers.
+        # returns the seq, the frame with it stamped in and whether the backup was sent it
+        with self.replication_lock:
+            frame = sequenced(frame, seq if seq is not None else self.replication_log.last_seq + 1)
+            seq, entry = self.replication_log.append(frame, seq)
+            if not self.backup_connected:
+                return seq, frame, False
+            link = self.backup_link
+            sent = link.send(entry)
+            self.replicated_at = time.monotonic()
+        if not sent:
+            self.lost_backup()
+        return seq, frame, sent
+
+    def replication_lag(self):
+        # how far behind the backup is, see ReplicationLog.lag
+        return self.replication_log.lag()
+
+    def send_heartbeat(self):
+        # send the backup a heartbeat whenever the link has been quiet for a heartbeat
+        # interval, while messages are flowing they tell it we're alive instead
+        while self.is_running:
+            quiet_for = time.monotonic() - self.replicated_at
+            link = self.backup_link
+            if link is not None and quiet_for >= self.heartbeat_interval:
+                if link.send(HEARTBEAT_FRAME):
+                    self.metrics.heartbeats_sent.inc()
+                    self.replicated_at = time.monotonic()
+                else:
+                    self.lost_backup()
+                quiet_for = 0
+            time.sleep(max(self.heartbeat_interval - quiet_for, CHECK_INTERVAL))
+
+    def broadcast(self, message, sender):
+        # encode and frame the message once, the backup and every client share these bytes
+        self.broadcast_frame(encode_message(message), sender)
+
+    def broadcast_frame(self, frame, sender):
+        self.deliver(frame, sender)
+
+    def deliver(self, frame, sender):
+        # a membership or presence change only has to reach our tables and the
+        # backup, it's not a message so it stays out of the log on disk
+        if self.apply_change(frame):
+            self.replicate(frame)
+            return
+
+        # a traced message a client resent after reconnecting only gets its receipt again
+        key = trace_of(frame).trace_id if is_traced(frame) else None
+        if key is not None:
+            seq = self.delivered.claim(key)
+            if seq is not None:
+                if sender is not None:
+                    sender.send(encode_receipt(key, seq))
+                return
+
+        # number it and send it to the backup server if it's connected, then log
+        # it to disk, the disk and the backup work on it at the same time
+        with self.replication_lock:
+            seq, frame, sent = self.replicate(frame)
+            turn = self.turns.take()
+        try:
+            wal_seq = self.persist(frame)
+            if key is not None:
+                self.delivered.record(key, seq)
+
+            # in the semi-sync and sync modes wait for the backup to ack it, and with
+            # batch durability for it to be fsynced, before fan out
+            acked = False
+            if sent:
+                acked = self.replication_log.wait_for_ack(seq, lambda: self.backup_connected)
+            if wal_seq is not None:
+                self.wal.wait(wal_seq)
+
+            # messages numbered before this one go out first, whichever of them finished waiting first
+            self.turns.wait(turn)
+            # a traced message gets the time the backup acked it, if we waited for that, and when fan out began
+            if key is not None:
+                now = time.time()
+                frame = stamp(frame, replicated=now if acked else None, fanned_out=now)
+            self.fan_out(frame, sender)
+        finally:
+            self.turns.done(turn)
+        # and once it's out the sender can stop keeping it
+        if key is not None and sender is not None:
+            sender.send(receipt_for(frame))
+
+    def fan_out(self, frame, sender):
+        # remember the message for clients that join later and queue it for all
+        # clients except the sender, the writer threads do the actual sending so
+        # nobody here waits on a slow reader
+        started = time.perf_counter()
+        with profiler.span("fan_out"):
+            if is_room_message(frame):
+                # only the room's connections get it, and it's not replayed to everyone who connects
+                with self.history_lock:
+                    self.room_history.append(frame)
+                recipients = self.rooms.recipients(room_of(frame))
+            else:
+                with self.history_lock:
+                    self.history.append(frame)
+                    recipients = self.clients.snapshot()
+            disconnected_clients = []
+            sent = 0
+            for client in recipients:
+                if client is not sender:  # don't send the message back to the sender
+                    if client.send(frame):
+                        sent += 1
+                    else:
+                        disconnected_clients.append(client)
+        elapsed = time.perf_counter() - started
+        self.metrics.fanout_seconds.observe(elapsed)
+        profiler.record_broadcast(elapsed, len(recipients))
+        self.metrics.messages_out.inc(sent)
+        self.metrics.bytes_out.inc(sent * len(frame))
+
+        # remove any clients that disconnected or were too slow to keep up
+        for client in disconnected_clients:
+            self.rooms.drop(client)
+            if self.clients.remove(client):
+                client.close()
+
+    def stop(self):
+        # stop the server and clean up
+        self.is_running = False
+        if self.server_socket:
+            self.server_socket.close()
+        for client in self.clients.snapshot():
+            client.close()
+        link = self.backup_link
+        if link:
+            link.close()
+        if self.wal:
+            self.wal.close()
+        self.metrics.close()
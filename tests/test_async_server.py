@@ -0,0 +1,138 @@
+import unittest
+import socket
+import threading
+import time
+from common import (
+    PRIMARY_PORT, FRAME_LEADER, FRAME_DIRECT, FRAME_ROOM, FRAME_IDENTIFY, encode_frame, send_encoded, send_message,
+    receive_message, receive_frame
+)
+from handshake import ROLE_CLIENT, encode_hello
+from replication import decode_leader
+from async_server import AsyncPrimaryServer, AsyncBackupServer
+
+class TestAsyncServer(unittest.TestCase):
+    def setUp(self):
+        """start an asyncio primary and backup on test ports."""
+        self.primary_port = PRIMARY_PORT + 400
+        self.backup_port = PRIMARY_PORT + 401
+        # heartbeats ten times a second so the backup gives up on a stopped primary quickly
+        self.backup = AsyncBackupServer(port=self.backup_port, takeover_port=self.primary_port,
+                                        heartbeat_interval=0.1, acceptable_pause=0.1)
+        self.primary = AsyncPrimaryServer(port=self.primary_port, heartbeat_interval=0.1,
+                                          backup_address=('127.0.0.1', self.backup_port))
+        self.threads = []
+        for server in (self.backup, self.primary):
+            thread = threading.Thread(target=server.start, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        # keep track of all client sockets we open
+        self.clients = []
+        # wait for the servers to start and the primary to reach the backup
+        deadline = time.time() + 5
+        while time.time() < deadline and not self.backup.primary_connected:
+            time.sleep(0.05)
+
+    def tearDown(self):
+        """stop both servers and close our clients."""
+        for client in self.clients:
+            try:
+                client.close()
+            except:
+                pass
+        # the background tasks notice this and let the loops finish
+        self.primary.is_running = False
+        self.backup.is_running = False
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+    def connect(self, port):
+        """open a client socket to one of the servers."""
+        client = socket.create_connection(('localhost', port))
+        client.settimeout(2)
+        self.clients.append(client)
+        return client
+
+    def test_broadcast_and_replication(self):
+        """test that a message reaches the other clients and the backup's clients."""
+        self.assertTrue(self.backup.primary_connected, "Primary should connect to the backup")
+        backup_client = self.connect(self.backup_port)
+        sender = self.connect(self.primary_port)
+        receivers = [self.connect(self.primary_port) for _ in range(3)]
+        # wait until the server has accepted everyone
+        deadline = time.time() + 2
+        while time.time() < deadline and len(self.primary.clients) < 4:
+            time.sleep(0.05)
+
+        send_message(sender, "Hello from asyncio")
+        for client in receivers + [backup_client]:
+            self.assertEqual(receive_message(client), "Hello from asyncio")
+        # the backup should ack the entry it applied
+        deadline = time.time() + 2
+        while time.time() < deadline and self.primary.replication_lag()["entries"]:
+            time.sleep(0.05)
+        self.assertEqual(self.primary.replication_lag()["entries"], 0)
+        self.assertEqual(self.backup.applied_seq, 1)
+
+    def test_replay_on_join(self):
+        """test that a client that connects late is sent what it missed."""
+        sender = self.connect(self.primary_port)
+        for i in range(3):
+            send_message(sender, f"earlier {i}")
+        deadline = time.time() + 2
+        while time.time() < deadline and len(self.primary.history) < 3:
+            time.sleep(0.05)
+        late = self.connect(self.primary_port)
+        self.assertEqual([receive_message(late) for _ in range(3)], [f"earlier {i}" for i in range(3)])
+
+    def test_promotion_after_primary_stops(self):
+        """test that the backup promotes itself once heartbeats stop."""
+        self.primary.is_running = False
+        self.threads[1].join(timeout=5)
+        deadline = time.time() + 5
+        while time.time() < deadline and not self.backup.promoted:
+            time.sleep(0.05)
+        self.assertTrue(self.backup.promoted, "Backup should promote itself")
+
+    def test_promoted_backup_takes_over_the_port(self):
+        """test that a promoted backup tells its clients and takes clients on the primary's port."""
+        client = socket.create_connection(('127.0.0.1', self.backup_port))
+        send_encoded(client, encode_hello(ROLE_CLIENT, 0, "test"))
+        client.settimeout(2)
+        self.clients.append(client)
+        deadline = time.time() + 2
+        while time.time() < deadline and not self.backup.clients:
+            time.sleep(0.05)
+        self.primary.is_running = False
+        self.threads[1].join(timeout=5)
+        frame_type, payload = receive_frame(client)
+        self.assertEqual((frame_type, decode_leader(payload)), (FRAME_LEADER, self.primary_port))
+        deadline = time.time() + 5
+        while time.time() < deadline and self.backup.takeover_server is None:
+            time.sleep(0.05)
+        moved = self.connect(self.primary_port)
+        send_message(moved, "on the old port")
+        self.assertEqual(receive_message(client), "on the old port")
+
+    def test_malformed_frames_drop_only_their_client(self):
+        """test that a frame the server can't make sense of closes that connection and nothing else."""
+        # without the handler catching it, asyncio's fatal error path reports it to the loop
+        errors = []
+        self.primary.loop.set_exception_handler(lambda loop, context: errors.append(context))
+        bystander = self.connect(self.primary_port)
+        send_encoded(bystander, encode_hello(ROLE_CLIENT, 0, "bystander"))
+        for frame in (encode_frame(FRAME_DIRECT, b""), encode_frame(FRAME_ROOM, b"\x01"),
+                      encode_frame(FRAME_IDENTIFY, b"\xff\xfe")):
+            client = self.connect(self.primary_port)
+            send_encoded(client, encode_hello(ROLE_CLIENT, 0, "broken"))
+            send_encoded(client, frame)
+            # whatever was replayed comes first, then the server hangs up
+            while receive_frame(client) is not None:
+                pass
+        sender = self.connect(self.primary_port)
+        send_encoded(sender, encode_hello(ROLE_CLIENT, 0, "sender"))
+        send_message(sender, "still serving")
+        self.assertEqual(receive_message(bystander), "still serving")
+        self.assertEqual(errors, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import unittest
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from common import (
+    PRIMARY_PORT, FRAME_HEADER, FRAME_CONTROL, FRAME_IDENTIFY, FRAME_ROOM, encode_message, send_encoded,
+    send_message, receive_message, receive_frame
+)
+from connection import ClientConnection
+from handshake import ROLE_CLIENT, encode_hello
+from bus import FanoutHub, BusLink, complete_frames, CLAIM_USER
+from primary_server import PrimaryServer
+from rooms import ROOM_JOIN, encode_room
+
+class TestFanoutHub(unittest.TestCase):
+    def setUp(self):
+        """start a hub on a unix socket in a temp dir."""
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "hub.sock")
+        ready = threading.Event()
+        threading.Thread(target=FanoutHub(self.path).run, args=(ready,), daemon=True).start()
+        ready.wait()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_complete_frames(self):
+        """test that only whole frames are passed on."""
+        frame = encode_message("hello")
+        self.assertEqual(complete_frames(frame + frame[:3]), len(frame))
+        self.assertEqual(complete_frames(frame[:FRAME_HEADER.size]), 0)
+
+    def test_one_order_for_every_worker(self):
+        """test that every worker sees every worker's frames in the same order."""
+        links = [BusLink(self.path, worker_id) for worker_id in range(3)]
+        time.sleep(0.1)
+        for i in range(30):
+            links[i % 3].publish(encode_message(f"message {i}"), f"sender {i}")
+        orders = []
+        for link in links:
+            received = [link.receive() for _ in range(30)]
+            orders.append([frame for frame, _ in received])
+            # a worker gets its own senders back, and nobody else's
+            self.assertEqual([sender for _, sender in received if sender is not None],
+                             [f"sender {i}" for i in range(link.worker_id, 30, 3)])
+        self.assertEqual(orders[0], orders[1])
+        self.assertEqual(orders[0], orders[2])
+        self.assertEqual(sorted(orders[0]), sorted(encode_message(f"message {i}") for i in range(30)))
+        for link in links:
+            link.close()
+
+    def test_late_worker_gets_the_same_numbers(self):
+        """test that the hub numbers on from worker 0's log and a worker joining late gets its numbers too."""
+        first = BusLink(self.path, 0, seq=41)
+        first.publish(encode_message("before"), "a")
+        first.receive()
+        self.assertEqual(first.seq, 42)
+        late = BusLink(self.path, 1)
+        late.publish(encode_message("after"), "b")
+        for link in (first, late):
+            frame, _ = link.receive()
+            self.assertEqual((frame, link.seq), (encode_message("after"), 43))
+            link.close()
+
+class TestWorkers(unittest.TestCase):
+    def setUp(self):
+        """start a hub and two primary workers sharing a port in this process."""
+        self.directory = tempfile.mkdtemp()
+        path = os.path.join(self.directory, "hub.sock")
+        ready = threading.Event()
+        threading.Thread(target=FanoutHub(path).run, args=(ready,), daemon=True).start()
+        ready.wait()
+        self.port = PRIMARY_PORT + 600
+        self.workers = [PrimaryServer(port=self.port, bus_path=path, worker_id=i) for i in range(2)]
+        for worker in self.workers:
+            threading.Thread(target=worker.start, daemon=True).start()
+        deadline = time.time() + 5
+        while time.time() < deadline and not all(worker.bus for worker in self.workers):
+            time.sleep(0.05)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for worker in self.workers:
+            worker.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def connect(self):
+        client = socket.create_connection(('127.0.0.1', self.port))
+        send_encoded(client, encode_hello(ROLE_CLIENT, 0, "test"))
+        client.settimeout(2)
+        self.clients.append(client)
+        return client
+
+    def test_broadcast_reaches_every_worker(self):
+        """test that a message reaches clients no matter which worker accepted them."""
+        clients = [self.connect() for _ in range(8)]
+        deadline = time.time() + 2
+        while time.time() < deadline and sum(len(w.clients) for w in self.workers) < 8:
+            time.sleep(0.05)
+        send_message(clients[0], "hello workers")
+        for client in clients[1:]:
+            self.assertEqual(receive_message(client), "hello workers")
+        # only worker 0 numbers messages for the backup
+        self.assertEqual(self.workers[0].replication_log.last_seq, 1)
+        self.assertEqual(self.workers[1].replication_log.last_seq, 0)
+
+    def attach(self, worker):
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(2)
+        connection = ClientConnection(ours, "test")
+        connection.start()
+        worker.add_client(connection)
+        self.clients.append(theirs)
+        return connection, theirs
+
+    def test_names_are_claimed_once_across_workers(self):
+        """test that a username or member id in use on one worker is turned down on another until it's free."""
+        first, first_socket = self.attach(self.workers[0])
+        second, second_socket = self.attach(self.workers[1])
+        self.workers[0].identify(first, b"alice")
+        self.assertEqual(receive_frame(first_socket), (FRAME_IDENTIFY, b"alice"))
+        self.workers[1].identify(second, b"alice")
+        self.assertEqual(receive_frame(second_socket)[0], FRAME_CONTROL)
+        self.assertIsNone(self.workers[1].users.connection_of("alice"))
+
+        join = encode_room(ROOM_JOIN, "alice", "dev")
+        self.workers[0].room_command(first, join[FRAME_HEADER.size:])
+        self.assertEqual(receive_frame(first_socket), (FRAME_ROOM, join[FRAME_HEADER.size:]))
+        self.workers[1].room_command(second, join[FRAME_HEADER.size:])
+        self.assertEqual(receive_frame(second_socket)[0], FRAME_CONTROL)
+
+        # once its connection closes the name is free for the other worker's client
+        self.workers[0].client_gone(first)
+        deadline = time.time() + 2
+        while time.time() < deadline and ("alice" in {name for _, name in self.workers[1].claims.holders}):
+            time.sleep(0.01)
+        self.workers[1].identify(second, b"alice")
+        self.assertEqual(receive_frame(second_socket), (FRAME_IDENTIFY, b"alice"))
+        self.assertTrue(self.workers[0].claims.holds(CLAIM_USER, "alice", 1, id(second)))
+
+if __name__ == '__main__':
+    unittest.main()
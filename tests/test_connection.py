@@ -0,0 +1,193 @@
+import unittest
+import socket
+import threading
+import time
+from common import FRAME_CHAT, encode_frame, receive_message
+from connection import (
+    OutboundQueue, ClientConnection, ClientRegistry, POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT
+)
+from primary_server import PrimaryServer
+
+class TestOutboundQueue(unittest.TestCase):
+    def test_drop_oldest(self):
+        """test that a full queue throws away its oldest frames."""
+        queue = OutboundQueue(max_frames=3, max_bytes=1000, policy=POLICY_DROP_OLDEST)
+        for i in range(5):
+            self.assertTrue(queue.put(bytes([i])))
+        self.assertEqual(queue.drain(), [b'\x02', b'\x03', b'\x04'])
+        self.assertEqual(queue.dropped, 2)
+
+    def test_coalesce(self):
+        """test that a queue at its frame limit merges frames instead of dropping them."""
+        queue = OutboundQueue(max_frames=3, max_bytes=1000, policy=POLICY_COALESCE)
+        for i in range(5):
+            self.assertTrue(queue.put(bytes([i])))
+        self.assertEqual(b''.join(queue.drain()), bytes(range(5)))
+        self.assertEqual(queue.dropped, 0)
+
+    def test_coalesce_byte_limit(self):
+        """test that coalesce over its byte limit drops only the oldest frames, even out of a merged run."""
+        queue = OutboundQueue(max_frames=3, max_bytes=10, policy=POLICY_COALESCE)
+        for i in range(8):
+            self.assertTrue(queue.put(bytes([i, i])))
+        self.assertLessEqual(queue.queued_bytes, 10)
+        self.assertEqual(b''.join(queue.drain()), b''.join(bytes([i, i]) for i in range(3, 8)))
+        self.assertEqual(queue.dropped, 3)
+
+    def test_disconnect(self):
+        """test that a queue over its byte limit tells us to hang up."""
+        queue = OutboundQueue(max_frames=100, max_bytes=10, policy=POLICY_DISCONNECT)
+        self.assertTrue(queue.put(b'x' * 10))
+        self.assertFalse(queue.put(b'y'))
+        self.assertEqual(queue.queued_bytes, 10)
+
+    def test_byte_limit(self):
+        """test that the byte limit holds even when the frame limit isn't reached."""
+        queue = OutboundQueue(max_frames=100, max_bytes=10, policy=POLICY_DROP_OLDEST)
+        for _ in range(4):
+            queue.put(b'abcd')
+        self.assertLessEqual(queue.queued_bytes, 10)
+        self.assertEqual(len(queue), 2)
+
+
+class TestClientConnection(unittest.TestCase):
+    def setUp(self):
+        """set up a server side connection and the client end of it."""
+        self.server_sock, self.client_sock = socket.socketpair()
+        self.client_sock.settimeout(2)
+
+    def tearDown(self):
+        """clean up after each test."""
+        self.server_sock.close()
+        self.client_sock.close()
+
+    def test_messages_are_delivered(self):
+        """test that queued messages reach the client in order."""
+        connection = ClientConnection(self.server_sock, "test")
+        connection.start()
+        for i in range(10):
+            self.assertTrue(connection.send_message(f"message {i}"))
+        for i in range(10):
+            self.assertEqual(receive_message(self.client_sock), f"message {i}")
+        connection.close()
+
+    def test_queued_frames_are_coalesced(self):
+        """test that a backlog of frames goes out in far fewer sends than frames."""
+        connection = ClientConnection(self.server_sock, "test", max_frames=5000)
+        # queue up more frames than one sendmsg can take before the writer starts
+        for i in range(3000):
+            connection.send_message(f"burst {i}")
+        connection.start()
+        for i in range(3000):
+            self.assertEqual(receive_message(self.client_sock), f"burst {i}")
+        self.assertEqual(connection.frames_sent, 3000)
+        self.assertLess(connection.send_calls, 30)
+        connection.close()
+
+    def test_slow_reader_does_not_block_sender(self):
+        """test that sending to a client that never reads returns straight away."""
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        connection = ClientConnection(self.server_sock, "slow", max_frames=16, max_bytes=64 * 1024)
+        connection.start()
+        frame = encode_frame(FRAME_CHAT, b'x' * 1024)
+        start = time.time()
+        for _ in range(2000):
+            connection.send(frame)
+        self.assertLess(time.time() - start, 1, "Sending should never wait on the socket")
+        self.assertLessEqual(connection.queue_depth(), 16)
+        self.assertGreater(connection.queue.dropped, 0)
+        connection.close()
+
+    def test_slow_reader_is_disconnected(self):
+        """test that the disconnect policy closes a client that falls too far behind."""
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        connection = ClientConnection(self.server_sock, "slow", max_bytes=16 * 1024,
+                                      policy=POLICY_DISCONNECT)
+        connection.start()
+        frame = encode_frame(FRAME_CHAT, b'x' * 1024)
+        results = [connection.send(frame) for _ in range(2000)]
+        self.assertFalse(results[-1])
+        self.assertTrue(connection.closed)
+
+class Client:
+    """stands in for a connection, the registry only needs somewhere to put the id."""
+    client_id = None
+
+class TestClientRegistry(unittest.TestCase):
+    def test_snapshot_is_stable(self):
+        """test that a snapshot taken before a change doesn't see it and the next one does."""
+        registry = ClientRegistry()
+        first, second = Client(), Client()
+        registry.add(first)
+        snapshot = registry.snapshot()
+        self.assertIs(registry.snapshot(), snapshot, "an unchanged registry shouldn't rebuild")
+        registry.add(second)
+        self.assertEqual(snapshot, (first,))
+        self.assertEqual(set(registry.snapshot()), {first, second})
+        self.assertNotEqual(first.client_id, second.client_id)
+
+    def test_remove_only_once(self):
+        """test that only the first of several removals of a client reports it."""
+        registry = ClientRegistry()
+        client = Client()
+        registry.add(client)
+        self.assertIn(client, registry)
+        self.assertTrue(registry.remove(client))
+        self.assertFalse(registry.remove(client))
+        self.assertFalse(registry.remove(Client()))
+        self.assertEqual((len(registry), registry.snapshot()), (0, ()))
+
+    def test_concurrent_churn(self):
+        """test that threads connecting and disconnecting while others iterate leave it consistent."""
+        registry = ClientRegistry()
+        stayers = [Client() for _ in range(50)]
+        for client in stayers:
+            registry.add(client)
+        stop = threading.Event()
+        errors = []
+
+        def churn():
+            for _ in range(2000):
+                client = Client()
+                registry.add(client)
+                if not registry.remove(client):
+                    errors.append("lost a client")
+
+        def iterate():
+            while not stop.is_set():
+                snapshot = registry.snapshot()
+                if not set(stayers) <= set(snapshot):
+                    errors.append("a snapshot missed a client that never left")
+
+        readers = [threading.Thread(target=iterate) for _ in range(2)]
+        writers = [threading.Thread(target=churn) for _ in range(4)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        stop.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(set(registry.snapshot()), set(stayers))
+
+class TestBroadcastFanout(unittest.TestCase):
+    def test_frame_is_encoded_once(self):
+        """test that every recipient gets the very same frame object."""
+        server = PrimaryServer()
+        # connections that are never started, so frames just sit in their queues
+        pairs = [socket.socketpair() for _ in range(4)]
+        connections = [ClientConnection(a, i) for i, (a, _) in enumerate(pairs)]
+        for connection in connections:
+            server.clients.add(connection)
+        server.broadcast("Hello everyone", connections[0])
+        frames = [client.queue.drain() for client in connections[1:]]
+        self.assertEqual(connections[0].queue_depth(), 0, "Sender should not get its own message")
+        self.assertTrue(all(f[0] is frames[0][0] for f in frames), "Recipients should share one frame")
+        self.assertEqual(frames[0][0], encode_frame(FRAME_CHAT, b"Hello everyone"))
+        for a, b in pairs:
+            a.close()
+            b.close()
+
+if __name__ == '__main__':
+    unittest.main()
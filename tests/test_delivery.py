@@ -0,0 +1,245 @@
+import unittest
+import socket
+import threading
+import time
+from common import (
+    FRAME_HEADER, FRAME_CHAT, FRAME_TRACED, FRAME_RECEIPT, FRAME_RESUME, FRAME_ROOM, FRAME_ROOM_CHAT, FRAME_CONTROL,
+    FRAME_LEADER, receive_frame, encode_message
+)
+from connection import ClientConnection
+from primary_server import PrimaryServer
+from backup_server import BackupServer
+from server_core import NOT_PRIMARY_FRAME, FanOutTurns
+from replication import encode_entry
+from tracing import encode_traced, decode_traced, received_frame, sequenced
+from rooms import (
+    ROOM_JOIN, ROOM_RESTORE, encode_room, encode_room_message, decode_room_message, decode_room_seq
+)
+from delivery import (
+    DeliveredIds, ClientSession, Endpoints, encode_receipt, decode_receipt, encode_resume, decode_resume,
+    frames_after
+)
+
+def payload_of(frame):
+    return frame[FRAME_HEADER.size:]
+
+class TestDelivery(unittest.TestCase):
+    def test_resends_are_claimed_once(self):
+        """test that only the first copy of a key is taken in and a resend gets its seq."""
+        delivered = DeliveredIds(max_ids=2)
+        self.assertIsNone(delivered.claim(7))
+        self.assertEqual(delivered.claim(7), 0)
+        delivered.record(7, 3)
+        self.assertEqual(delivered.claim(7), 3)
+        # the oldest keys are forgotten once the window is full
+        delivered.record(8, 4)
+        delivered.record(9, 5)
+        self.assertIsNone(delivered.claim(7))
+
+    def test_session_keeps_unacked_until_receipt(self):
+        """test that a sent message is resent after a reconnect until its receipt comes back."""
+        session = ClientSession()
+        frame = session.sending(encode_traced("hi", trace_id=5))
+        self.assertEqual(session.reconnect_frames(), [frame])
+        self.assertEqual(session.unacked_frames(), [frame])
+        session.receipt(payload_of(encode_receipt(5, 1)))
+        self.assertEqual(session.reconnect_frames(), [])
+
+    def test_session_drops_repeats_and_resumes(self):
+        """test that a message seen twice is only new once and a reconnect asks for what came after it."""
+        session = ClientSession()
+        trace, _ = decode_traced(payload_of(sequenced(encode_traced("hi", trace_id=9), 4)))
+        self.assertTrue(session.delivered(trace))
+        self.assertFalse(session.delivered(trace))
+        # our own messages come back in the replay too, and aren't new either
+        session.sending(encode_traced("mine", trace_id=10))
+        self.assertFalse(session.delivered(trace._replace(trace_id=10, seq=5)))
+        frames = session.reconnect_frames()
+        self.assertEqual(decode_resume(payload_of(frames[0])), (5, 0))
+        # a room message moves the resume position on too
+        session.numbered(6)
+        self.assertEqual(decode_resume(payload_of(session.reconnect_frames()[0])), (6, 0))
+
+    def test_endpoints_follow_the_leader(self):
+        """test that servers are tried in turn and an announced primary goes first."""
+        endpoints = Endpoints([("h", 1), ("h", 2)])
+        self.assertEqual(endpoints.advance(), ("h", 2))
+        self.assertEqual(endpoints.advance(), ("h", 1))
+        endpoints.prefer(("h", 2))
+        self.assertEqual(endpoints.addresses, [("h", 2), ("h", 1)])
+        self.assertEqual(endpoints.current(), ("h", 2))
+
+    def test_frames_after(self):
+        """test that a resume only gets traced messages numbered after where the client was."""
+        frames = [sequenced(encode_traced(f"m{seq}", trace_id=seq), seq) for seq in range(1, 5)]
+        self.assertEqual(frames_after(frames, 2), frames[2:])
+        self.assertEqual(frames_after(frames, 0, limit=1), frames[:1])
+        # room messages are numbered too, plain chat frames never are
+        room = sequenced(encode_room_message("dev", "hi"), 5)
+        self.assertEqual(frames_after(frames + [encode_message("plain"), room], 4), [room])
+
+class TestServerDelivery(unittest.TestCase):
+    def connect(self, server):
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(2)
+        connection = ClientConnection(ours, "test")
+        connection.start()
+        server.add_client(connection)
+        self.addCleanup(theirs.close)
+        self.addCleanup(connection.close)
+        return connection, theirs
+
+    def send_traced(self, server, sender, text, trace_id):
+        payload = payload_of(encode_traced(text, trace_id=trace_id))
+        server.broadcast_frame(received_frame(payload, 1.0), sender)
+
+    def test_resend_is_not_repeated(self):
+        """test that a message gets a number and a receipt, and a resend of it only the receipt."""
+        server = PrimaryServer()
+        self.addCleanup(server.stop)
+        sender, sender_socket = self.connect(server)
+        _, receiver_socket = self.connect(server)
+        self.send_traced(server, sender, "hi", 42)
+        frame_type, payload = receive_frame(receiver_socket)
+        self.assertEqual(frame_type, FRAME_TRACED)
+        self.assertEqual(decode_traced(payload)[0].seq, 1)
+        self.assertEqual(receive_frame(sender_socket), (FRAME_RECEIPT, payload_of(encode_receipt(42, 1))))
+
+        self.send_traced(server, sender, "hi", 42)
+        self.assertEqual(decode_receipt(receive_frame(sender_socket)[1]), (42, 1))
+        # the receiver's next frame is the next message, the resend never reached it
+        self.send_traced(server, sender, "next", 43)
+        self.assertEqual(decode_traced(receive_frame(receiver_socket)[1])[1], b"next")
+
+    def test_fan_out_follows_the_numbering(self):
+        """test that a message numbered later waits for an earlier one still waiting on the disk before fan out."""
+        server = PrimaryServer()
+        self.addCleanup(server.stop)
+        _, receiver_socket = self.connect(server)
+        # hold the first message up where it would wait for its fsync, after it was numbered
+        gate = threading.Event()
+        persist = server.persist
+
+        def slow_persist(frame):
+            if b"first" in frame:
+                gate.wait(5)
+            return persist(frame)
+        server.persist = slow_persist
+
+        first = threading.Thread(target=self.send_traced, args=(server, None, "first", 1))
+        first.start()
+        while server.replication_log.last_seq < 1:
+            time.sleep(0.01)
+        second = threading.Thread(target=self.send_traced, args=(server, None, "second", 2))
+        second.start()
+        second.join(0.3)
+        self.assertTrue(second.is_alive(), "The second message went out before the first")
+        gate.set()
+        first.join(5)
+        second.join(5)
+        seqs = [decode_traced(receive_frame(receiver_socket)[1])[0].seq for _ in range(2)]
+        self.assertEqual(seqs, [1, 2])
+        self.assertEqual([decode_traced(payload_of(frame))[0].seq for frame in server.history.tail()], [1, 2])
+
+    def test_a_failed_turn_keeps_the_order(self):
+        """test that a delivery that fails before its turn doesn't let the ones after it skip the one before."""
+        turns = FanOutTurns()
+        first, failed, third = turns.take(), turns.take(), turns.take()
+        turns.done(failed)
+        self.assertEqual(turns.serving, first)
+        turns.done(first)
+        self.assertEqual(turns.serving, third)
+
+    def test_backup_resumes_a_client_from_the_primary(self):
+        """test that a client moving to the backup gets only what it missed and its resend is dropped."""
+        server = BackupServer()
+        self.addCleanup(server.stop)
+        for seq in (1, 2, 3):
+            frame = sequenced(encode_traced(f"m{seq}", trace_id=100 + seq), seq)
+            server.apply_entry(payload_of(encode_entry(seq, frame)))
+        connection, client_socket = self.connect(server)
+        # the replay on connect
+        for _ in range(3):
+            receive_frame(client_socket)
+        server.resume(connection, payload_of(encode_resume(2)))
+        frame_type, payload = receive_frame(client_socket)
+        self.assertEqual((frame_type, decode_traced(payload)[1]), (FRAME_TRACED, b"m3"))
+        self.assertEqual(receive_frame(client_socket), (FRAME_RESUME, payload_of(encode_resume(3, 1))))
+        # the client had sent m3 itself and resends it, the backup already has it from the primary
+        self.send_traced(server, connection, "m3", 103)
+        self.assertEqual(decode_receipt(receive_frame(client_socket)[1]), (103, 3))
+
+    def test_backup_refuses_messages_until_promoted(self):
+        """test that a backup numbers no client message until it takes over, its numbers would clash."""
+        server = BackupServer(takeover_port=None)
+        self.addCleanup(server.stop)
+        connection, client_socket = self.connect(server)
+        frame = encode_traced("too early", trace_id=7)
+        self.assertTrue(server.handle_frame(connection, FRAME_TRACED, frame))
+        self.assertEqual(receive_frame(client_socket), (FRAME_CONTROL, payload_of(NOT_PRIMARY_FRAME)))
+        self.assertEqual(server.replication_log.last_seq, 0)
+        # once promoted the client's resend goes through
+        server.promote_to_primary()
+        self.assertEqual(receive_frame(client_socket)[0], FRAME_LEADER)
+        server.handle_frame(connection, FRAME_TRACED, frame)
+        self.assertEqual(decode_receipt(receive_frame(client_socket)[1]), (7, 1))
+
+    def test_backup_holds_messages_while_its_primary_is_gone(self):
+        """test that what clients send a backup that lost its primary goes out in order once it takes over."""
+        server = BackupServer(takeover_port=None)
+        self.addCleanup(server.stop)
+        server.apply_entry(payload_of(encode_entry(1, sequenced(encode_traced("before", trace_id=1), 1))))
+        # the primary's connection dropped and the failure detector hasn't given up on it yet
+        server.primary_connected = True
+        sender, sender_socket = self.connect(server)
+        receiver, receiver_socket = self.connect(server)
+        for client_socket in (sender_socket, receiver_socket):
+            receive_frame(client_socket)
+        server.handle_frame(sender, FRAME_CHAT, encode_message("plain"))
+        server.handle_frame(sender, FRAME_TRACED, encode_traced("traced", trace_id=9))
+        self.assertEqual(server.replication_log.last_seq, 0)
+        server.promote_to_primary()
+        # numbered on from the primary's log, ahead of the leader frame
+        self.assertEqual(receive_frame(receiver_socket), (FRAME_CHAT, payload_of(encode_message("plain"))))
+        frame_type, payload = receive_frame(receiver_socket)
+        self.assertEqual((frame_type, decode_traced(payload)[1]), (FRAME_TRACED, b"traced"))
+        self.assertEqual(decode_receipt(receive_frame(sender_socket)[1]), (9, 3))
+        self.assertEqual(receive_frame(receiver_socket)[0], FRAME_LEADER)
+
+    def test_backup_refuses_held_messages_when_its_primary_is_back(self):
+        """test that a primary reconnecting in time gets the clients told their held messages weren't sent."""
+        server = BackupServer(takeover_port=None)
+        self.addCleanup(server.stop)
+        server.primary_connected = True
+        connection, client_socket = self.connect(server)
+        server.handle_frame(connection, FRAME_CHAT, encode_message("held"))
+        primary_socket, other_end = socket.socketpair()
+        self.addCleanup(other_end.close)
+        server.attach_primary(primary_socket)
+        self.assertEqual(receive_frame(client_socket), (FRAME_CONTROL, payload_of(NOT_PRIMARY_FRAME)))
+        self.assertEqual(len(server.waiting), 0)
+
+    def test_resume_covers_room_messages(self):
+        """test that a member resuming on the backup gets the room messages it missed, and only its rooms'."""
+        server = BackupServer()
+        self.addCleanup(server.stop)
+        entries = [
+            sequenced(encode_traced("everyone", trace_id=1), 1),
+            encode_room(ROOM_JOIN, "alice", "dev"),
+            sequenced(encode_room_message("dev", "while you were away"), 3),
+            sequenced(encode_room_message("ops", "not for alice"), 4),
+        ]
+        for seq, frame in enumerate(entries, 1):
+            server.apply_entry(payload_of(encode_entry(seq, frame)))
+        connection, client_socket = self.connect(server)
+        receive_frame(client_socket)
+        server.room_command(connection, payload_of(encode_room(ROOM_RESTORE, "alice")))
+        self.assertEqual(receive_frame(client_socket)[0], FRAME_ROOM)
+        server.resume(connection, payload_of(encode_resume(1)))
+        frame_type, payload = receive_frame(client_socket)
+        self.assertEqual(frame_type, FRAME_ROOM_CHAT)
+        self.assertEqual((decode_room_seq(payload), decode_room_message(payload)), (3, ("dev", b"while you were away")))
+        self.assertEqual(receive_frame(client_socket), (FRAME_RESUME, payload_of(encode_resume(3, 1))))
+
+if __name__ == '__main__':
+    unittest.main()
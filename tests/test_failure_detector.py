@@ -0,0 +1,104 @@
+import unittest
+import math
+import random
+import socket
+import threading
+import time
+from common import PRIMARY_PORT, send_encoded, HEARTBEAT_FRAME
+from primary_server import PrimaryServer
+from backup_server import BackupServer
+from failure_detector import PhiAccrualDetector, phi
+
+def arrivals(detector, intervals, start=0.0):
+    # feed the detector frames the given intervals apart, returns when the last one came
+    now = start
+    detector.reset(now)
+    for interval in intervals:
+        now += interval
+        detector.heartbeat(now)
+    return now
+
+class CountingLink:
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, frame):
+        self.sent += 1
+        return True
+
+    def close(self):
+        pass
+
+class TestPhiAccrualDetector(unittest.TestCase):
+    def test_phi_grows_with_the_silence(self):
+        """test that phi is small around the mean and keeps growing past it without overflowing."""
+        self.assertLess(phi(1.0, 1.0, 0.1), 0.5)
+        self.assertLess(phi(1.2, 1.0, 0.1), phi(1.5, 1.0, 0.1))
+        self.assertTrue(math.isfinite(phi(1000.0, 1.0, 0.1)))
+        self.assertEqual(phi(0.0, 1000.0, 0.1), 0.0)
+
+    def test_steady_link_is_given_up_on_quickly(self):
+        """test that a primary with regular heartbeats is suspected soon after they stop."""
+        detector = PhiAccrualDetector(expected_interval=1.0, acceptable_pause=0.5)
+        last = arrivals(detector, [1.0] * 20)
+        self.assertFalse(detector.suspects(last + 1.5))
+        self.assertTrue(detector.suspects(last + 2.5))
+
+    def test_irregular_link_gets_longer(self):
+        """test that a primary whose heartbeats have been late and uneven isn't failed over as soon."""
+        rng = random.Random(1)
+        detector = PhiAccrualDetector(expected_interval=1.0, acceptable_pause=0.5)
+        last = arrivals(detector, [rng.choice([1.0, 1.0, 2.5]) for _ in range(50)])
+        self.assertFalse(detector.suspects(last + 2.5))
+        self.assertTrue(detector.suspects(last + 10))
+
+    def test_data_then_heartbeats_is_not_suspicious(self):
+        """test that going from a flood of messages back to heartbeats doesn't look like a failure."""
+        detector = PhiAccrualDetector(expected_interval=1.0, acceptable_pause=0.5)
+        last = arrivals(detector, [0.001] * 100)
+        self.assertFalse(detector.suspects(last + 1.0))
+
+    def test_falls_back_to_missed_heartbeats(self):
+        """test that until there are enough intervals it's a fixed number of missed heartbeats."""
+        detector = PhiAccrualDetector(expected_interval=1.0, missed_heartbeats=3)
+        self.assertFalse(detector.suspects(100.0), "A peer that never connected isn't suspected")
+        last = arrivals(detector, [1.0, 1.0])
+        self.assertFalse(detector.suspects(last + 2.9))
+        self.assertTrue(detector.suspects(last + 3.1))
+
+class TestServerFailureDetection(unittest.TestCase):
+    def test_quiet_open_connection_is_failed_over(self):
+        """test that the backup takes over from a primary that stops sending without closing the connection."""
+        server = BackupServer(port=PRIMARY_PORT + 520, takeover_port=None, heartbeat_interval=0.1,
+                              acceptable_pause=0.1)
+        self.addCleanup(server.stop)
+        threading.Thread(target=server.start, daemon=True).start()
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        server.attach_primary(ours)
+        for _ in range(10):
+            send_encoded(theirs, HEARTBEAT_FRAME)
+            time.sleep(0.1)
+        self.assertFalse(server.promoted)
+        deadline = time.time() + 3
+        while time.time() < deadline and not server.promoted:
+            time.sleep(0.05)
+        self.assertTrue(server.promoted, "Backup should promote itself once the primary goes quiet")
+
+    def test_heartbeats_wait_for_a_quiet_link(self):
+        """test that no heartbeats go out while messages are being replicated."""
+        server = PrimaryServer(heartbeat_interval=0.2)
+        self.addCleanup(server.stop)
+        link = server.backup_link = CountingLink()
+        server.replicated_at = time.monotonic()
+        threading.Thread(target=server.send_heartbeat, daemon=True).start()
+        deadline = time.monotonic() + 0.6
+        while time.monotonic() < deadline:
+            server.replicated_at = time.monotonic()
+            time.sleep(0.02)
+        self.assertEqual(link.sent, 0)
+        time.sleep(0.5)
+        self.assertGreaterEqual(link.sent, 1)
+
+if __name__ == '__main__':
+    unittest.main()
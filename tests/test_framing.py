@@ -0,0 +1,129 @@
+import unittest
+import io
+import socket
+import time
+from contextlib import redirect_stdout
+from common import (
+    FRAME_CHAT, FRAME_HEARTBEAT, FRAME_CONTROL, FRAME_HEADER, MAX_FRAME_SIZE,
+    BufferPool, FrameBuffer, FrameDecoder, ProtocolError, encode_frame, send_encoded, send_message,
+    receive_message, receive_frame, get_reader, release_reader, send_heartbeat, log_event
+)
+
+class TestFraming(unittest.TestCase):
+    def setUp(self):
+        """set up a connected pair of sockets for each test."""
+        self.left, self.right = socket.socketpair()
+        # don't let a broken test hang forever
+        self.right.settimeout(2)
+
+    def tearDown(self):
+        """clean up after each test."""
+        self.left.close()
+        self.right.close()
+
+    def test_decoder_handles_split_frames(self):
+        """test that a frame split across reads comes out whole."""
+        data = encode_frame(FRAME_CHAT, b"hello world")
+        decoder = FrameDecoder()
+        # feed the frame one byte at a time
+        frames = []
+        for i in range(len(data)):
+            frames.extend(decoder.feed(data[i:i + 1]))
+        self.assertEqual(frames, [(FRAME_CHAT, b"hello world")])
+        self.assertEqual(len(decoder.buffer), 0, "Decoder should not keep consumed bytes")
+
+    def test_decoder_handles_merged_frames(self):
+        """test that several frames in one read come out separately."""
+        data = (encode_frame(FRAME_CHAT, b"one") + encode_frame(FRAME_HEARTBEAT, b"")
+                + encode_frame(FRAME_CONTROL, b"two"))
+        decoder = FrameDecoder()
+        # keep the last few bytes back so one frame is still partial
+        frames = decoder.feed(data[:-2])
+        self.assertEqual(frames, [(FRAME_CHAT, b"one"), (FRAME_HEARTBEAT, b"")])
+        self.assertEqual(decoder.feed(data[-2:]), [(FRAME_CONTROL, b"two")])
+
+    def test_decoder_rejects_bad_frames(self):
+        """test that oversized or unknown frames are reported as protocol errors."""
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(FRAME_HEADER.pack(MAX_FRAME_SIZE + 1, FRAME_CHAT))
+        with self.assertRaises(ProtocolError):
+            FrameDecoder().feed(FRAME_HEADER.pack(0, 99))
+
+    def test_heartbeat_does_not_merge_with_chat(self):
+        """test that a heartbeat sent right after chat data stays its own frame."""
+        send_message(self.left, "Hello from primary")
+        send_heartbeat(self.left)
+        send_message(self.left, "x" * 5000)
+        self.assertEqual(receive_frame(self.right), (FRAME_CHAT, b"Hello from primary"))
+        self.assertEqual(receive_frame(self.right), (FRAME_HEARTBEAT, b""))
+        self.assertEqual(receive_message(self.right), "x" * 5000)
+
+    def test_closed_connection(self):
+        """test that a closed connection reads as an empty message."""
+        self.left.close()
+        self.assertEqual(receive_message(self.right), "")
+
+    def test_views_are_whole_frames_in_place(self):
+        """test that a received frame comes back as a view of the receive buffer, header and all."""
+        first, second = encode_frame(FRAME_CHAT, b"one"), encode_frame(FRAME_CONTROL, b"two")
+        send_encoded(self.left, first + second)
+        frame_type, frame = get_reader(self.right).read_view()
+        self.assertEqual((frame_type, bytes(frame)), (FRAME_CHAT, first))
+        self.assertIs(frame.obj, get_reader(self.right).frames.buffer)
+        # the second frame came in the same read and is already waiting
+        self.assertTrue(get_reader(self.right).pending)
+        self.assertEqual(receive_frame(self.right), (FRAME_CONTROL, b"two"))
+
+    def test_partial_frame_moves_to_the_front(self):
+        """test that a frame cut off at the end of the buffer comes out whole after the next read."""
+        frames = FrameBuffer(BufferPool(size=16))
+        data = encode_frame(FRAME_CHAT, b"0123456") + encode_frame(FRAME_CHAT, b"abcdefgh")
+        space = frames.space()
+        space[:16] = data[:16]
+        frames.filled(16)
+        self.assertEqual(bytes(frames.next_frame()[1]), data[:12])
+        self.assertIsNone(frames.next_frame())
+        space = frames.space()
+        space[:len(data) - 16] = data[16:]
+        frames.filled(len(data) - 16)
+        self.assertEqual(bytes(frames.next_frame()[1]), data[12:])
+        self.assertEqual(len(frames.buffer), 16)
+
+    def test_oversized_frame_grows_the_buffer(self):
+        """test that a frame bigger than the receive buffer still comes out whole."""
+        pool = BufferPool(size=64)
+        frames = FrameBuffer(pool)
+        data = encode_frame(FRAME_CHAT, b"x" * 200)
+        while frames.end < len(data):
+            space = frames.space()
+            count = min(len(space), len(data) - frames.end)
+            space[:count] = data[frames.end:frames.end + count]
+            frames.filled(count)
+        self.assertEqual(bytes(frames.next_frame()[1]), data)
+        # the grown buffer isn't worth pooling, the original one is
+        frames.release()
+        self.assertEqual([len(buffer) for buffer in pool.free], [64])
+
+    def test_released_buffers_are_reused(self):
+        """test that a closed connection's receive buffer goes to the next one."""
+        send_message(self.left, "hello")
+        self.assertEqual(receive_message(self.right), "hello")
+        buffer = get_reader(self.right).frames.buffer
+        release_reader(self.right)
+        other_left, other_right = socket.socketpair()
+        self.addCleanup(other_left.close)
+        self.addCleanup(other_right.close)
+        self.assertIs(get_reader(other_right).frames.buffer, buffer)
+
+    def test_log_event(self):
+        """test that event lines carry the time, the event and its details in a fixed order."""
+        output = io.StringIO()
+        before = time.time()
+        with redirect_stdout(output):
+            log_event("heartbeat_timeout", silent_for="3.100")
+        prefix, timestamp, event, detail = output.getvalue().split()
+        self.assertEqual((prefix, event, detail), ("event", "heartbeat_timeout", "silent_for=3.100"))
+        self.assertGreaterEqual(float(timestamp), before - 0.001)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest
+import socket
+import threading
+import time
+from types import SimpleNamespace
+from common import (
+    PRIMARY_PORT, FRAME_CHAT, FRAME_CATCHUP, FRAME_HELLO, ProtocolError, encode_message, send_encoded,
+    receive_frame
+)
+from handshake import (
+    ROLE_CLIENT, ROLE_PEER, HELLO, Hello, encode_hello, decode_hello, read_hello, resolve_peers
+)
+from primary_server import PrimaryServer
+from backup_server import BackupServer
+from async_server import AsyncBackupServer
+
+class TestHello(unittest.TestCase):
+    def test_hello_round_trip(self):
+        """test that a hello comes back with the role, epoch and node id it was sent with."""
+        frame = encode_hello(ROLE_PEER, 3, "db-2:5001")
+        self.assertEqual(frame[4], FRAME_HELLO)
+        self.assertEqual(decode_hello(frame[5:]), Hello(ROLE_PEER, 3, "db-2:5001"))
+
+    def test_bad_hellos_are_rejected(self):
+        """test that a short hello or one with a role we don't know is a protocol error."""
+        with self.assertRaises(ProtocolError):
+            decode_hello(b"\x01")
+        with self.assertRaises(ProtocolError):
+            decode_hello(HELLO.pack(9, 0) + b"x")
+
+    def test_read_hello_leaves_other_frames(self):
+        """test that a connection that starts with a message gets no hello and keeps the message."""
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        send_encoded(theirs, encode_message("hi"))
+        self.assertIsNone(read_hello(ours))
+        self.assertEqual(receive_frame(ours), (FRAME_CHAT, b"hi"))
+
+    def test_read_hello_gives_up_on_silence(self):
+        """test that a connection that says nothing is left alone once the wait is over."""
+        ours, theirs = socket.socketpair()
+        self.addCleanup(ours.close)
+        self.addCleanup(theirs.close)
+        start = time.monotonic()
+        self.assertIsNone(read_hello(ours, wait=0.1))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertIsNone(ours.gettimeout(), "The socket should be blocking again")
+
+class TestPeerHandshake(unittest.TestCase):
+    def backup(self, **options):
+        # the primary in these tests connects from 10.0.0.1
+        options.setdefault("peers", ("10.0.0.1",))
+        server = BackupServer(takeover_port=None, **options)
+        self.addCleanup(server.stop)
+        return server
+
+    def peer(self, server, epoch, node_id, host='10.0.0.1'):
+        # hand the backup one end of a connection whose hello says it's a primary
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        server.peer_connected(ours, (host, 5000), Hello(ROLE_PEER, epoch, node_id))
+        theirs.settimeout(2)
+        return ours, theirs
+
+    def test_local_client_is_not_taken_for_the_primary(self):
+        """test that a client on the backup's own machine is a client, whatever its address."""
+        port = PRIMARY_PORT + 530
+        server = self.backup(port=port)
+        threading.Thread(target=server.start, daemon=True).start()
+        deadline = time.time() + 2
+        while time.time() < deadline and server.server_socket is None:
+            time.sleep(0.05)
+        client = socket.create_connection(('127.0.0.1', port))
+        self.addCleanup(client.close)
+        send_encoded(client, encode_hello(ROLE_CLIENT, 0, "alice"))
+        deadline = time.time() + 2
+        while time.time() < deadline and not server.clients:
+            time.sleep(0.05)
+        self.assertEqual(len(server.clients), 1)
+        self.assertIsNone(server.primary_socket)
+
+    def test_backup_follows_the_newest_primary(self):
+        """test that the backup answers with its epoch, refuses an older primary and moves to a newer one."""
+        server = self.backup()
+        first, first_peer = self.peer(server, 1, "a")
+        self.assertIs(server.primary_socket, first)
+        self.assertEqual(decode_hello(receive_frame(first_peer)[1]), Hello(ROLE_PEER, 1, server.node_id))
+        self.assertEqual(receive_frame(first_peer)[0], FRAME_CATCHUP)
+
+        # a primary from before the last takeover is turned away and told our epoch
+        _, stale_peer = self.peer(server, 0, "old")
+        self.assertEqual(decode_hello(receive_frame(stale_peer)[1]).epoch, 1)
+        self.assertIsNone(receive_frame(stale_peer))
+        self.assertIs(server.primary_socket, first)
+
+        # one at least as new replaces the connection we had
+        second, _ = self.peer(server, 2, "b")
+        self.assertIs(server.primary_socket, second)
+        self.assertEqual((server.epoch, server.primary_node), (2, "b"))
+
+    def test_promotion_raises_the_epoch(self):
+        """test that a promoted backup is a newer primary and turns away the one it replaced."""
+        server = self.backup()
+        self.peer(server, 4, "a")
+        server.promote_to_primary()
+        self.assertEqual(server.epoch, 5)
+        _, old_peer = self.peer(server, 4, "a")
+        self.assertEqual(decode_hello(receive_frame(old_peer)[1]).epoch, 5)
+        self.assertIsNone(receive_frame(old_peer))
+
+    def test_only_peers_are_taken_for_the_primary(self):
+        """test that a hello saying it's a primary from a host that isn't a peer is refused, whatever its epoch."""
+        server = self.backup()
+        first, _ = self.peer(server, 1, "a")
+        _, impostor = self.peer(server, 2 ** 40, "a", host='10.0.0.99')
+        # it's cut off without being told our epoch, and the real primary keeps its place
+        self.assertIsNone(receive_frame(impostor))
+        self.assertIs(server.primary_socket, first)
+        self.assertEqual((server.epoch, server.primary_node), (1, "a"))
+        _, next_peer = self.peer(server, 1, "a")
+        self.assertEqual(decode_hello(receive_frame(next_peer)[1]).epoch, 1)
+
+    def test_async_backup_only_takes_peers_for_the_primary(self):
+        """test that the asyncio backup refuses a primary's hello from a host that isn't a peer."""
+        server = AsyncBackupServer(takeover_port=None, peers=("10.0.0.1",))
+        self.addCleanup(server.stop)
+        written = []
+        transport = SimpleNamespace(write=written.append, close=lambda: written.append(None))
+        protocol = SimpleNamespace(address=('10.0.0.99', 5000), transport=transport)
+        server.peer_connected(protocol, Hello(ROLE_PEER, 2 ** 40, "a"))
+        self.assertEqual(written, [None])
+        self.assertIsNone(server.primary_protocol)
+        self.assertEqual(server.epoch, 0)
+
+    def test_peer_names_are_resolved(self):
+        """test that peers can be given by name as well as by address."""
+        peers = resolve_peers(["localhost", "10.0.0.1"])
+        self.assertIn("127.0.0.1", peers)
+        self.assertIn("10.0.0.1", peers)
+
+    def test_primary_stops_at_a_newer_backup(self):
+        """test that a primary won't replicate to a backup that has followed a newer primary."""
+        server = PrimaryServer()
+        self.addCleanup(server.stop)
+        self.assertTrue(server.backup_hello(Hello(ROLE_PEER, 0, "backup")))
+        self.assertFalse(server.backup_hello(Hello(ROLE_PEER, 1, "backup")))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+import os
+import shutil
+import socket
+import tempfile
+import time
+from common import FRAME_HEADER, FRAME_CHAT, FRAME_HISTORY, encode_message, receive_frame
+from connection import ClientConnection
+from history import HistoryReader, HistoryRing, encode_history, decode_history
+from primary_server import PrimaryServer
+from wal import WriteAheadLog, DURABILITY_BATCH, index_name, list_segments, read_index, segment_name
+
+class TestHistoryReader(unittest.TestCase):
+    def setUp(self):
+        """write 100 messages to a log with small segments and a dense index."""
+        self.directory = tempfile.mkdtemp()
+        wal = WriteAheadLog(self.directory, durability=DURABILITY_BATCH,
+                            segment_bytes=1024, index_bytes=128)
+        wal.start()
+        self.times = []
+        for i in range(100):
+            wal.wait(wal.append(encode_message(f"message {i}")))
+            self.times.append(time.time())
+        wal.close()
+        self.reader = HistoryReader(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_index_is_sparse(self):
+        """test that every segment gets an index with fewer entries than records."""
+        firsts = list_segments(self.directory)
+        self.assertGreater(len(firsts), 1)
+        entries = read_index(os.path.join(self.directory, index_name(firsts[0])))
+        self.assertGreater(len(entries), 1)
+        self.assertLess(len(entries), firsts[1] - firsts[0])
+
+    def test_since_seq(self):
+        """test that we get the messages after a sequence number, across segments."""
+        records = self.reader.since_seq(40, limit=30)
+        self.assertEqual([seq for seq, _, _ in records], list(range(41, 71)))
+        self.assertEqual(bytes(records[0][2]), encode_message("message 40"))
+        # frames are views into the mapped segment rather than copies
+        self.assertIsInstance(records[0][2], memoryview)
+
+    def test_since_time(self):
+        """test that we get the messages from a point in time on."""
+        records = self.reader.since_time(self.times[69])
+        self.assertEqual(records[0][0], 71)
+        self.assertEqual(records[-1][0], 100)
+
+    def test_frames_end_with_a_reply(self):
+        """test that a history request is answered with the frames and where they got up to."""
+        frames = self.reader.frames(encode_history(95)[FRAME_HEADER.size:])
+        self.assertEqual([bytes(frame) for frame in frames[:-1]],
+                         [encode_message(f"message {i}") for i in range(95, 100)])
+        self.assertEqual(decode_history(frames[-1][FRAME_HEADER.size:])[::2], (100, 5))
+
+    def test_deleted_segments_are_forgotten(self):
+        """test that segments deleted from disk are dropped from the reader instead of kept mapped."""
+        self.reader.since_seq(0, limit=100)
+        firsts = list_segments(self.directory)
+        self.assertIn(firsts[0], self.reader.segments)
+        os.remove(os.path.join(self.directory, segment_name(firsts[0])))
+        os.remove(os.path.join(self.directory, index_name(firsts[0])))
+        records = self.reader.since_seq(0, limit=100)
+        self.assertEqual(records[0][0], firsts[1])
+        self.assertNotIn(firsts[0], self.reader.segments)
+
+class TestHistoryRing(unittest.TestCase):
+    def test_count_limit(self):
+        """test that the ring keeps only the newest frames once it's full."""
+        ring = HistoryRing(max_messages=3, max_bytes=1000)
+        for i in range(5):
+            ring.append(bytes([i]))
+        self.assertEqual(ring.tail(), [b'\x02', b'\x03', b'\x04'])
+        self.assertEqual(ring.tail(2), [b'\x03', b'\x04'])
+        self.assertEqual(len(ring.slots), 3, "The ring should never grow")
+
+    def test_byte_limit(self):
+        """test that the byte limit holds before the count limit is reached."""
+        ring = HistoryRing(max_messages=100, max_bytes=10)
+        for _ in range(4):
+            ring.append(b'abcd')
+        self.assertEqual(len(ring), 2)
+        self.assertLessEqual(ring.bytes, 10)
+        # a frame bigger than the whole ring is just not kept
+        ring.append(b'x' * 11)
+        self.assertEqual(ring.tail(), [b'abcd', b'abcd'])
+
+    def test_clear(self):
+        """test that clearing drops every frame and the ring still works afterwards."""
+        ring = HistoryRing(max_messages=2, max_bytes=100)
+        ring.extend([b'a', b'b', b'c'])
+        ring.clear()
+        self.assertEqual((len(ring), ring.bytes), (0, 0))
+        ring.append(b'd')
+        self.assertEqual(ring.tail(), [b'd'])
+
+class TestServeHistory(unittest.TestCase):
+    def test_replay_on_join(self):
+        """test that a new client is sent the recent messages in one chunk before anything live."""
+        server = PrimaryServer(replay_messages=2)
+        for i in range(3):
+            server.broadcast(f"message {i}", None)
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(2)
+        connection = ClientConnection(ours, "test")
+        server.add_client(connection)
+        self.assertEqual(connection.queue_depth(), 1, "The replay should be queued as one write")
+        server.broadcast("live", None)
+        connection.start()
+        for expected in (b"message 1", b"message 2", b"live"):
+            self.assertEqual(receive_frame(theirs), (FRAME_CHAT, expected))
+        connection.close()
+        theirs.close()
+
+    def test_client_gets_history(self):
+        """test that the primary answers a history request from its log."""
+        directory = tempfile.mkdtemp()
+        server = PrimaryServer(wal_dir=directory, durability=DURABILITY_BATCH)
+        server.open_wal()
+        for i in range(3):
+            server.broadcast(f"message {i}", None)
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(2)
+        connection = ClientConnection(ours, "test")
+        connection.start()
+        server.send_history(connection, encode_history(1)[FRAME_HEADER.size:])
+        self.assertEqual(receive_frame(theirs), (FRAME_CHAT, b"message 1"))
+        self.assertEqual(receive_frame(theirs), (FRAME_CHAT, b"message 2"))
+        frame_type, payload = receive_frame(theirs)
+        self.assertEqual(frame_type, FRAME_HISTORY)
+        self.assertEqual(decode_history(payload)[::2], (3, 2))
+        connection.close()
+        theirs.close()
+        server.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import socket
+import urllib.request
+from common import PRIMARY_PORT, FRAME_CHAT, receive_frame
+from connection import ClientConnection
+from metrics import Metrics, ServerMetrics, NULL_METRIC
+from primary_server import PrimaryServer
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        """test that counters, gauges and histograms come out in the prometheus text format."""
+        metrics = Metrics()
+        counter = metrics.counter("test_total", "things")
+        counter.inc()
+        counter.inc(2)
+        metrics.gauge("test_depth", "depth", lambda: 7)
+        metrics.labelled_gauge("test_queue", "per client", "client", lambda: {("10.0.0.1", 5000): 3, 'a"b': 1})
+        histogram = metrics.histogram("test_seconds", "time", buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5.0):
+            histogram.observe(value)
+        lines = metrics.render().splitlines()
+        self.assertIn("# TYPE test_total counter", lines)
+        self.assertIn("test_total 3", lines)
+        self.assertIn("test_depth 7", lines)
+        self.assertIn('test_queue{client="10.0.0.1:5000"} 3', lines)
+        self.assertIn('test_queue{client="a\\"b"} 1', lines)
+        # buckets count everything at or below their bound
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn("test_seconds_count 3", lines)
+
+    def test_disabled(self):
+        """test that disabled metrics hand out the no-op metric and render nothing."""
+        metrics = ServerMetrics(enabled=False)
+        self.assertIs(metrics.messages_in, NULL_METRIC)
+        metrics.messages_in.inc()
+        metrics.fanout_seconds.observe(1.0)
+        self.assertEqual(metrics.render().strip(), "")
+
+    def test_failing_gauge_is_skipped(self):
+        """test that a gauge whose function raises doesn't break the scrape."""
+        metrics = Metrics()
+        metrics.gauge("broken", "always fails", lambda: 1 / 0)
+        metrics.counter("fine_total", "still here")
+        self.assertIn("fine_total 0", metrics.render())
+
+class TestStatsEndpoint(unittest.TestCase):
+    def test_scrape_server(self):
+        """test that a server with a stats port counts fan out and serves it over http."""
+        port = PRIMARY_PORT + 700
+        server = PrimaryServer(stats_port=port)
+        server.metrics.serve(port)
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(2)
+        connection = ClientConnection(ours, "test")
+        connection.start()
+        server.add_client(connection)
+        server.broadcast("hello", None)
+        self.assertEqual(receive_frame(theirs), (FRAME_CHAT, b"hello"))
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=2) as response:
+            body = response.read().decode()
+        lines = body.splitlines()
+        self.assertIn("chat_messages_sent_total 1", lines)
+        self.assertIn("chat_connected_clients 1", lines)
+        self.assertIn('chat_client_queue_depth{client="test"} 0', lines)
+        self.assertIn("chat_fanout_seconds_count 1", lines)
+        self.assertIn("chat_replication_lag_entries 1", lines)
+        connection.close()
+        theirs.close()
+        server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
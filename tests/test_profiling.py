@@ -0,0 +1,66 @@
+import unittest
+import shutil
+import tempfile
+import time
+from profiling import Profiler, NULL_SPAN, COMMAND_ON, COMMAND_OFF, COMMAND_DUMP
+
+class TestProfiler(unittest.TestCase):
+    def setUp(self):
+        """a profiler of our own that dumps into a temp dir and never on its own."""
+        self.directory = tempfile.mkdtemp()
+        self.profiler = Profiler(self.directory, dump_interval=60, top=2)
+
+    def tearDown(self):
+        self.profiler.enabled = False
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_off_by_default(self):
+        """test that spans cost nothing and record nothing until profiling is turned on."""
+        self.assertIs(self.profiler.span("broadcast"), NULL_SPAN)
+        with self.profiler.span("broadcast"):
+            pass
+        self.profiler.record_broadcast(1.0, 10)
+        self.assertEqual((self.profiler.totals, self.profiler.slowest), ({}, []))
+
+    def test_nested_spans_charge_own_time(self):
+        """test that a span's time minus its children goes to its full stack."""
+        self.profiler.start()
+        with self.profiler.span("broadcast"):
+            time.sleep(0.02)
+            with self.profiler.span("fan_out"):
+                time.sleep(0.05)
+        totals = self.profiler.totals
+        self.assertEqual(set(totals), {"broadcast", "broadcast;fan_out"})
+        self.assertGreaterEqual(totals["broadcast;fan_out"], 50000)
+        # the parent doesn't count its child's time again
+        self.assertLess(totals["broadcast"], 45000)
+
+    def test_slowest_broadcasts(self):
+        """test that only the top n slowest broadcasts are kept, slowest first in the dump."""
+        self.profiler.start()
+        for seconds, fan_out in ((0.001, 5), (0.009, 50), (0.003, 10), (0.0005, 1)):
+            self.profiler.record_broadcast(seconds, fan_out)
+        _, slowest_path = self.profiler.dump()
+        with open(slowest_path) as f:
+            rows = [line.split()[:2] for line in f.readlines()[1:]]
+        self.assertEqual(rows, [["9.000", "50"], ["3.000", "10"]])
+
+    def test_commands(self):
+        """test that control commands switch profiling, but only from this machine."""
+        self.assertEqual(self.profiler.command(("10.0.0.5", 4000), COMMAND_ON),
+                         "profiling commands are only taken from this machine")
+        self.assertFalse(self.profiler.enabled)
+        self.assertEqual(self.profiler.command(("127.0.0.1", 4000), COMMAND_ON), "profiling on")
+        self.assertTrue(self.profiler.enabled)
+        with self.profiler.span("decode"):
+            pass
+        reply = self.profiler.command(("127.0.0.1", 4000), COMMAND_DUMP)
+        folded_path, _ = self.profiler.paths()
+        self.assertIn(folded_path, reply)
+        with open(folded_path) as f:
+            self.assertTrue(f.read().startswith("decode "))
+        self.assertEqual(self.profiler.command(("127.0.0.1", 4000), COMMAND_OFF), "profiling off")
+        self.assertIsNone(self.profiler.command(("127.0.0.1", 4000), "hello"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import unittest
+import random
+import socket
+import threading
+import time
+from client import ChatClient
+from common import FRAME_CHAT, FRAME_HELLO, encode_message, receive_frame
+from delivery import Endpoints
+from reconnect import Backoff, race_connect
+
+def listener(backlog=5):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(backlog)
+    return server
+
+class TestBackoff(unittest.TestCase):
+    def test_waits_grow_within_bounds(self):
+        """test that every wait is between base and three times the last, and never past the cap."""
+        backoff = Backoff(base=0.1, cap=2, rng=random.Random(1))
+        last = 0.1
+        for _ in range(50):
+            delay = backoff.next()
+            self.assertGreaterEqual(delay, 0.1)
+            self.assertLessEqual(delay, min(2, last * 3))
+            last = delay
+        backoff.reset()
+        self.assertLessEqual(backoff.next(), 0.3)
+
+    def test_clients_spread_out(self):
+        """test that clients backing off from the same moment don't all wait the same."""
+        first_waits = {round(Backoff(rng=random.Random(seed)).next(), 6) for seed in range(100)}
+        self.assertGreater(len(first_waits), 90)
+
+class TestRaceConnect(unittest.TestCase):
+    def test_skips_a_refused_server(self):
+        """test that a server that isn't there is passed over for the next one straight away."""
+        closed = listener()
+        closed_address = closed.getsockname()
+        closed.close()
+        server = listener()
+        self.addCleanup(server.close)
+        start = time.monotonic()
+        sock, address = race_connect([closed_address, server.getsockname()], delay=5)
+        self.addCleanup(sock.close)
+        self.assertEqual(address, server.getsockname())
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_beats_a_server_that_isnt_answering(self):
+        """test that a server whose accept queue is full only holds us up for the stagger."""
+        stuck = listener(backlog=0)
+        self.addCleanup(stuck.close)
+        # fill its queue so the kernel drops any more connection attempts
+        queued = []
+        for _ in range(4):
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client.setblocking(False)
+            client.connect_ex(stuck.getsockname())
+            queued.append(client)
+            self.addCleanup(client.close)
+        time.sleep(0.1)
+        server = listener()
+        self.addCleanup(server.close)
+        start = time.monotonic()
+        sock, address = race_connect([stuck.getsockname(), server.getsockname()], timeout=5, delay=0.1)
+        self.addCleanup(sock.close)
+        self.assertEqual(address, server.getsockname())
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_fails_when_nothing_answers(self):
+        """test that an error comes back once every server has been tried."""
+        closed = listener()
+        closed_address = closed.getsockname()
+        closed.close()
+        with self.assertRaises(OSError):
+            race_connect([closed_address])
+
+    def test_endpoints_put_the_current_one_first(self):
+        """test that the race starts with the server we're on and notes the one we end up on."""
+        endpoints = Endpoints([("h", 1), ("h", 2), ("h", 3)])
+        endpoints.advance()
+        self.assertEqual(endpoints.ordered(), [("h", 2), ("h", 3), ("h", 1)])
+        endpoints.use(("h", 3))
+        self.assertEqual(endpoints.current(), ("h", 3))
+
+class TestClientReconnect(unittest.TestCase):
+    def test_sender_and_listener_reconnect_once(self):
+        """test that both threads losing the same socket open one new connection between them."""
+        server = listener()
+        self.addCleanup(server.close)
+        client = ChatClient(endpoints=[server.getsockname()])
+        client.backoff = Backoff(base=0.05, cap=0.05)
+        self.addCleanup(client.stop)
+        lost, other_end = socket.socketpair()
+        self.addCleanup(other_end.close)
+        client.socket = lost
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(client.reconnect(lost))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [True, True])
+        self.assertEqual(client.reconnect_attempts, 0)
+
+        accepted, _ = server.accept()
+        self.addCleanup(accepted.close)
+        accepted.settimeout(2)
+        self.assertEqual(receive_frame(accepted)[0], FRAME_HELLO)
+        server.settimeout(0.2)
+        with self.assertRaises(socket.timeout):
+            server.accept()
+
+    def test_threads_sending_together_keep_frames_whole(self):
+        """test that frames the sender and the listener write at the same time arrive whole."""
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        client = ChatClient(endpoints=[("127.0.0.1", 1)])
+        self.addCleanup(client.stop)
+        client.socket = ours
+        # big enough that sendall has to go round more than once and could be interrupted
+        frames = [encode_message(letter * 200000) for letter in "ab"]
+
+        def send(frame):
+            for _ in range(20):
+                client.send(frame)
+        threads = [threading.Thread(target=send, args=(frame,)) for frame in frames]
+        for thread in threads:
+            thread.start()
+        theirs.settimeout(5)
+        received = [receive_frame(theirs) for _ in range(40)]
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual({frame_type for frame_type, _ in received}, {FRAME_CHAT})
+        self.assertEqual({bytes(payload) for _, payload in received}, {b"a" * 200000, b"b" * 200000})
+
+if __name__ == '__main__':
+    unittest.main()
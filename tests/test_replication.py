@@ -0,0 +1,230 @@
+import unittest
+import threading
+import time
+import socket
+from common import (
+    PRIMARY_PORT, FRAME_HEADER, FRAME_CHAT, FRAME_REPLICATE, FRAME_CATCHUP, FRAME_SNAPSHOT, FRAME_LEADER, FrameDecoder,
+    encode_message
+)
+from common import send_encoded, send_message, receive_frame
+from handshake import ROLE_CLIENT, encode_hello
+from replication import (
+    ReplicationLog, MODE_ASYNC, MODE_SEMI_SYNC, MODE_SYNC, decode_entry, encode_ack, decode_ack,
+    decode_position, split_frames, encode_entry, decode_leader
+)
+from backup_server import BackupServer
+from async_server import AsyncPrimaryServer, AsyncBackupServer
+
+class TestReplicationLog(unittest.TestCase):
+    def test_entries_are_numbered_in_order(self):
+        """test that entries get gapless sequence numbers and decode back."""
+        log = ReplicationLog()
+        frame = encode_message("alice: hi")
+        entries = [log.append(frame) for _ in range(3)]
+        self.assertEqual([seq for seq, _ in entries], [1, 2, 3])
+        frame_type, payload = FrameDecoder().feed(entries[1][1])[0]
+        self.assertEqual(frame_type, FRAME_REPLICATE)
+        self.assertEqual(decode_entry(payload), (2, frame))
+
+    def test_cumulative_ack(self):
+        """test that one ack covers every entry up to it."""
+        log = ReplicationLog()
+        for _ in range(5):
+            log.append(b'x')
+        self.assertEqual(log.lag()["entries"], 5)
+        log.ack(decode_ack(FrameDecoder().feed(encode_ack(4))[0][1]))
+        self.assertEqual(log.lag()["entries"], 1)
+        # an old ack arriving late doesn't move us backwards
+        log.ack(2)
+        self.assertEqual(log.acked_seq, 4)
+
+    def test_async_never_waits(self):
+        """test that async mode fans out without waiting for the backup."""
+        log = ReplicationLog(MODE_ASYNC)
+        seq, _ = log.append(b'x')
+        self.assertFalse(log.wait_for_ack(seq, lambda: True))
+
+    def test_semi_sync_gives_up_after_timeout(self):
+        """test that semi-sync stops waiting once the ack timeout passes."""
+        log = ReplicationLog(MODE_SEMI_SYNC, ack_timeout=0.1)
+        seq, _ = log.append(b'x')
+        start = time.time()
+        self.assertFalse(log.wait_for_ack(seq, lambda: True))
+        self.assertLess(time.time() - start, 1)
+
+    def test_sync_waits_for_ack(self):
+        """test that sync mode returns as soon as the backup acks."""
+        log = ReplicationLog(MODE_SYNC, ack_timeout=0.05)
+        seq, _ = log.append(b'x')
+        threading.Timer(0.2, log.ack, args=(seq,)).start()
+        self.assertTrue(log.wait_for_ack(seq, lambda: True))
+
+    def test_sync_stops_when_backup_is_lost(self):
+        """test that sync mode doesn't wait forever for a backup that's gone."""
+        log = ReplicationLog(MODE_SYNC, ack_timeout=0.05)
+        seq, _ = log.append(b'x')
+        self.assertFalse(log.wait_for_ack(seq, lambda: False))
+
+    def test_catch_up_sends_missing_suffix(self):
+        """test that a backup still inside the retained log only gets what it missed."""
+        log = ReplicationLog(retain_entries=10)
+        for i in range(8):
+            log.append(encode_message(f"message {i}"))
+        frames = [FrameDecoder().feed(frame)[0] for frame in log.catch_up(log.log_id, 5)]
+        self.assertEqual(frames[0][0], FRAME_CATCHUP)
+        self.assertEqual([decode_entry(payload)[0] for _, payload in frames[1:]], [6, 7, 8])
+        self.assertEqual(log.lag()["entries"], 3)
+
+    def test_catch_up_falls_back_to_snapshot(self):
+        """test that a backup too far behind gets a snapshot and then the tail."""
+        log = ReplicationLog(retain_entries=3, snapshot_messages=2)
+        for i in range(10):
+            log.append(encode_message(f"message {i}"))
+        frames = [FrameDecoder().feed(frame)[0] for frame in log.catch_up(log.log_id, 2)]
+        frame_type, payload = frames[0]
+        self.assertEqual(frame_type, FRAME_SNAPSHOT)
+        log_id, seq, body = decode_position(payload)
+        self.assertEqual((log_id, seq), (log.log_id, 7))
+        self.assertEqual(split_frames(body), [encode_message("message 5"), encode_message("message 6")])
+        self.assertEqual([decode_entry(payload)[0] for _, payload in frames[1:]], [8, 9, 10])
+
+    def test_retained_bytes_are_capped(self):
+        """test that big entries fall out of the log once they pass the byte cap, and catch-up takes a snapshot."""
+        big = "x" * 1000
+        log = ReplicationLog(retain_bytes=3000)
+        for i in range(10):
+            log.append(encode_message(f"{i}{big}"))
+        self.assertEqual([seq for seq, _ in log.entries], [9, 10])
+        self.assertLessEqual(log.entries_bytes, 3000)
+        frames = [FrameDecoder().feed(frame)[0] for frame in log.catch_up(log.log_id, 5)]
+        self.assertEqual(frames[0][0], FRAME_SNAPSHOT)
+        self.assertEqual(decode_position(frames[0][1])[1], 8)
+        self.assertEqual([decode_entry(payload)[0] for _, payload in frames[1:]], [9, 10])
+
+    def test_catch_up_from_another_log(self):
+        """test that a position in some other primary's log always gets a snapshot."""
+        log = ReplicationLog()
+        log.append(encode_message("hi"))
+        frames = [FrameDecoder().feed(frame)[0] for frame in log.catch_up(log.log_id + 1, 1)]
+        self.assertEqual(frames[0][0], FRAME_SNAPSHOT)
+        self.assertEqual(len(frames), 2)
+
+    def test_restart_starts_a_new_log(self):
+        """test that a promoted backup's log asks for a snapshot seeded with what it had."""
+        log = ReplicationLog()
+        log.append(encode_message("from the old primary"))
+        old_id = log.log_id
+        log.restart([encode_message("kept")], 1)
+        self.assertNotEqual(log.log_id, old_id)
+        # the numbering carries on so clients can resume from where they were
+        self.assertEqual(log.append(encode_message("after"))[0], 2)
+        frames = [FrameDecoder().feed(frame)[0] for frame in log.catch_up(old_id, 1)]
+        frame_type, payload = frames[0]
+        self.assertEqual(frame_type, FRAME_SNAPSHOT)
+        self.assertEqual(split_frames(decode_position(payload)[2]), [encode_message("kept")])
+
+
+class TestBackupCatchUp(unittest.TestCase):
+    def setUp(self):
+        """start an asyncio primary with no backup yet."""
+        self.backup_port = PRIMARY_PORT + 501
+        self.primary = AsyncPrimaryServer(port=PRIMARY_PORT + 500, backup_address=('127.0.0.1', self.backup_port))
+        self.primary.replication_log.retain_entries = 5
+        self.threads = []
+        self.start(self.primary)
+        self.backups = []
+
+    def tearDown(self):
+        """stop everything we started."""
+        self.primary.is_running = False
+        for backup in self.backups:
+            backup.is_running = False
+        for thread in self.threads:
+            thread.join(timeout=5)
+
+    def start(self, server):
+        thread = threading.Thread(target=server.start, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def start_backup(self):
+        backup = AsyncBackupServer(port=self.backup_port)
+        self.backups.append(backup)
+        self.start(backup)
+        return backup
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while time.time() < deadline and not condition():
+            time.sleep(0.05)
+        return condition()
+
+    def test_backup_catches_up_on_connect(self):
+        """test that a backup started late gets everything said before it came up."""
+        self.assertTrue(self.wait_for(lambda: self.primary.server is not None))
+        client = socket.create_connection(('localhost', self.primary.port))
+        for i in range(8):
+            send_message(client, f"message {i}")
+        self.assertTrue(self.wait_for(lambda: self.primary.replication_log.last_seq == 8))
+
+        backup = self.start_backup()
+        self.assertTrue(self.wait_for(lambda: backup.applied_seq == 8), "Backup should catch up")
+        # the first three fell out of the retained log, so they came as a snapshot
+        self.assertEqual(len(backup.history), 8)
+        self.assertEqual(backup.history.tail()[0], encode_message("message 0"))
+
+        # live entries keep flowing after the catch-up
+        send_message(client, "after catch-up")
+        self.assertTrue(self.wait_for(lambda: backup.applied_seq == 9))
+        client.close()
+
+class TestPromotedBackup(unittest.TestCase):
+    def setUp(self):
+        """start a threaded backup that will take over, and a second backup for it to replicate to."""
+        self.takeover_port = PRIMARY_PORT + 510
+        self.second = BackupServer(port=PRIMARY_PORT + 512, takeover_port=None)
+        self.backup = BackupServer(port=PRIMARY_PORT + 511, takeover_port=self.takeover_port,
+                                   backup_address=('127.0.0.1', PRIMARY_PORT + 512))
+        for server in (self.second, self.backup):
+            self.addCleanup(server.stop)
+            threading.Thread(target=server.start, daemon=True).start()
+        self.assertTrue(self.wait_for(lambda: self.backup.server_socket and self.second.server_socket))
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while time.time() < deadline and not condition():
+            time.sleep(0.05)
+        return condition()
+
+    def connect(self, port):
+        client = socket.create_connection(('127.0.0.1', port))
+        send_encoded(client, encode_hello(ROLE_CLIENT, 0, "test"))
+        client.settimeout(2)
+        self.addCleanup(client.close)
+        return client
+
+    def test_promotion_takes_over_clients_and_replicates(self):
+        """test that a promoted backup announces itself, takes the primary's port and has a backup of its own."""
+        self.backup.apply_entry(encode_entry(1, encode_message("before"))[FRAME_HEADER.size:])
+        client = self.connect(self.backup.port)
+        self.assertTrue(self.wait_for(lambda: len(self.backup.clients) == 1))
+        self.assertEqual(receive_frame(client), (FRAME_CHAT, b"before"))
+
+        self.backup.promote_to_primary()
+        frame_type, payload = receive_frame(client)
+        self.assertEqual((frame_type, decode_leader(payload)), (FRAME_LEADER, self.takeover_port))
+
+        # clients still retrying the old primary's port reach us there
+        self.assertTrue(self.wait_for(lambda: self.backup.takeover_socket is not None))
+        moved = self.connect(self.takeover_port)
+        self.assertEqual(receive_frame(moved), (FRAME_CHAT, b"before"))
+        send_message(moved, "after")
+        self.assertEqual(receive_frame(client), (FRAME_CHAT, b"after"))
+
+        # the second backup got what we had before as a snapshot and then the new message
+        self.assertTrue(self.wait_for(lambda: len(self.second.history) == 2), "Second backup should catch up")
+        self.assertEqual(self.second.history.tail(), [encode_message("before"), encode_message("after")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import socket
+from common import (
+    FRAME_HEADER, FRAME_ROOM, FRAME_ROOM_CHAT, FRAME_CHAT, FRAME_CONTROL, receive_frame, encode_message,
+    encode_frame
+)
+from connection import ClientConnection
+from primary_server import PrimaryServer
+from backup_server import BackupServer
+from replication import encode_entry
+from rooms import (
+    RoomIndex, ROOM_JOIN, ROOM_LEAVE, ROOM_RESTORE, encode_room, decode_room, encode_room_message,
+    decode_room_message
+)
+
+def payload_of(frame):
+    return frame[FRAME_HEADER.size:]
+
+class TestRoomIndex(unittest.TestCase):
+    def test_join_and_leave(self):
+        """test that joining and leaving changes both the connections and the member table."""
+        rooms = RoomIndex()
+        replies, change = rooms.command("conn", payload_of(encode_room(ROOM_JOIN, "alice", "dev")))
+        self.assertEqual(replies, [change])
+        self.assertEqual(decode_room(payload_of(change)), (ROOM_JOIN, "alice", "dev"))
+        self.assertEqual(rooms.recipients("dev"), frozenset({"conn"}))
+        self.assertEqual(rooms.members, {"alice": {"dev"}})
+        rooms.command("conn", payload_of(encode_room(ROOM_LEAVE, "alice", "dev")))
+        self.assertEqual((rooms.recipients("dev"), rooms.members), (frozenset(), {}))
+
+    def test_restore_after_disconnect(self):
+        """test that a member gets its rooms back on a new connection."""
+        rooms = RoomIndex()
+        for room in ("dev", "ops"):
+            rooms.command("old", payload_of(encode_room(ROOM_JOIN, "alice", room)))
+        rooms.drop("old")
+        self.assertEqual(rooms.recipients("dev"), frozenset())
+        replies, change = rooms.command("new", payload_of(encode_room(ROOM_RESTORE, "alice")))
+        self.assertIsNone(change)
+        self.assertEqual([decode_room(payload_of(reply))[2] for reply in replies], ["dev", "ops"])
+        self.assertEqual(rooms.recipients("ops"), frozenset({"new"}))
+
+    def test_member_ids_belong_to_their_connection(self):
+        """test that a connection can't join, leave or restore for a member another connection holds."""
+        rooms = RoomIndex()
+        rooms.command("alice_conn", payload_of(encode_room(ROOM_JOIN, "alice", "dev")))
+        refused = encode_frame(FRAME_CONTROL, b"member alice is in use on another connection")
+        for op, room in ((ROOM_RESTORE, ""), (ROOM_LEAVE, "dev"), (ROOM_JOIN, "ops")):
+            self.assertEqual(rooms.command("mallory", payload_of(encode_room(op, "alice", room))), ([refused], None))
+        self.assertEqual(rooms.recipients("dev"), frozenset({"alice_conn"}))
+        self.assertEqual(rooms.members, {"alice": {"dev"}})
+        # and a connection only ever speaks for the member it started with
+        replies, change = rooms.command("alice_conn", payload_of(encode_room(ROOM_JOIN, "bob", "dev")))
+        self.assertIsNone(change)
+        # once alice's connection is gone her next one gets her rooms back
+        rooms.drop("alice_conn")
+        replies, _ = rooms.command("alice_new", payload_of(encode_room(ROOM_RESTORE, "alice")))
+        self.assertEqual([decode_room(payload_of(reply))[2] for reply in replies], ["dev"])
+
+    def test_snapshot_rebuilds_the_table(self):
+        """test that applying a snapshot replaces whatever member table was there."""
+        rooms = RoomIndex()
+        rooms.apply(ROOM_JOIN, "alice", "dev")
+        copy = RoomIndex()
+        copy.apply(ROOM_JOIN, "bob", "stale")
+        for frame in rooms.snapshot():
+            copy.apply_frame(frame)
+        self.assertEqual(copy.members, {"alice": {"dev"}})
+
+    def test_history_only_shows_own_rooms(self):
+        """test that room messages in the history only go to that room's members."""
+        rooms = RoomIndex()
+        rooms.subscribe("conn", "dev")
+        self.assertTrue(rooms.can_see("conn", encode_room_message("dev", "hi")))
+        self.assertFalse(rooms.can_see("conn", encode_room_message("ops", "hi")))
+        self.assertTrue(rooms.can_see("conn", encode_message("hi")))
+
+class TestServerRooms(unittest.TestCase):
+    def connect(self, server):
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(2)
+        connection = ClientConnection(ours, "test")
+        connection.start()
+        server.add_client(connection)
+        self.addCleanup(theirs.close)
+        self.addCleanup(connection.close)
+        return connection, theirs
+
+    def test_room_messages_only_reach_members(self):
+        """test that a room message goes to the room and not to everyone connected."""
+        server = PrimaryServer()
+        self.addCleanup(server.stop)
+        sender, _ = self.connect(server)
+        member, member_socket = self.connect(server)
+        outsider, outsider_socket = self.connect(server)
+        server.room_command(sender, payload_of(encode_room(ROOM_JOIN, "alice", "dev")))
+        server.room_command(member, payload_of(encode_room(ROOM_JOIN, "bob", "dev")))
+        self.assertEqual(receive_frame(member_socket)[0], FRAME_ROOM)
+        server.broadcast_frame(encode_room_message("dev", "hi dev"), sender)
+        server.broadcast("hi all", sender)
+        frame_type, payload = receive_frame(member_socket)
+        self.assertEqual(frame_type, FRAME_ROOM_CHAT)
+        self.assertEqual(decode_room_message(payload), ("dev", b"hi dev"))
+        # the outsider's next frame is the lobby message, the room message never came
+        self.assertEqual(receive_frame(outsider_socket), (FRAME_CHAT, b"hi all"))
+        # and room messages aren't replayed to clients that connect later
+        self.assertEqual(server.history.tail(), [encode_message("hi all")])
+
+    def test_backup_restores_replicated_rooms(self):
+        """test that membership replicated to the backup lets a member get its rooms back there."""
+        server = BackupServer()
+        self.addCleanup(server.stop)
+        server.apply_entry(encode_entry(1, encode_room(ROOM_JOIN, "alice", "dev"))[FRAME_HEADER.size:])
+        self.assertEqual(server.applied_seq, 1)
+        connection, their_socket = self.connect(server)
+        server.room_command(connection, payload_of(encode_room(ROOM_RESTORE, "alice")))
+        frame_type, payload = receive_frame(their_socket)
+        self.assertEqual((frame_type, decode_room(payload)), (FRAME_ROOM, (ROOM_JOIN, "alice", "dev")))
+        self.assertEqual(server.rooms.recipients("dev"), frozenset({connection}))
+
+if __name__ == '__main__':
+    unittest.main()
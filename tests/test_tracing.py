@@ -0,0 +1,65 @@
+import unittest
+import socket
+from common import FRAME_HEADER, FRAME_TRACED, TRACE_HEADER, receive_frame, receive_message
+from connection import ClientConnection
+from primary_server import PrimaryServer
+from tracing import Trace, encode_traced, decode_traced, is_traced, received_frame, stamp, hops
+
+class TestTracing(unittest.TestCase):
+    def test_round_trip(self):
+        """test that a traced frame keeps its id, send time and text."""
+        frame = encode_traced("alice: hi", trace_id=42, sent=100.0)
+        self.assertTrue(is_traced(frame))
+        trace, text = decode_traced(frame[FRAME_HEADER.size:])
+        self.assertEqual(trace, Trace(42, 100.0, 0.0, 0.0, 0.0))
+        self.assertEqual(text, b"alice: hi")
+
+    def test_server_times_replace_the_clients(self):
+        """test that only the server fills in the hops after the client's."""
+        payload = TRACE_HEADER.pack(42, 100.0, 1.0, 2.0, 3.0, 9) + b"hi"
+        frame = received_frame(payload, 100.5)
+        frame = stamp(frame, fanned_out=100.75)
+        trace, text = decode_traced(frame[FRAME_HEADER.size:])
+        self.assertEqual(trace, Trace(42, 100.0, 100.5, 0.0, 100.75))
+        self.assertEqual(text, b"hi")
+
+    def test_hops(self):
+        """test that the latency is split up into the hops the message made."""
+        latency = hops(Trace(1, 10.0, 10.25, 10.5, 11.0), 12.0)
+        self.assertEqual(latency, {"total": 2.0, "network": 0.25, "replication": 0.25,
+                                   "queueing": 0.75, "fan_out": 1.0})
+        # a message that never reached a server only has a total
+        self.assertEqual(hops(Trace(1, 10.0, 0.0, 0.0, 0.0), 10.5), {"total": 0.5})
+
+    def test_plain_clients_see_the_text(self):
+        """test that a client reading messages the old way gets the text without the trace."""
+        ours, theirs = socket.socketpair()
+        ours.sendall(encode_traced("hi"))
+        self.assertEqual(receive_message(theirs), "hi")
+        ours.close()
+        theirs.close()
+
+class TestServerTracing(unittest.TestCase):
+    def test_primary_stamps(self):
+        """test that the primary adds its receive and fan out times to a traced message."""
+        server = PrimaryServer()
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(2)
+        connection = ClientConnection(ours, "test")
+        connection.start()
+        server.add_client(connection)
+        payload = encode_traced("hi", trace_id=7, sent=100.0)[FRAME_HEADER.size:]
+        server.broadcast_frame(received_frame(payload, 100.5), None)
+        frame_type, payload = receive_frame(theirs)
+        self.assertEqual(frame_type, FRAME_TRACED)
+        trace, text = decode_traced(payload)
+        self.assertEqual((trace.trace_id, trace.sent, trace.received, text), (7, 100.0, 100.5, b"hi"))
+        # no backup to ack it, so there's no replication time
+        self.assertEqual(trace.replicated, 0.0)
+        self.assertGreater(trace.fanned_out, trace.received)
+        connection.close()
+        theirs.close()
+        server.stop()
+
+if __name__ == '__main__':
+    unittest.main()
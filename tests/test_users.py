@@ -0,0 +1,103 @@
+import unittest
+import socket
+from common import FRAME_HEADER, FRAME_IDENTIFY, FRAME_DIRECT, FRAME_CONTROL, receive_frame, encode_frame
+from connection import ClientConnection
+from primary_server import PrimaryServer
+from backup_server import BackupServer
+from replication import encode_entry
+from users import (
+    UserIndex, USER_ONLINE, USER_OFFLINE, encode_identify, encode_direct, decode_direct, encode_presence,
+    decode_presence
+)
+
+def payload_of(frame):
+    return frame[FRAME_HEADER.size:]
+
+class TestUserIndex(unittest.TestCase):
+    def test_identify_and_route(self):
+        """test that a direct message is addressed from its sender to the one connection."""
+        users = UserIndex()
+        users.identify("alice_conn", "alice")
+        replies, change = users.identify("bob_conn", "bob")
+        self.assertEqual(replies, [encode_identify("bob")])
+        self.assertEqual(decode_presence(payload_of(change)), (USER_ONLINE, "bob"))
+        username, frame = users.route("alice_conn", payload_of(encode_direct("bob", "hi")))
+        self.assertEqual(username, "bob")
+        self.assertEqual(users.connection_of(username), "bob_conn")
+        self.assertEqual(decode_direct(payload_of(frame)), ("alice", b"hi"))
+
+    def test_cannot_route(self):
+        """test that strangers can't send and nobody can send to someone offline."""
+        users = UserIndex()
+        self.assertIsNone(users.route("conn", payload_of(encode_direct("bob", "hi")))[0])
+        users.identify("conn", "alice")
+        self.assertEqual(users.route("conn", payload_of(encode_direct("bob", "hi"))), (None, "bob isn't online"))
+
+    def test_name_stays_with_its_connection(self):
+        """test that nobody can log in as a name another connection holds until that one closes."""
+        users = UserIndex()
+        users.identify("old", "alice")
+        replies, change = users.identify("new", "alice")
+        self.assertIsNone(change)
+        self.assertEqual(replies[0], encode_frame(FRAME_CONTROL, b"alice is logged in on another connection"))
+        self.assertEqual(users.connection_of("alice"), "old")
+        self.assertIsNone(users.route("new", payload_of(encode_direct("alice", "hi")))[0])
+        self.assertEqual(decode_presence(payload_of(users.drop("old"))), (USER_OFFLINE, "alice"))
+        self.assertEqual(users.identify("new", "alice")[0], [encode_identify("alice")])
+        self.assertEqual(users.connection_of("alice"), "new")
+
+    def test_held_until_login(self):
+        """test that messages for someone online elsewhere wait for them to log in here."""
+        users = UserIndex(pending_messages=2)
+        users.apply_frame(encode_presence(USER_ONLINE, "bob"))
+        for text in ("one", "two", "three"):
+            self.assertTrue(users.hold("bob", encode_direct("alice", text)))
+        self.assertFalse(users.hold("carol", encode_direct("alice", "hi")))
+        replies, _ = users.identify("conn", "bob")
+        # only the newest pending_messages are kept
+        self.assertEqual([decode_direct(payload_of(frame))[1] for frame in replies[1:]], [b"two", b"three"])
+
+class TestServerDirect(unittest.TestCase):
+    def connect(self, server):
+        ours, theirs = socket.socketpair()
+        theirs.settimeout(2)
+        connection = ClientConnection(ours, "test")
+        connection.start()
+        server.add_client(connection)
+        self.addCleanup(theirs.close)
+        self.addCleanup(connection.close)
+        return connection, theirs
+
+    def test_direct_reaches_one_client(self):
+        """test that a direct message goes to the recipient alone and errors come back to the sender."""
+        server = PrimaryServer()
+        self.addCleanup(server.stop)
+        (alice, alice_socket), (bob, bob_socket), (carol, carol_socket) = [self.connect(server) for _ in range(3)]
+        for connection, their_socket, name in ((alice, alice_socket, "alice"), (bob, bob_socket, "bob")):
+            server.identify(connection, name.encode())
+            self.assertEqual(receive_frame(their_socket), (FRAME_IDENTIFY, name.encode()))
+        server.direct(alice, payload_of(encode_direct("bob", "psst")))
+        server.direct(alice, payload_of(encode_direct("dave", "hello?")))
+        frame_type, payload = receive_frame(bob_socket)
+        self.assertEqual((frame_type, decode_direct(payload)), (FRAME_DIRECT, ("alice", b"psst")))
+        self.assertEqual(receive_frame(alice_socket), (FRAME_CONTROL, b"dave isn't online"))
+        carol_socket.settimeout(0.2)
+        with self.assertRaises(socket.timeout):
+            receive_frame(carol_socket)
+
+    def test_backup_holds_for_replicated_users(self):
+        """test that after taking over the backup keeps messages for users the primary had online."""
+        server = BackupServer()
+        self.addCleanup(server.stop)
+        server.apply_entry(payload_of(encode_entry(1, encode_presence(USER_ONLINE, "bob"))))
+        alice, _ = self.connect(server)
+        server.identify(alice, b"alice")
+        server.direct(alice, payload_of(encode_direct("bob", "are you back?")))
+        bob, bob_socket = self.connect(server)
+        server.identify(bob, b"bob")
+        self.assertEqual(receive_frame(bob_socket), (FRAME_IDENTIFY, b"bob"))
+        frame_type, payload = receive_frame(bob_socket)
+        self.assertEqual(decode_direct(payload), ("alice", b"are you back?"))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from common import FRAME_HEADER, encode_message
+from primary_server import PrimaryServer
+from tracing import encode_traced, decode_traced
+from delivery import frames_after
+from wal import WriteAheadLog, DURABILITY_NONE, DURABILITY_BATCH, segment_name
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        """give every test its own log directory."""
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_replay_after_restart(self):
+        """test that records survive a restart and numbering carries on."""
+        wal = WriteAheadLog(self.directory, durability=DURABILITY_BATCH)
+        wal.start()
+        for i in range(5):
+            wal.append(encode_message(f"message {i}"))
+        wal.close()
+
+        wal = WriteAheadLog(self.directory)
+        self.assertEqual(wal.last_seq, 5)
+        self.assertEqual([frame for _, _, frame in wal.replay(4)],
+                         [encode_message("message 3"), encode_message("message 4")])
+        wal.start()
+        self.assertEqual(wal.append(encode_message("after restart")), 6)
+        wal.close()
+
+    def test_group_commit(self):
+        """test that appends from many threads share batches and fsyncs."""
+        wal = WriteAheadLog(self.directory, durability=DURABILITY_BATCH, commit_interval=0.01)
+        wal.start()
+        frame = encode_message("x" * 100)
+
+        def writer():
+            for _ in range(50):
+                self.assertTrue(wal.wait(wal.append(frame), timeout=5))
+
+        threads = [threading.Thread(target=writer) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wal.close()
+        self.assertEqual(wal.committed_seq, 400)
+        self.assertLess(wal.syncs, 400 / 2, "Concurrent appends should share fsyncs")
+
+    def test_torn_write_is_cut_off(self):
+        """test that a half written record left by a crash is dropped on recovery."""
+        wal = WriteAheadLog(self.directory, durability=DURABILITY_NONE)
+        wal.start()
+        wal.append(encode_message("whole"))
+        wal.append(encode_message("torn"))
+        wal.close()
+        path = os.path.join(self.directory, segment_name(1))
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+
+        wal = WriteAheadLog(self.directory)
+        self.assertEqual(wal.last_seq, 1)
+        self.assertEqual([seq for seq, _, _ in wal.replay()], [1])
+        wal.close()
+
+    def test_segments_roll_over(self):
+        """test that the log moves on to a new segment once one is full."""
+        wal = WriteAheadLog(self.directory, durability=DURABILITY_BATCH, segment_bytes=32)
+        wal.start()
+        for i in range(4):
+            wal.wait(wal.append(encode_message(f"message {i}")))
+        wal.close()
+        # every record is bigger than a segment, so each one gets its own
+        wal = WriteAheadLog(self.directory)
+        self.assertEqual(wal.segments(), [1, 2, 3, 4])
+        self.assertEqual([seq for seq, _, _ in wal.replay(3)], [3, 4])
+        wal.close()
+
+    def test_primary_logs_broadcasts(self):
+        """test that the primary puts every broadcast in its log."""
+        server = PrimaryServer(wal_dir=self.directory, durability=DURABILITY_BATCH)
+        server.open_wal()
+        server.broadcast("Hello everyone", None)
+        self.assertEqual(server.wal.committed_seq, 1, "Batch durability should wait for the fsync")
+        server.stop()
+        wal = WriteAheadLog(self.directory)
+        self.assertEqual([frame for _, _, frame in wal.replay()], [encode_message("Hello everyone")])
+        wal.close()
+
+    def test_restarted_primary_carries_on_numbering(self):
+        """test that a primary restarting on its log numbers after what it logged and has it for resuming."""
+        server = PrimaryServer(wal_dir=self.directory, durability=DURABILITY_BATCH)
+        server.open_wal()
+        server.broadcast_frame(encode_traced("one", trace_id=1), None)
+        server.broadcast_frame(encode_traced("two", trace_id=2), None)
+        # a plain message is numbered too, it just doesn't carry the number
+        server.broadcast("three", None)
+        server.stop()
+
+        server = PrimaryServer(wal_dir=self.directory, durability=DURABILITY_BATCH)
+        self.addCleanup(server.stop)
+        server.open_wal()
+        self.assertEqual(server.replication_log.last_seq, 3)
+        server.broadcast_frame(encode_traced("four", trace_id=4), None)
+        resumed = frames_after(server.history.tail(), 1)
+        self.assertEqual([decode_traced(frame[FRAME_HEADER.size:])[0].seq for frame in resumed], [2, 4])
+
+if __name__ == '__main__':
+    unittest.main()
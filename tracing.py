@@ -0,0 +1,101 @@
+import os
+import time
+from collections import namedtuple
+from common import FRAME_HEADER, FRAME_TRACED, TRACE_HEADER, encode_frame
+from rooms import is_room_message, numbered_room_message
+
+# the hops of one message as wall clock times, 0 for a hop it hasn't made, and its
+# sequence number, which is how a client that reconnects says where it got up to
+Trace = namedtuple('Trace', 'trace_id sent received replicated fanned_out seq', defaults=(0,))
+
+
+def new_trace_id() -> int:
+    return int.from_bytes(os.urandom(8), 'big')
+
+
+def encode_traced(message: str, trace_id: int = None, sent: float = None) -> bytes:
+    """
+    build a traced chat frame the way a client sends it.
+
+    Args:
+        message: the text of the message
+        trace_id: what to call it, a random id if not given
+        sent: when it was sent, now if not given
+
+    Returns:
+        a FRAME_TRACED frame with only the send time filled in
+    """
+    header = TRACE_HEADER.pack(trace_id or new_trace_id(), sent or time.time(), 0.0, 0.0, 0.0, 0)
+    return encode_frame(FRAME_TRACED, header + message.encode('utf-8'))
+
+
+def decode_traced(payload: bytes):
+    """
+    split a FRAME_TRACED payload up.
+
+    Returns:
+        a (Trace, text bytes) tuple
+    """
+    return Trace(*TRACE_HEADER.unpack_from(payload)), payload[TRACE_HEADER.size:]
+
+
+def is_traced(frame) -> bool:
+    """whether an encoded frame is a traced message."""
+    return len(frame) > FRAME_HEADER.size and frame[FRAME_HEADER.size - 1] == FRAME_TRACED
+
+
+def received_frame(payload: bytes, received: float) -> bytes:
+    """
+    the frame to broadcast for a traced message a client just sent us.
+
+    only the client's trace id and send time are kept, anything it put in
+    the later hops or the sequence number is cleared so they only ever hold ours.
+    """
+    trace, text = decode_traced(payload)
+    return encode_frame(FRAME_TRACED, TRACE_HEADER.pack(trace.trace_id, trace.sent, received, 0.0, 0.0, 0) + text)
+
+
+def stamp(frame: bytes, replicated: float = None, fanned_out: float = None, seq: int = None) -> bytes:
+    """a copy of a traced frame with the given hops, or its sequence number, filled in."""
+    trace = Trace(*TRACE_HEADER.unpack_from(frame, FRAME_HEADER.size))
+    if seq is not None:
+        trace = trace._replace(seq=seq)
+    if replicated is not None:
+        trace = trace._replace(replicated=replicated)
+    if fanned_out is not None:
+        trace = trace._replace(fanned_out=fanned_out)
+    end = FRAME_HEADER.size + TRACE_HEADER.size
+    return b''.join((frame[:FRAME_HEADER.size], TRACE_HEADER.pack(*trace), frame[end:]))
+
+
+def sequenced(frame: bytes, seq: int) -> bytes:
+    """the frame to log and replicate as entry seq, traced and room messages carry their number to every client."""
+    if is_traced(frame):
+        return stamp(frame, seq=seq)
+    if is_room_message(frame):
+        return numbered_room_message(frame, seq)
+    return frame
+
+
+def hops(trace: Trace, arrived: float) -> dict:
+    """
+    where the time went between a message being sent and it arriving.
+
+    network is the client to the primary, queueing is the primary waiting on
+    the disk and the backup before fan out, replication is how long after
+    arriving the backup had it, and fan_out is from fan out starting until
+    the message reached us, through the client queues and back over the network.
+
+    Returns:
+        seconds per hop, only for the hops the message made
+    """
+    result = {"total": arrived - trace.sent}
+    if trace.received:
+        result["network"] = trace.received - trace.sent
+        if trace.replicated:
+            result["replication"] = trace.replicated - trace.received
+        if trace.fanned_out:
+            result["queueing"] = trace.fanned_out - trace.received
+    if trace.fanned_out:
+        result["fan_out"] = arrived - trace.fanned_out
+    return result
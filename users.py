@@ -0,0 +1,214 @@
+import struct
+import threading
+from collections import deque
+from common import (
+    FRAME_HEADER, FRAME_IDENTIFY, FRAME_DIRECT, FRAME_PRESENCE, FRAME_CONTROL, ProtocolError, encode_frame
+)
+
+# what a FRAME_PRESENCE frame says about a username
+USER_ONLINE = 1
+USER_OFFLINE = 2
+USER_CLEAR = 3  # primary to backup: forget everyone, the full list follows as onlines
+USER_OPS = (USER_ONLINE, USER_OFFLINE, USER_CLEAR)
+# a FRAME_PRESENCE payload is the op, then the username
+PRESENCE_OP = struct.Struct('!B')
+# a FRAME_DIRECT payload is the username's length and the username, then the message. from a
+# client the username is who it's for, from the server it's who it's from
+DIRECT_NAME = struct.Struct('!B')
+# usernames have to fit in that one byte length
+MAX_USERNAME_BYTES = 255
+# how many direct messages are kept for someone we think is online but isn't connected
+# here yet, like while everyone reconnects after a failover
+DEFAULT_PENDING_MESSAGES = 100
+
+
+def encode_identify(username: str) -> bytes:
+    """build the frame a client logs in with, the server sends it back once it's done."""
+    name = username.encode('utf-8')
+    if not name or len(name) > MAX_USERNAME_BYTES:
+        raise ProtocolError(f"usernames have to be 1 to {MAX_USERNAME_BYTES} bytes")
+    return encode_frame(FRAME_IDENTIFY, name)
+
+
+def encode_direct(username: str, message) -> bytes:
+    """
+    build a direct message frame.
+
+    Args:
+        username: who it's for, or who it's from when the server sends it on
+        message: the text, as a string or already encoded
+
+    Returns:
+        a FRAME_DIRECT frame
+    """
+    name = username.encode('utf-8')
+    if not name or len(name) > MAX_USERNAME_BYTES:
+        raise ProtocolError(f"usernames have to be 1 to {MAX_USERNAME_BYTES} bytes")
+    message = message.encode('utf-8') if isinstance(message, str) else bytes(message)
+    return encode_frame(FRAME_DIRECT, DIRECT_NAME.pack(len(name)) + name + message)
+
+
+def decode_direct(payload: bytes):
+    """
+    split a FRAME_DIRECT payload up.
+
+    Returns:
+        a (username, message bytes) tuple
+    """
+    end = DIRECT_NAME.size + payload[0]
+    return bytes(payload[DIRECT_NAME.size:end]).decode('utf-8'), payload[end:]
+
+
+def encode_presence(op: int, username: str = "") -> bytes:
+    return encode_frame(FRAME_PRESENCE, PRESENCE_OP.pack(op) + username.encode('utf-8'))
+
+
+def decode_presence(payload: bytes):
+    """
+    split a FRAME_PRESENCE payload up.
+
+    Returns:
+        an (op, username) tuple
+    """
+    op = payload[0]
+    if op not in USER_OPS:
+        raise ProtocolError(f"unknown presence op {op}")
+    return op, bytes(payload[PRESENCE_OP.size:]).decode('utf-8')
+
+
+def is_presence_frame(frame) -> bool:
+    """whether an encoded frame is someone coming or going rather than something to fan out."""
+    return len(frame) >= FRAME_HEADER.size and frame[FRAME_HEADER.size - 1] == FRAME_PRESENCE
+
+
+def is_direct_message(frame) -> bool:
+    return len(frame) >= FRAME_HEADER.size and frame[FRAME_HEADER.size - 1] == FRAME_DIRECT
+
+
+class UserIndex:
+    """
+    who is logged in as whom, for one server.
+
+    connections maps a username to the one connection using it here, so a
+    direct message is one dict lookup and one send. a name stays with the
+    connection that logged in with it until that connection closes, nobody
+    else can log in as them and take their direct messages meanwhile.
+
+    online is every username some server has logged in, replicated to the
+    backup. after a failover the backup still counts those as online, and
+    keeps their direct messages until they reconnect and log in again.
+    """
+
+    def __init__(self, pending_messages: int = DEFAULT_PENDING_MESSAGES):
+        self.pending_messages = pending_messages
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.names = {}
+        self.online = set()
+        # username to direct messages waiting for them to log in here
+        self.pending = {}
+
+    def name_of(self, connection):
+        return self.names.get(connection)
+
+    def connection_of(self, username: str):
+        return self.connections.get(username)
+
+    def identify(self, connection, username: str):
+        """
+        log a connection in.
+
+        Returns:
+            (frames to send the connection, the presence frame every server has to
+            see), the second is None if the name is in use on another connection
+        """
+        if not username or len(username.encode('utf-8')) > MAX_USERNAME_BYTES:
+            raise ProtocolError(f"usernames have to be 1 to {MAX_USERNAME_BYTES} bytes")
+        with self.lock:
+            holder = self.connections.get(username)
+            if holder is not None and holder is not connection:
+                error = f"{username} is logged in on another connection"
+                return [encode_frame(FRAME_CONTROL, error.encode('utf-8'))], None
+            old_name = self.names.pop(connection, None)
+            if old_name is not None and self.connections.get(old_name) is connection:
+                del self.connections[old_name]
+            self.connections[username] = connection
+            self.names[connection] = username
+            self.online.add(username)
+            waiting = list(self.pending.pop(username, ()))
+        return [encode_identify(username)] + waiting, encode_presence(USER_ONLINE, username)
+
+    def drop(self, connection):
+        """
+        log a closed connection out.
+
+        Returns:
+            the presence frame every server has to see, None if it wasn't logged in
+            or its name has since moved to another connection
+        """
+        with self.lock:
+            username = self.names.pop(connection, None)
+            if username is None or self.connections.get(username) is not connection:
+                return None
+            del self.connections[username]
+            self.online.discard(username)
+        return encode_presence(USER_OFFLINE, username)
+
+    def apply(self, op: int, username: str) -> None:
+        """update who is online, for a presence frame from another server."""
+        with self.lock:
+            if op == USER_ONLINE:
+                self.online.add(username)
+            elif op == USER_OFFLINE:
+                # they may have logged in here since, which wins
+                if username not in self.connections:
+                    self.online.discard(username)
+                    self.pending.pop(username, None)
+            elif op == USER_CLEAR:
+                self.online = set(self.connections)
+
+    def apply_frame(self, frame) -> None:
+        """apply an encoded FRAME_PRESENCE frame."""
+        self.apply(*decode_presence(memoryview(frame)[FRAME_HEADER.size:]))
+
+    def route(self, sender, payload: bytes):
+        """
+        work out where a direct message from a client goes.
+
+        Args:
+            sender: the connection it came from, it has to be logged in
+            payload: the FRAME_DIRECT payload it sent, naming who it's for
+
+        Returns:
+            (recipient username, the frame to send them naming the sender), or
+            (None, an error to send back) if it can't be delivered
+        """
+        username, message = decode_direct(payload)
+        sender_name = self.names.get(sender)
+        if sender_name is None:
+            return None, "log in with a username before sending direct messages"
+        if username not in self.online:
+            return None, f"{username} isn't online"
+        return username, encode_direct(sender_name, message)
+
+    def hold(self, username: str, frame: bytes) -> bool:
+        """
+        keep a direct message for someone who is online but not connected here.
+
+        Returns:
+            true if it was kept, false if they aren't online at all
+        """
+        with self.lock:
+            if username not in self.online:
+                return False
+            waiting = self.pending.get(username)
+            if waiting is None:
+                waiting = self.pending[username] = deque(maxlen=self.pending_messages)
+            waiting.append(frame)
+        return True
+
+    def snapshot(self) -> list:
+        """everyone online as frames, a clear and then one online each."""
+        with self.lock:
+            names = sorted(self.online)
+        return [encode_presence(USER_CLEAR)] + [encode_presence(USER_ONLINE, name) for name in names]
@@ -0,0 +1,387 @@
+import os
+import struct
+import threading
+import time
+import zlib
+from common import FRAME_HEADER, IOV_MAX
+
+# how hard the log tries to keep what it has been given
+DURABILITY_NONE = "none"          # hand batches to the os and never fsync, survives a process crash only
+DURABILITY_INTERVAL = "interval"  # fsync at most every sync_interval, a power cut loses up to that much
+DURABILITY_BATCH = "batch"        # fsync every batch before it counts as committed
+DURABILITIES = (DURABILITY_NONE, DURABILITY_INTERVAL, DURABILITY_BATCH)
+
+# how long the writer waits for more records to join a batch, with 0 a batch
+# is still everything that queued up while the last one was written and synced
+DEFAULT_COMMIT_INTERVAL = 0.0  # seconds
+# a batch is written straight away once this many bytes are waiting
+DEFAULT_COMMIT_BYTES = 1024 * 1024
+# how often the interval mode fsyncs
+DEFAULT_SYNC_INTERVAL = 1.0  # seconds
+# start a new segment file once the current one reaches this size
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+# how many bytes of segment go by between entries in its sparse index
+DEFAULT_INDEX_BYTES = 64 * 1024
+
+# every record is its sequence number, the wall clock time it was appended and
+# a crc32 of the frame, followed by the encoded frame itself
+RECORD_HEADER = struct.Struct('!QdI')
+# segments are named after the first sequence number in them so they sort in order
+SEGMENT_SUFFIX = ".wal"
+# every segment has a sparse index next to it, each entry is the sequence number
+# and timestamp of a record and that record's offset in the segment
+INDEX_ENTRY = struct.Struct('!QdQ')
+INDEX_SUFFIX = ".idx"
+
+
+def segment_name(first_seq: int) -> str:
+    """file name for the segment starting at first_seq."""
+    return f"{first_seq:020d}{SEGMENT_SUFFIX}"
+
+
+def index_name(first_seq: int) -> str:
+    """file name for the index of the segment starting at first_seq."""
+    return f"{first_seq:020d}{INDEX_SUFFIX}"
+
+
+def list_segments(directory: str) -> list:
+    """the first sequence number of every segment in directory, oldest first."""
+    firsts = []
+    for name in os.listdir(directory):
+        if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+            firsts.append(int(name[:-len(SEGMENT_SUFFIX)]))
+    return sorted(firsts)
+
+
+def read_index(path: str) -> list:
+    """
+    load a segment's sparse index.
+
+    Returns:
+        (seq, timestamp, offset) tuples in segment order, empty if there's no index yet
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    # a crash can leave the last entry half written
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    return list(INDEX_ENTRY.iter_unpack(data[:usable]))
+
+
+def parse_records(data, offset: int = 0):
+    """
+    walk the records in a segment's contents.
+
+    stops at the first record that is cut short or fails its checksum, which
+    is what a crash in the middle of a write leaves behind.
+
+    Args:
+        data: the segment's bytes, or a memoryview of them
+        offset: where to start reading
+
+    Returns:
+        a generator of (seq, timestamp, frame offset, frame length, record end) tuples
+    """
+    end = len(data)
+    while offset + RECORD_HEADER.size + FRAME_HEADER.size <= end:
+        seq, timestamp, checksum = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        length, _ = FRAME_HEADER.unpack_from(data, start)
+        stop = start + FRAME_HEADER.size + length
+        if stop > end or zlib.crc32(data[start:stop]) != checksum:
+            return
+        yield seq, timestamp, start, stop - start, stop
+        offset = stop
+
+
+class WriteAheadLog:
+    """
+    segmented append-only log of every frame the server fans out.
+
+    appends only queue the record, a writer thread group commits everything
+    queued in one write (and one fsync, depending on durability) every
+    commit_interval, so a busy room costs one syscall per batch rather than
+    per message. committed_seq is the newest record that is as safe as the
+    durability mode promises, wait() blocks until a record gets there.
+    """
+
+    def __init__(self, directory: str, durability: str = DURABILITY_INTERVAL,
+                 commit_interval: float = DEFAULT_COMMIT_INTERVAL,
+                 sync_interval: float = DEFAULT_SYNC_INTERVAL,
+                 segment_bytes: int = DEFAULT_SEGMENT_BYTES,
+                 commit_bytes: int = DEFAULT_COMMIT_BYTES, index_bytes: int = DEFAULT_INDEX_BYTES,
+                 on_commit=None):
+        if durability not in DURABILITIES:
+            raise ValueError(f"unknown durability {durability!r}")
+        self.directory = directory
+        self.durability = durability
+        self.commit_interval = commit_interval
+        self.sync_interval = sync_interval
+        self.segment_bytes = segment_bytes
+        self.commit_bytes = commit_bytes
+        self.index_bytes = index_bytes
+        # called from the writer thread with the new committed_seq after every batch
+        self.on_commit = on_commit
+        # header and frame buffers waiting for the next batch, when the first of them
+        # arrived and the timestamp in its record
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = 0.0
+        self.pending_time = 0.0
+        # sequence number of the newest record appended, and of the newest committed one
+        self.last_seq = 0
+        self.committed_seq = 0
+        # the segment we append to and how big it is
+        self.fd = None
+        self.segment_size = 0
+        # the segment's index and the offset its newest entry points at
+        self.index_fd = None
+        self.indexed_at = 0
+        # written but not fsynced yet, and when we last fsynced
+        self.dirty = False
+        self.last_sync = time.monotonic()
+        # how many batches and fsyncs the writer has done
+        self.batches = 0
+        self.syncs = 0
+        # set once close() is called, and if the disk fails us
+        self.closing = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.writer = None
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def segments(self) -> list:
+        """the first sequence number of every segment on disk, oldest first."""
+        return list_segments(self.directory)
+
+    def recover(self) -> None:
+        # carry on numbering from the last good record and cut off anything torn after
+        # it, the index lets us read just the end of the last segment instead of all of it
+        firsts = self.segments()
+        if not firsts:
+            self.open_segment(1)
+            return
+        first = firsts[-1]
+        path = os.path.join(self.directory, segment_name(first))
+        index_path = os.path.join(self.directory, index_name(first))
+        size = os.path.getsize(path)
+        stored = read_index(index_path)
+        entries = [entry for entry in stored if entry[2] < size]
+        with open(path, 'rb') as f:
+            while True:
+                start_seq, offset = (entries[-1][0], entries[-1][2]) if entries else (first, 0)
+                f.seek(offset)
+                data = f.read()
+                self.last_seq = start_seq - 1
+                good = offset
+                for seq, _, _, _, end in parse_records(data):
+                    self.last_seq = seq
+                    good = offset + end
+                # an entry that points at a torn record is no good either
+                if good > offset or not entries:
+                    break
+                entries.pop()
+        if good < size:
+            print(f"Truncating torn write at offset {good} of {path}")
+            with open(path, 'r+b') as f:
+                f.truncate(good)
+        if len(entries) != len(stored):
+            with open(index_path, 'wb') as f:
+                f.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in entries))
+        self.committed_seq = self.last_seq
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        self.index_fd = os.open(index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.segment_size = good
+        # no entries means the next batch gets one
+        self.indexed_at = entries[-1][2] if entries else -self.index_bytes
+
+    def open_segment(self, first_seq: int) -> None:
+        # close the current segment, making sure it's all on disk, and start a new one
+        if self.fd is not None:
+            if self.durability != DURABILITY_NONE:
+                self.sync()
+            os.close(self.fd)
+            os.close(self.index_fd)
+        path = os.path.join(self.directory, segment_name(first_seq))
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(os.path.join(self.directory, index_name(first_seq)),
+                                os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.segment_size = 0
+        self.indexed_at = -self.index_bytes
+
+    def start(self) -> None:
+        """start the group commit thread."""
+        self.writer = threading.Thread(target=self.commit_loop, daemon=True)
+        self.writer.start()
+
+    def append(self, frame: bytes) -> int:
+        """
+        queue a frame for the next batch.
+
+        Args:
+            frame: the complete encoded frame
+
+        Returns:
+            the record's sequence number, pass it to wait() to block until it's committed
+        """
+        with self.condition:
+            if self.closing:
+                raise ValueError("write-ahead log is closed")
+            self.last_seq += 1
+            timestamp = time.time()
+            self.pending.append(RECORD_HEADER.pack(self.last_seq, timestamp, zlib.crc32(frame)))
+            self.pending.append(frame)
+            self.pending_bytes += RECORD_HEADER.size + len(frame)
+            # only the first record of a batch, or one that fills it, needs to wake the writer
+            if len(self.pending) == 2:
+                self.pending_since = time.monotonic()
+                self.pending_time = timestamp
+                self.condition.notify_all()
+            elif self.pending_bytes >= self.commit_bytes:
+                self.condition.notify_all()
+            return self.last_seq
+
+    def wait(self, seq: int, timeout: float = None) -> bool:
+        """
+        block until record seq is committed.
+
+        Returns:
+            true once it is, false on timeout or if the log can't be written
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.committed_seq < seq and self.error is None:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return self.committed_seq >= seq
+
+    def commit_loop(self) -> None:
+        # write out whatever has queued up, one batch at a time
+        while True:
+            with self.condition:
+                self.wait_for_batch()
+                batch, self.pending = self.pending, []
+                self.pending_bytes = 0
+                last_seq = self.last_seq
+                first_time = self.pending_time
+                closing = self.closing
+            try:
+                if batch:
+                    self.write_batch(batch, last_seq - len(batch) // 2 + 1, first_time)
+                if self.dirty and (self.durability == DURABILITY_BATCH or closing or
+                                   (self.durability == DURABILITY_INTERVAL and
+                                    time.monotonic() - self.last_sync >= self.sync_interval)):
+                    self.sync()
+            except OSError as e:
+                print(f"Write-ahead log failed: {e}")
+                with self.condition:
+                    self.error = e
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.committed_seq = last_seq
+                self.condition.notify_all()
+            if batch and self.on_commit is not None:
+                self.on_commit(last_seq)
+            if closing:
+                return
+
+    def wait_for_batch(self) -> None:
+        # called with the lock held, returns once there's a batch to write or an fsync is due
+        while not self.pending and not self.closing:
+            timeout = None
+            if self.dirty:
+                timeout = self.last_sync + self.sync_interval - time.monotonic()
+                if timeout <= 0:
+                    return
+            self.condition.wait(timeout)
+        # give everyone else commit_interval to get their records into this batch
+        deadline = self.pending_since + self.commit_interval
+        while not self.closing and self.pending_bytes < self.commit_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self.condition.wait(remaining)
+
+    def write_batch(self, buffers: list, first_seq: int, first_time: float) -> None:
+        # batches never straddle segments, so every segment starts on a record
+        if self.segment_size >= self.segment_bytes:
+            self.open_segment(first_seq)
+        self.batches += 1
+        # index entries always point at the start of a batch, which is a record boundary
+        offset = self.segment_size
+        self.write_buffers(buffers)
+        if offset - self.indexed_at >= self.index_bytes:
+            os.write(self.index_fd, INDEX_ENTRY.pack(first_seq, first_time, offset))
+            self.indexed_at = offset
+
+    def write_buffers(self, buffers: list) -> None:
+        # one writev for the whole batch unless the platform doesn't have it
+        self.dirty = self.durability != DURABILITY_NONE
+        if not hasattr(os, 'writev'):
+            data = b''.join(buffers)
+            self.segment_size += len(data)
+            while data:
+                data = data[os.write(self.fd, data):]
+            return
+        start = 0
+        while start < len(buffers):
+            written = os.writev(self.fd, buffers[start:start + IOV_MAX])
+            self.segment_size += written
+            # skip past whatever was written, keeping the rest of a partly written buffer
+            while start < len(buffers) and written >= len(buffers[start]):
+                written -= len(buffers[start])
+                start += 1
+            if written:
+                buffers[start] = memoryview(buffers[start])[written:]
+
+    def sync(self) -> None:
+        # fdatasync skips the metadata we don't need where the platform has it
+        getattr(os, 'fdatasync', os.fsync)(self.fd)
+        self.syncs += 1
+        self.dirty = False
+        self.last_sync = time.monotonic()
+
+    def replay(self, start_seq: int = 1):
+        """
+        read records back from disk, oldest first.
+
+        only sees what the writer has already written, not what is still queued.
+
+        Args:
+            start_seq: the first sequence number wanted
+
+        Returns:
+            a generator of (seq, timestamp, frame) tuples
+        """
+        firsts = self.segments()
+        for index, first in enumerate(firsts):
+            # skip whole segments that end before start_seq
+            if index + 1 < len(firsts) and firsts[index + 1] <= start_seq:
+                continue
+            with open(os.path.join(self.directory, segment_name(first)), 'rb') as f:
+                data = f.read()
+            for seq, timestamp, offset, length, _ in parse_records(data):
+                if seq >= start_seq:
+                    yield seq, timestamp, data[offset:offset + length]
+
+    def close(self) -> None:
+        """commit whatever is still queued and close the segment."""
+        with self.condition:
+            if self.closing:
+                return
+            self.closing = True
+            self.condition.notify_all()
+        if self.writer is not None:
+            self.writer.join()
+        elif self.fd is not None and self.durability != DURABILITY_NONE:
+            self.sync()
+        if self.fd is not None:
+            os.close(self.fd)
+            os.close(self.index_fd)
+            self.fd = None